@@ -0,0 +1,99 @@
+# No shebang line, this module is meant to be run with python -m
+#
+# Copyright 2013 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Job Listing Benchmark
+=====================
+
+Compares listing jobs with the deferred ``details`` columns left unloaded
+against listing them with :attr:`.Job.WITH_DETAILS`.  For each case the
+number of bytes returned by the database and the time spent fetching and
+decoding the rows is printed.  Run with::
+
+    python -m benchmarks.job_listing [count]
+
+By default an in memory sqlite database is used, set
+``PYFARM_DATABASE_URI`` to benchmark against another database.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+os.environ.setdefault("PYFARM_DATABASE_URI", "sqlite:///:memory:")
+os.environ.setdefault("PYFARM_CONFIG", "debug")
+
+from pyfarm.core.enums import JobTypeLoadMode
+from pyfarm.master.application import db
+from pyfarm.models.agent import Agent  # required for relationships
+from pyfarm.models.task import Task  # required for relationships
+from pyfarm.models.job import Job
+from pyfarm.models.jobtype import JobType
+
+
+def populate(count):
+    """inserts ``count`` jobs with typically sized details"""
+    jobtype = JobType(
+        name="benchmark", classname="Benchmark", mode=JobTypeLoadMode.OPEN,
+        code="class Benchmark(JobType):\n    pass\n")
+    db.session.add(jobtype)
+    db.session.flush()
+
+    environ = dict(("VARIABLE_%s" % i, "/some/path/%s" % i) for i in range(40))
+    args = ["-render", "-frame", "1", "-output", "/some/output/path"] * 4
+    data = {"submitted_from": "benchmark", "history": ["created"] * 50}
+    notes = "notes about this job " * 20
+
+    for _ in range(count):
+        db.session.add(Job(
+            job_type_id=jobtype.id, environ=environ, args=args, data=data,
+            notes=notes))
+    db.session.commit()
+
+
+def measure(options):
+    """
+    Returns the number of bytes the listing query selects and the seconds
+    spent loading and decoding every job with ``options``
+    """
+    query = Job.query.options(*options)
+    received = 0
+    for row in db.session.execute(query.statement):
+        received += sum(len(str(value)) for value in row if value is not None)
+
+    db.session.expunge_all()
+    start = time.time()
+    jobs = query.all()
+    seconds = time.time() - start
+    db.session.expunge_all()
+    return received, seconds, len(jobs)
+
+
+def main(count):
+    db.create_all()
+    populate(count)
+
+    for label, options in (
+            ("deferred", ()), ("WITH_DETAILS", Job.WITH_DETAILS)):
+        received, seconds, count = measure(options)
+        print("%-14s %6d jobs %12d bytes %8.3fs" % (
+            label, count, received, seconds))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
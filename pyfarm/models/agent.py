@@ -27,15 +27,15 @@ from textwrap import dedent
 
 import netaddr
 from sqlalchemy.schema import UniqueConstraint
-from sqlalchemy.orm import validates
+from sqlalchemy.orm import validates, subqueryload
 from netaddr import AddrFormatError, IPAddress
 
 from pyfarm.core.enums import AgentState, STRING_TYPES, PY3
 from pyfarm.core.config import read_env_number, read_env_int, read_env_bool
 from pyfarm.master.application import db, app
-from pyfarm.models.core.functions import repr_ip
+from pyfarm.models.core.functions import repr_ip, insert_associations
 from pyfarm.models.core.mixins import (
-    ValidatePriorityMixin, UtilityMixins, ReprMixin)
+    ValidatePriorityMixin, UtilityMixins, ReprMixin, KeysetPaginationMixin)
 from pyfarm.models.core.types import (
     id_column, IPv4Address, IDTypeAgent, IDTypeTag, UseAgentAddressEnum,
     AgentStateEnum)
@@ -43,6 +43,8 @@ from pyfarm.models.core.cfg import (
     TABLE_AGENT, TABLE_SOFTWARE, TABLE_TAG, TABLE_AGENT_TAG_ASSOC,
     MAX_HOSTNAME_LENGTH, MAX_TAG_LENGTH, TABLE_AGENT_SOFTWARE_ASSOC,
     TABLE_PROJECT_AGENTS, TABLE_PROJECT)
+from pyfarm.models.software import Software, parse_requirement
+from pyfarm.models.tag import Tag
 
 PYFARM_REQUIRE_PRIVATE_IP = read_env_bool("PYFARM_REQUIRE_PRIVATE_IP", False)
 REGEX_HOSTNAME = re.compile("^(?!-)[A-Z\d-]{1,63}(?<!-)"
@@ -98,7 +100,8 @@ class AgentTaggingMixin(object):
         return value
 
 
-class Agent(db.Model, ValidatePriorityMixin, UtilityMixins, ReprMixin):
+class Agent(db.Model, ValidatePriorityMixin, UtilityMixins, ReprMixin,
+            KeysetPaginationMixin):
     """
     Stores information about an agent include its network address,
     state, allocation configuration, etc.
@@ -114,11 +117,14 @@ class Agent(db.Model, ValidatePriorityMixin, UtilityMixins, ReprMixin):
 
     """
     __tablename__ = TABLE_AGENT
-    __table_args__ = (UniqueConstraint("hostname", "ip", "port"), )
+    __table_args__ = (
+        UniqueConstraint("hostname", "ip", "port"),
+        db.Index("%s_keyset_idx" % TABLE_AGENT, "hostname", "id"))
     STATE_DEFAULT = "online"
     REPR_COLUMNS = (
         "id", "hostname", "state", "ip", "remote_ip", "port", "cpus",
         "ram", "free_ram")
+    KEYSET_COLUMNS = ("hostname", "id")
     REPR_CONVERT_COLUMN = {
         "ip": repr_ip,
         "remote_ip": repr_ip,
@@ -228,6 +234,31 @@ class Agent(db.Model, ValidatePriorityMixin, UtilityMixins, ReprMixin):
                                    "which is not associated with any projects "
                                    "will be a member of all projects.")
 
+    # Read only, non-dynamic versions of the relationships above so they
+    # can be eager loaded.  These are not refreshed when the dynamic
+    # relationships are changed until the agent is expired or reloaded.
+    tags_list = db.relationship("Tag", secondary=AgentTagAssociation,
+                                viewonly=True,
+                                doc="Eager loadable version of :attr:`tags`")
+    software_list = db.relationship("Software",
+                                    secondary=AgentSoftwareAssociation,
+                                    viewonly=True,
+                                    doc=dedent("""
+                                    Eager loadable version of
+                                    :attr:`software`"""))
+    projects_list = db.relationship("Project", secondary=AgentProjects,
+                                    viewonly=True,
+                                    doc=dedent("""
+                                    Eager loadable version of
+                                    :attr:`projects`"""))
+
+    #: Query options for listing agents along with their tags, software
+    #: and projects.  Each collection is loaded for every agent in the
+    #: result with one additional query.
+    PROFILE_LIST = (
+        subqueryload("tags_list"), subqueryload("software_list"),
+        subqueryload("projects_list"))
+
     @classmethod
     def validate_hostname(cls, key, value):
         """
@@ -309,6 +340,67 @@ class Agent(db.Model, ValidatePriorityMixin, UtilityMixins, ReprMixin):
         """validates the ram, cpus, and port columns"""
         return self.validate_resource(key, value)
 
+    def add_tags(self, names):
+        """
+        Associates the tags ``names`` with this agent.  Tags are resolved
+        and created in bulk by :meth:`.Tag.resolve` and the association
+        rows are written with a single statement.  Returns the number of
+        tags which were newly associated.
+        """
+        if self.id is None:
+            db.session.add(self)
+            db.session.flush()
+
+        return insert_associations(
+            AgentTagAssociation, "agent_id", self.id, "tag_id",
+            Tag.resolve(names).values())
+
+    def add_software(self, items):
+        """
+        Associates the software ``items`` with this agent, see
+        :meth:`.Software.resolve` for the accepted values.  Returns the
+        number of software items which were newly associated.
+        """
+        if self.id is None:
+            db.session.add(self)
+            db.session.flush()
+
+        return insert_associations(
+            AgentSoftwareAssociation, "agent_id", self.id, "software_id",
+            Software.resolve(items).values())
+
+    @classmethod
+    def with_software(cls, requirements, query=None):
+        """
+        Returns a query for the agents which provide all of the software
+        in ``requirements``.  Version constraints are evaluated by the
+        database, see :meth:`.Software.matching`.
+
+        :param requirements:
+            requirements such as ``maya >= 2014`` or ``(name, constraint)``
+            tuples
+
+        :param query:
+            optional query to filter instead of :attr:`query`
+        """
+        if query is None:
+            query = cls.query
+
+        for requirement in requirements:
+            if isinstance(requirement, STRING_TYPES):
+                name, spec = parse_requirement(requirement)
+            else:
+                name, spec = requirement
+
+            software_ids = db.select([Software.id]).where(
+                Software.matching(name, spec))
+            query = query.filter(cls.id.in_(
+                db.select([AgentSoftwareAssociation.c.agent_id]).where(
+                    AgentSoftwareAssociation.c.software_id.in_(
+                        software_ids))))
+
+        return query
+
     def serialize_column(self, column):
         """serializes a single column, typically used by a dictionary mixin"""
         if isinstance(column, IPAddress):
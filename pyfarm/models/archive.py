@@ -0,0 +1,152 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2013 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Archive
+=======
+
+Moves finished jobs, along with their tasks, dependencies and
+tag/software associations, out of the tables used by the queue and into
+archive tables with the same columns.  This keeps the queue's tables
+and indexes sized to the live work instead of growing forever.
+"""
+
+from datetime import datetime, timedelta
+
+from pyfarm.core.config import read_env_int, read_env_number
+from pyfarm.core.enums import WorkState
+from pyfarm.master.application import db
+from pyfarm.models.core.statemap import state_maps
+from pyfarm.models.job import (
+    Job, JobDependencies, JobTagAssociation, JobSoftwareDependency)
+from pyfarm.models.task import Task, TaskDependencies
+
+ARCHIVE_AGE = read_env_number("PYFARM_ARCHIVE_AGE_DAYS", 30)
+ARCHIVE_CHUNK_SIZE = read_env_int("PYFARM_ARCHIVE_CHUNK_SIZE", 100)
+
+#: States a job must be in before it can be archived
+ARCHIVE_STATES = (WorkState.DONE, WorkState.FAILED)
+
+assert ARCHIVE_AGE >= 0, "$PYFARM_ARCHIVE_AGE_DAYS must be >= 0"
+assert ARCHIVE_CHUNK_SIZE >= 1, "$PYFARM_ARCHIVE_CHUNK_SIZE must be >= 1"
+
+
+def archive_table(table, *indexes):
+    """
+    Returns a table named ``<table>_archive`` with the same columns as
+    ``table``.  Foreign keys, defaults and autoincrement are left out
+    since rows are copied as they are and may outlive the rows they
+    referred to.
+
+    :param indexes:
+        ``(suffix, columns)`` tuples for indexes to create
+    """
+    name = "%s_archive" % table.name
+    columns = [
+        db.Column(column.name, column.type, primary_key=column.primary_key,
+                  nullable=column.nullable, autoincrement=False)
+        for column in table.c]
+    args = [
+        db.Index("%s_%s_idx" % (name, suffix), *index_columns)
+        for suffix, index_columns in indexes]
+    return db.Table(name, db.metadata, *(columns + args))
+
+
+JobArchive = archive_table(
+    Job.__table__, ("time_finished", ("time_finished", )))
+TaskArchive = archive_table(Task.__table__, ("job", ("job_id", )))
+JobDependenciesArchive = archive_table(JobDependencies)
+JobTagAssociationArchive = archive_table(JobTagAssociation)
+JobSoftwareDependencyArchive = archive_table(JobSoftwareDependency)
+TaskDependenciesArchive = archive_table(TaskDependencies)
+
+
+#: Maps each table :meth:`.Job.dependent_rows` returns to its archive table
+ARCHIVE_TABLES = {
+    TaskDependencies: TaskDependenciesArchive,
+    Task.__table__: TaskArchive,
+    JobDependencies: JobDependenciesArchive,
+    JobTagAssociation: JobTagAssociationArchive,
+    JobSoftwareDependency: JobSoftwareDependencyArchive,
+    Job.__table__: JobArchive}
+
+
+def archive_chunk(job_ids):
+    """
+    Copies the rows of ``job_ids`` into the archive tables then deletes
+    them from the live tables.  Dependencies between an archived job and
+    a job which is still live are archived too.  The live job stops
+    waiting on the archived one, even when it failed and so never
+    finished, see :meth:`.Job.release_children`.
+    This does not commit.  Returns a dictionary with the number of rows
+    archived from each table.
+    """
+    counts = {}
+    rows = Job.dependent_rows(job_ids)
+
+    for table, whereclause in rows:
+        archive = ARCHIVE_TABLES[table]
+        names = [column.name for column in table.c]
+        result = db.session.execute(archive.insert().from_select(
+            names, db.select([table.c[name] for name in names]).where(
+                whereclause)))
+        counts[table.name] = result.rowcount
+
+    Job.release_children(job_ids, exclude=job_ids)
+    for table, whereclause in rows:
+        db.session.execute(table.delete().where(whereclause))
+
+    for job_id in job_ids:
+        state_maps.pop(job_id)
+
+    return counts
+
+
+def archive_jobs(age=None, chunk_size=None, now=None):
+    """
+    Archives jobs which have been finished for longer than ``age`` days,
+    :const:`ARCHIVE_AGE` by default.  Jobs are archived in transactions
+    of at most ``chunk_size`` jobs, :const:`ARCHIVE_CHUNK_SIZE` by
+    default, so locks are only held briefly.  Each chunk is committed
+    before the next one starts.
+
+    :return:
+        dictionary with the number of rows archived from each table
+    """
+    age = ARCHIVE_AGE if age is None else age
+    chunk_size = chunk_size or ARCHIVE_CHUNK_SIZE
+    cutoff = (now or datetime.now()) - timedelta(days=age)
+    query = db.select([Job.id]).where(
+        Job.state.in_(ARCHIVE_STATES) &
+        (Job.time_finished < cutoff)).order_by(Job.id).limit(chunk_size)
+
+    totals = {}
+    while True:
+        job_ids = [row[0] for row in db.session.execute(query)]
+        if not job_ids:
+            break
+
+        try:
+            counts = archive_chunk(job_ids)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        for name, count in counts.items():
+            totals[name] = totals.get(name, 0) + count
+
+    return totals
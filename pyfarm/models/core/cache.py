@@ -0,0 +1,174 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2013 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Caches
+======
+
+Small in-process caches used by the models to avoid repeating queries
+or computations for data which rarely changes.
+"""
+
+from collections import OrderedDict
+from threading import RLock
+from time import time
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+#: Returned by :meth:`LRUCache.get` when a key is not cached so cached
+#: values of None can be told apart from missing entries
+NOT_CACHED = object()
+
+
+class LRUCache(object):
+    """
+    A thread safe dictionary like object which stores at most
+    ``maxsize`` entries.  When full the least recently used entry is
+    discarded to make room for new entries.  The number of successful
+    and unsuccessful lookups made with :meth:`get` are counted in
+    :attr:`hits` and :attr:`misses`.
+
+    :param int maxsize:
+        the maximum number of entries to store
+    """
+    def __init__(self, maxsize=128):
+        assert maxsize >= 1, "`maxsize` must be >= 1"
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        """returns the value for ``key`` or ``default`` if not cached"""
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self.data[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """stores ``value`` for ``key``, discarding old entries if full"""
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+        return value
+
+    def lookup(self, key, function, store_none=True):
+        """
+        returns the value for ``key``, calling ``function()`` and storing
+        its result if ``key`` is not cached.  Results of None are stored
+        too so repeated lookups of missing values are also cached unless
+        ``store_none`` is False.
+        """
+        value = self.get(key, NOT_CACHED)
+        if value is NOT_CACHED:
+            value = function()
+            if value is not None or store_none:
+                self.put(key, value)
+        return value
+
+    def pop(self, key, default=None):
+        """removes ``key`` from the cache and returns its value"""
+        with self.lock:
+            return self.data.pop(key, default)
+
+    def discard(self, predicate):
+        """removes every entry for which ``predicate(key, value)`` is True"""
+        with self.lock:
+            for key, value in list(self.data.items()):
+                if predicate(key, value):
+                    del self.data[key]
+
+    def clear(self):
+        """removes all entries from the cache"""
+        with self.lock:
+            self.data.clear()
+
+
+class TTLCache(LRUCache):
+    """
+    A :class:`LRUCache` whose entries also expire ``ttl`` seconds after
+    they were stored.
+
+    :param int maxsize:
+        the maximum number of entries to store
+
+    :param float ttl:
+        the default number of seconds an entry remains valid
+    """
+    def __init__(self, maxsize=128, ttl=60):
+        super(TTLCache, self).__init__(maxsize=maxsize)
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        """returns the value for ``key`` or ``default`` if not cached"""
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is not None and entry[0] <= time():
+                del self.data[key]
+
+            entry = super(TTLCache, self).get(key)
+            return default if entry is None else entry[1]
+
+    def put(self, key, value, ttl=None):
+        """
+        stores ``value`` for ``key`` for ``ttl`` seconds, by default
+        :attr:`ttl`
+        """
+        expires = time() + (self.ttl if ttl is None else ttl)
+        super(TTLCache, self).put(key, (expires, value))
+        return value
+
+    def pop(self, key, default=None):
+        """removes ``key`` from the cache and returns its value"""
+        entry = super(TTLCache, self).pop(key)
+        return default if entry is None else entry[1]
+
+    def discard(self, predicate):
+        """removes every entry for which ``predicate(key, value)`` is True"""
+        super(TTLCache, self).discard(
+            lambda key, entry: predicate(key, entry[1]))
+
+
+def clear_on_rollback(*caches):
+    """
+    Clears each of ``caches`` whenever a session is rolled back so they
+    can not hold ids of rows which were never committed.
+    """
+    def session_after_rollback(session):
+        for cache in caches:
+            cache.clear()
+
+    event.listen(Session, "after_rollback", session_after_rollback)
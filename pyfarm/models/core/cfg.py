@@ -55,6 +55,10 @@ variables have defaults defined in the configuration under `PYFARM_DB_<value>`
     Stores relationships between :const:`.TABLE_USERS_USER` and
     :const:`.TABLE_USERS_ROLE`
 
+:const string TABLE_USERS_ROLE_CLOSURE:
+    Stores every ancestor/descendant pair of roles in
+    :const:`.TABLE_USERS_ROLE` based on their dotted names
+
 :const integer MAX_HOSTNAME_LENGTH:
     the max length of a hostname
 
@@ -96,12 +100,14 @@ TABLE_USERS_PROJECTS = "%s_projects" % TABLE_USERS
 TABLE_USERS_USER = "%s_users" % TABLE_USERS
 TABLE_USERS_ROLE = "%s_roles" % TABLE_USERS
 TABLE_USERS_USER_ROLES = "%s_user_roles" % TABLE_USERS
+TABLE_USERS_ROLE_CLOSURE = "%s_role_closure" % TABLE_USERS
 TABLE_PROJECT = "%sprojects" % TABLE_PREFIX
 TABLE_PROJECT_AGENTS = "%s_agents" % TABLE_PROJECT
 
 TABLES = (TABLE_SOFTWARE, TABLE_TAG, TABLE_AGENT_SOFTWARE_ASSOC,
           TABLE_AGENT, TABLE_JOB_TYPE, TABLE_AGENT_TAG_ASSOC,
           TABLE_USERS_USER, TABLE_USERS_ROLE, TABLE_USERS_USER_ROLES,
+          TABLE_USERS_ROLE_CLOSURE,
           TABLE_TASK, TABLE_TASK_DEPENDENCIES, TABLE_JOB_DEPENDENCIES,
           TABLE_JOB_TAG_ASSOC, TABLE_JOB_SOFTWARE_DEP, TABLE_JOB, TABLE_PROJECT,
           TABLE_PROJECT_AGENTS, TABLE_USERS_PROJECTS)
@@ -28,13 +28,20 @@ from uuid import UUID
 from datetime import datetime
 from textwrap import dedent
 
+from sqlalchemy.exc import IntegrityError
+
 from pyfarm.core.enums import STRING_TYPES
 from pyfarm.core.config import read_env_int
 from pyfarm.master.application import db
+from pyfarm.models.core.cache import LRUCache
 from pyfarm.models.core.types import (
     id_column, IDTypeWork, IPAddress, WorkStateEnum)
 
 DEFAULT_PRIORITY = read_env_int("PYFARM_QUEUE_DEFAULT_PRIORITY", 0)
+BULK_CHUNK_SIZE = read_env_int("PYFARM_DB_BULK_CHUNK_SIZE", 500)
+EXPANDED_ROLES = LRUCache(
+    read_env_int("PYFARM_EXPANDED_ROLES_CACHE_SIZE", 512))
+EPOCH = datetime(1970, 1, 1)
 
 
 def modelfor(model, table):
@@ -122,7 +129,7 @@ def work_columns(state_default, priority_default):
                   :class:`.WorkState`""")),
 
         # priority
-        db.Column(db.Integer,
+        db.Column(db.Integer, nullable=False,
                   default=DEFAULT_PRIORITY,
                   doc=dedent("""
                   The priority of the job relative to others in the
@@ -131,7 +138,7 @@ def work_columns(state_default, priority_default):
                   **configured by**: `%s`""" % priority_default)),
 
         # time_submitted
-        db.Column(db.DateTime,
+        db.Column(db.DateTime, nullable=False,
                   default=datetime.now,
                   doc=dedent("""
                   The time the job was submitted.  By default this
@@ -179,6 +186,169 @@ def split_and_extend(items):
     return output
 
 
+def chunked(items, size=None):
+    """
+    Splits ``items`` into lists of at most ``size`` elements, by default
+    :const:`BULK_CHUNK_SIZE`.  This is used to keep ``IN`` clauses and
+    bulk statements within the limits of the database.
+
+    **Example**
+        >>> list(chunked([1, 2, 3, 4, 5], 2))
+        [[1, 2], [3, 4], [5]]
+    """
+    size = size or BULK_CHUNK_SIZE
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def get_or_create_ids(model, columns, keys, cache=None):
+    """
+    Bulk get-or-create for small lookup tables such as :class:`.Tag`
+    and :class:`.Software`.  Existing rows are fetched with one ``IN``
+    query per chunk and the missing rows are inserted with a single
+    statement.  If that insert collides with a row another transaction
+    just created, each row is inserted on its own and rows which already
+    exist are skipped.  The unique constraint on ``columns`` keeps this
+    safe.
+
+    :param model:
+        the model to resolve ids for
+
+    :param tuple columns:
+        names of the columns which uniquely identify a row
+
+    :param keys:
+        values to resolve, tuples if there is more than one column
+
+    :param cache:
+        optional :class:`.LRUCache` of ids to consult and update
+
+    :return:
+        dictionary mapping each key to the id of its row
+    """
+    def key_for(row):
+        return row[0] if len(columns) == 1 else tuple(row[:len(columns)])
+
+    ids = {}
+    missing = set()
+    for key in set(keys):
+        cached = None if cache is None else cache.get(key)
+        if cached is None:
+            missing.add(key)
+        else:
+            ids[key] = cached
+
+    def fetch():
+        first = getattr(model, columns[0])
+        query_columns = [getattr(model, name) for name in columns]
+        query_columns.append(model.id)
+        values = set(key if len(columns) == 1 else key[0] for key in missing)
+
+        for chunk in chunked(values):
+            for row in db.session.query(*query_columns).filter(
+                    first.in_(chunk)):
+                key = key_for(row)
+                if key in missing:
+                    missing.discard(key)
+                    ids[key] = row[-1]
+
+    if missing:
+        fetch()
+
+    if missing:
+        rows = [
+            dict(zip(columns, (key, ) if len(columns) == 1 else key))
+            for key in missing]
+        insert = model.__table__.insert()
+
+        try:
+            with db.session.begin_nested():
+                db.session.execute(insert, rows)
+        except IntegrityError:
+            for row in rows:
+                try:
+                    with db.session.begin_nested():
+                        db.session.execute(insert, row)
+                except IntegrityError:
+                    pass
+
+        fetch()
+
+    if cache is not None:
+        for key, value in ids.items():
+            cache.put(key, value)
+
+    return ids
+
+
+def insert_associations(table, owner_column, owner_id, target_column,
+                        target_ids):
+    """
+    Inserts rows into the association ``table`` linking ``owner_id`` to
+    each of ``target_ids`` with one ``executemany``.  Associations which
+    already exist are skipped.  Returns the number of rows inserted.
+    """
+    owner = table.c[owner_column]
+    target = table.c[target_column]
+    target_ids = set(target_ids)
+
+    for chunk in chunked(list(target_ids)):
+        existing = db.session.execute(
+            db.select([target]).where(
+                (owner == owner_id) & target.in_(chunk)))
+        target_ids.difference_update(row[0] for row in existing)
+
+    if target_ids:
+        db.session.execute(table.insert(), [
+            {owner_column: owner_id, target_column: target_id}
+            for target_id in target_ids])
+
+    return len(target_ids)
+
+
+def expand_roles(items):
+    """
+    Memoized version of :func:`split_and_extend` which returns a
+    :class:`frozenset`.  The same arguments are passed to
+    :meth:`.User.has_roles` over and over again so each distinct set of
+    role names is only expanded once and the resulting set is shared.
+
+    **Example**
+        >>> sorted(expand_roles(["root.admin", "admin"]))
+        ['admin', 'root', 'root.admin']
+    """
+    if not items:
+        return items
+
+    if isinstance(items, STRING_TYPES):
+        items = [items]
+
+    key = frozenset(items)
+    expanded = EXPANDED_ROLES.get(key)
+    if expanded is None:
+        expanded = EXPANDED_ROLES.put(key, frozenset(split_and_extend(key)))
+
+    return expanded
+
+
+def epoch_hours(value):
+    """
+    Returns the number of hours between :const:`EPOCH` and the provided
+    :class:`datetime.datetime` object.
+
+    >>> epoch_hours(datetime(1970, 1, 2, 12))
+    36.0
+    """
+    return (value - EPOCH).total_seconds() / 3600.0
+
+
 def repr_ip(value):
     """properly formats an :class:`.IPAddress` object"""
     if isinstance(value, IPAddress):
@@ -21,9 +21,13 @@ Mixin Classes
 Module containing mixins which can be used by multiple models.
 """
 
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
 from datetime import datetime
 
 from sqlalchemy.orm import validates
+from sqlalchemy.sql.expression import and_, or_, select
 
 from pyfarm.core.enums import DBWorkState, _WorkState, Values
 from pyfarm.core.logger import getLogger
@@ -173,3 +177,230 @@ class ReprMixin(object):
 
         return "%s(%s)" % (self.__class__.__name__, ", ".join(column_data))
 
+
+class StreamingMixin(object):
+    """
+    Mixin which iterates over large results in chunks while keeping
+    memory use flat.  Rows are fetched :attr:`STREAM_CHUNK_SIZE` at a time
+    using a server side cursor where the driver supports one.
+
+    :cvar int STREAM_CHUNK_SIZE:
+        the default number of rows fetched at once
+    """
+    STREAM_CHUNK_SIZE = read_env_int("PYFARM_STREAM_CHUNK_SIZE", 1000)
+
+    @classmethod
+    def stream(cls, query=None, chunk_size=None):
+        """
+        Yields the objects produced by ``query``, :attr:`query` by default,
+        without keeping them all in the session.  Objects are expunged
+        from the session once the rest of their chunk has been consumed
+        so callers should not hold onto them or rely on lazy loading
+        afterwards.  Objects which have pending changes are left in the
+        session.  Eager loading is disabled because it does not work
+        with chunked fetching.
+        """
+        chunk_size = chunk_size or cls.STREAM_CHUNK_SIZE
+        if query is None:
+            query = cls.query
+
+        session = query.session
+        query = query.enable_eagerloads(False).yield_per(
+            chunk_size).execution_options(stream_results=True)
+
+        processed = []
+        try:
+            for instance in query:
+                yield instance
+                processed.append(instance)
+
+                if len(processed) >= chunk_size:
+                    cls.expunge_processed(session, processed)
+                    processed = []
+        finally:
+            cls.expunge_processed(session, processed)
+
+    @staticmethod
+    def expunge_processed(session, instances):
+        """removes ``instances`` without pending changes from ``session``"""
+        dirty = session.dirty
+        for instance in instances:
+            if instance in session and instance not in dirty:
+                session.expunge(instance)
+
+    @classmethod
+    def stream_rows(cls, columns=None, whereclause=None, chunk_size=None):
+        """
+        Yields Core rows for ``columns``, every column by default,
+        matching ``whereclause``.  No ORM objects are created so this is
+        the cheapest way to scan a table.  Column types such as json and
+        enums are still converted.
+        """
+        chunk_size = chunk_size or cls.STREAM_CHUNK_SIZE
+        statement = select(columns or list(cls.__table__.c))
+        if whereclause is not None:
+            statement = statement.where(whereclause)
+
+        result = cls.query.session.execute(
+            statement.execution_options(stream_results=True))
+        try:
+            while True:
+                rows = result.fetchmany(chunk_size)
+                if not rows:
+                    break
+
+                for row in rows:
+                    yield row
+        finally:
+            result.close()
+
+
+class KeysetPaginationMixin(object):
+    """
+    Mixin which pages through a table by seeking past the last row of the
+    previous page instead of using ``OFFSET``.  Every page is found with
+    an index range scan so deep pages cost the same as the first page.
+
+    :cvar tuple KEYSET_COLUMNS:
+        names of the columns the pages are ordered by.  The last column
+        must be unique, and none of the columns may be nullable, so the
+        order is stable and matches an index.  There should be an index
+        covering these columns in this order.
+
+    :cvar int KEYSET_PAGE_SIZE:
+        the default number of rows per page
+    """
+    KEYSET_COLUMNS = NotImplemented
+    KEYSET_PAGE_SIZE = read_env_int("PYFARM_KEYSET_PAGE_SIZE", 100)
+    DATETIME_FORMATS = ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S")
+
+    @classmethod
+    def encode_keyset_token(cls, values, reverse=False):
+        """
+        Returns an opaque token which resumes pagination after a row
+        with the given ``values`` for :attr:`KEYSET_COLUMNS`
+        """
+        encoded = []
+        for value in values:
+            if isinstance(value, datetime):
+                value = {"datetime": value.isoformat()}
+            encoded.append(value)
+
+        data = json.dumps([encoded, reverse], separators=(",", ":"))
+        return urlsafe_b64encode(data.encode("utf-8")).decode("ascii")
+
+    @classmethod
+    def decode_keyset_token(cls, token):
+        """
+        Returns the values and direction stored in a token produced by
+        :meth:`encode_keyset_token`.  :class:`ValueError` is raised if the
+        token is not valid for this model.
+        """
+        try:
+            if not isinstance(token, bytes):
+                token = token.encode("ascii")
+            values, reverse = json.loads(
+                urlsafe_b64decode(token).decode("utf-8"))
+        except (BinasciiError, TypeError, UnicodeError, ValueError):
+            raise ValueError("invalid pagination token")
+
+        if not isinstance(values, list) or \
+                len(values) != len(cls.KEYSET_COLUMNS):
+            raise ValueError("invalid pagination token")
+
+        decoded = []
+        for value in values:
+            if isinstance(value, dict):
+                for date_format in cls.DATETIME_FORMATS:
+                    try:
+                        value = datetime.strptime(
+                            value.get("datetime", ""), date_format)
+                        break
+                    except ValueError:
+                        continue
+                else:
+                    raise ValueError("invalid pagination token")
+            decoded.append(value)
+
+        return decoded, bool(reverse)
+
+    @classmethod
+    def keyset_after(cls, values, reverse=False):
+        """
+        Returns a SQL expression matching the rows which come after
+        ``values`` in :attr:`KEYSET_COLUMNS` order, or before them when
+        ``reverse`` is True.  The expression starts with a range on the
+        first column so the database can seek into the index.
+        """
+        columns = cls.keyset_columns()
+        pairs = list(zip(columns, values))
+
+        column, value = pairs[-1]
+        expression = column < value if reverse else column > value
+        for column, value in reversed(pairs[:-1]):
+            expression = or_(
+                column < value if reverse else column > value,
+                and_(column == value, expression))
+
+        column, value = pairs[0]
+        if len(pairs) > 1:
+            expression = and_(
+                column <= value if reverse else column >= value, expression)
+
+        return expression
+
+    @classmethod
+    def keyset_columns(cls):
+        """
+        Returns the mapped :attr:`KEYSET_COLUMNS`.  :class:`ValueError`
+        is raised if any of them is nullable since nulls can't be
+        compared and would stop the pages from matching the index.
+        """
+        columns = [getattr(cls, name) for name in cls.KEYSET_COLUMNS]
+        for column in columns:
+            if any(mapped.nullable for mapped in column.property.columns):
+                raise ValueError(
+                    "keyset column %s must not be nullable" % column)
+        return columns
+
+    @classmethod
+    def keyset_page(cls, token=None, limit=None, query=None, reverse=False):
+        """
+        Returns a page of rows along with a token for the next page, or
+        None if this is the last page.
+
+        :param str token:
+            the token returned with the previous page, the first page is
+            returned when not provided
+
+        :param int limit:
+            the number of rows per page, by default
+            :attr:`KEYSET_PAGE_SIZE`
+
+        :param query:
+            optional query to page through instead of :attr:`query`.  It
+            must not already be ordered.
+
+        :param bool reverse:
+            if True return the rows in descending order.  This is ignored
+            when ``token`` is provided since the token stores the direction.
+        """
+        limit = limit or cls.KEYSET_PAGE_SIZE
+        if query is None:
+            query = cls.query
+
+        if token is not None:
+            values, reverse = cls.decode_keyset_token(token)
+            query = query.filter(cls.keyset_after(values, reverse=reverse))
+
+        query = query.order_by(*[
+            column.desc() if reverse else column
+            for column in cls.keyset_columns()])
+        rows = query.limit(limit + 1).all()
+
+        if len(rows) <= limit:
+            return rows, None
+
+        rows = rows[:limit]
+        last = [getattr(rows[-1], name) for name in cls.KEYSET_COLUMNS]
+        return rows, cls.encode_keyset_token(last, reverse=reverse)
@@ -0,0 +1,179 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2013 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Frame State Maps
+================
+
+Compact per-frame state storage for jobs.  Rather than loading every
+|Task| for a job a :class:`FrameStateMap` stores a single byte per frame
+which is enough to answer progress and 'which frames failed' questions
+for very large jobs.
+
+.. include:: ../include/references.rst
+"""
+
+from array import array
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+from pyfarm.core.config import read_env_int
+from pyfarm.core.enums import WorkState
+from pyfarm.models.core.cache import LRUCache
+
+# Code 0 is reserved for frames which no task covers, every other
+# state is stored as its position in WorkState.
+NO_STATE = 0
+STATE_CODES = dict(
+    (state.int, code) for code, state in enumerate(WorkState, 1))
+CODE_STATES = dict(
+    (code, state) for code, state in enumerate(WorkState, 1))
+assert len(STATE_CODES) < 256, "WorkState does not fit into a single byte"
+
+#: Cache of :class:`FrameStateMap` objects keyed by job id
+state_maps = LRUCache(read_env_int("PYFARM_FRAME_STATE_CACHE_SIZE", 256))
+
+
+def state_code(state):
+    """returns the single byte code for the given work ``state``"""
+    return STATE_CODES[getattr(state, "int", state)]
+
+
+class FrameStateMap(object):
+    """
+    Stores the state of each frame in a job using one byte per frame.
+
+    :param float start:
+        the first frame of the job
+
+    :param float end:
+        the last frame of the job, the map contains no frames if this is
+        before ``start``
+
+    :param float by:
+        the number of frames between each frame of the job
+    """
+    def __init__(self, start, end, by=1):
+        self.start = start
+        self.by = float(by or 1)
+        self.codes = array(
+            "B", [NO_STATE]) * max(int(round((end - start) / self.by)) + 1, 0)
+
+    @classmethod
+    def from_rows(cls, start, end, by, rows):
+        """
+        Produces a new map for a job from an iterable of
+        ``(frame, frame_end, frame_by, state)`` rows, typically the
+        result of a column only |Task| query.
+        """
+        statemap = cls(start, end, by)
+        for frame, frame_end, frame_by, state in rows:
+            statemap.set(frame, state, frame_end=frame_end, frame_by=frame_by)
+        return statemap
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def nbytes(self):
+        """number of bytes used to store the frame states"""
+        return len(self.codes) * self.codes.itemsize
+
+    def index(self, frame):
+        """returns the index of ``frame`` in the map or None"""
+        index = int(round((frame - self.start) / self.by))
+        if 0 <= index < len(self.codes):
+            return index
+
+    def frame(self, index):
+        """returns the frame for the given ``index``"""
+        return self.start + index * self.by
+
+    def get(self, frame):
+        """returns the state of ``frame`` or None if it has no state"""
+        index = self.index(frame)
+        if index is not None:
+            return CODE_STATES.get(self.codes[index])
+
+    def set(self, frame, state, frame_end=None, frame_by=None):
+        """
+        Sets the state of ``frame``, or every frame from ``frame`` to
+        ``frame_end`` counting by ``frame_by``, to ``state``.  Frames
+        outside of the map are ignored.
+        """
+        if frame_end is None:
+            frame_end = frame
+
+        code = state_code(state)
+        step = max(int(round(float(frame_by or self.by) / self.by)), 1)
+        first = int(round((frame - self.start) / self.by))
+        last = int(round((frame_end - self.start) / self.by))
+
+        # clip the range to the frames contained in the map while
+        # keeping the first frame aligned with ``step``
+        if first < 0:
+            first += -(first // step) * step
+        last = min(last, len(self.codes) - 1)
+
+        if first <= last:
+            count = (last - first) // step + 1
+            self.codes[first:last + 1:step] = array("B", [code]) * count
+
+    def counts(self):
+        """returns a dictionary of ``{state: frames}``"""
+        if numpy is not None:
+            found = numpy.bincount(
+                numpy.frombuffer(self.codes, dtype=numpy.uint8),
+                minlength=len(CODE_STATES) + 1)
+            counts = enumerate(found.tolist())
+        else:
+            counts = ((code, self.codes.count(code)) for code in CODE_STATES)
+
+        return dict(
+            (CODE_STATES[code], count) for code, count in counts
+            if count and code != NO_STATE)
+
+    def ranges(self, state):
+        """
+        Returns a list of ``(first, last)`` frames for each contiguous
+        run of frames in ``state``.
+        """
+        code = state_code(state)
+
+        if numpy is not None:
+            matches = numpy.frombuffer(self.codes, dtype=numpy.uint8) == code
+            edges = numpy.diff(
+                numpy.concatenate(([0], matches.view(numpy.int8), [0])))
+            starts = numpy.flatnonzero(edges == 1).tolist()
+            ends = (numpy.flatnonzero(edges == -1) - 1).tolist()
+        else:
+            starts, ends = [], []
+            previous = NO_STATE
+            for index, current in enumerate(self.codes):
+                if current == code and previous != code:
+                    starts.append(index)
+                elif current != code and previous == code:
+                    ends.append(index - 1)
+                previous = current
+
+            if previous == code:
+                ends.append(len(self.codes) - 1)
+
+        return [(self.frame(first), self.frame(last))
+                for first, last in zip(starts, ends)]
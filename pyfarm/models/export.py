@@ -0,0 +1,214 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2013 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Export
+======
+
+Functions which stream the history of finished jobs and tasks into
+newline delimited json or csv files for reporting.  Rows are read from
+a Core select in chunks and written as they arrive so memory use does
+not depend on the number of rows exported.
+"""
+
+import csv
+import gzip
+import json
+from datetime import datetime
+
+from sqlalchemy.sql.expression import type_coerce
+
+from pyfarm.core.enums import STRING_TYPES, PY3, WorkState
+from pyfarm.master.application import db
+from pyfarm.models.core.types import EnumType
+from pyfarm.models.job import Job
+from pyfarm.models.task import Task
+
+NDJSON = "ndjson"
+CSV = "csv"
+FORMATS = (NDJSON, CSV)
+
+#: States which are considered finished and will be exported
+FINISHED_STATES = (WorkState.DONE, WorkState.FAILED)
+
+
+class EncodedWriter(object):
+    """
+    Wraps a binary file object so text can be written to it on both
+    Python 2 and 3, encoding it as utf-8
+    """
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        if not isinstance(text, bytes):
+            text = text.encode("utf-8")
+        self.stream.write(text)
+
+
+def serialize(value, nested=True):
+    """
+    Converts a single column value into something json or csv can
+    represent.  Lists and dictionaries are encoded as json strings unless
+    ``nested`` is True.
+    """
+    if isinstance(value, datetime):
+        return value.isoformat()
+    elif isinstance(value, (dict, list)) and not nested:
+        return json.dumps(value, separators=(",", ":"), sort_keys=True)
+    return value
+
+
+def csv_cell(value):
+    """
+    Converts a single column value into a csv cell.  Text is encoded as
+    utf-8 on Python 2 because :mod:`csv` can not write non-ascii unicode
+    there.
+    """
+    value = serialize(value, nested=False)
+    if not PY3 and isinstance(value, STRING_TYPES) and \
+            not isinstance(value, bytes):
+        value = value.encode("utf-8")
+    return value
+
+
+def export_columns(table):
+    """
+    Returns the columns of ``table`` to select along with a function for
+    each which converts its value.  Enum columns are selected as plain
+    integers and translated with a dictionary which is much faster than
+    letting the column type look up every value.
+    """
+    columns = []
+    converters = []
+    for column in table.c:
+        if isinstance(column.type, EnumType):
+            names = dict((value.int, value.str) for value in column.type.enum)
+            columns.append(type_coerce(column, db.Integer).label(column.name))
+            converters.append(names.get)
+        else:
+            columns.append(column)
+            converters.append(None)
+
+    return columns, converters
+
+
+def export(model, whereclause, output, format=NDJSON, compress=False,
+           chunk_size=None):
+    """
+    Writes every row of ``model`` matching ``whereclause`` to ``output``
+    and returns the number of rows written.
+
+    :param model:
+        the model to export, which must provide
+        :meth:`.StreamingMixin.stream_rows`
+
+    :param output:
+        a path or a file object opened in binary mode
+
+    :param str format:
+        either :const:`NDJSON` or :const:`CSV`
+
+    :param bool compress:
+        if True compress the output with gzip
+
+    :param int chunk_size:
+        the number of rows to fetch from the database at once
+    """
+    if format not in FORMATS:
+        raise ValueError("`format` must be one of %s" % (FORMATS, ))
+
+    columns, converters = export_columns(model.__table__)
+    names = [column.name for column in model.__table__.c]
+    rows = model.stream_rows(columns, whereclause, chunk_size=chunk_size)
+
+    close = isinstance(output, STRING_TYPES)
+    handle = open(output, "wb") if close else output
+    stream = gzip.GzipFile(fileobj=handle, mode="wb") if compress else handle
+
+    writer = EncodedWriter(stream)
+    if format == CSV:
+        csv_writer = csv.writer(writer, lineterminator="\n")
+        csv_writer.writerow(names)
+
+    count = 0
+    try:
+        for row in rows:
+            values = [
+                value if convert is None else convert(value)
+                for value, convert in zip(row, converters)]
+
+            if format == NDJSON:
+                writer.write(json.dumps(
+                    dict(zip(names, map(serialize, values))),
+                    separators=(",", ":"), sort_keys=True))
+                writer.write("\n")
+            else:
+                csv_writer.writerow([csv_cell(value) for value in values])
+
+            count += 1
+    finally:
+        if compress:
+            stream.close()
+        if close:
+            handle.close()
+
+    return count
+
+
+def finished_filter(model, start=None, end=None, projects=None):
+    """
+    Returns the where clause for the finished rows of ``model`` whose
+    :attr:`time_finished` is within ``[start, end)`` and belong to one of
+    ``projects``.
+    """
+    clauses = [model.state.in_(FINISHED_STATES)]
+    if start is not None:
+        clauses.append(model.time_finished >= start)
+    if end is not None:
+        clauses.append(model.time_finished < end)
+    if projects is not None:
+        clauses.append(model.project_id.in_(list(projects)))
+
+    return db.and_(*clauses)
+
+
+def export_jobs(output, start=None, end=None, projects=None, **kwargs):
+    """
+    Exports jobs which finished between ``start`` and ``end`` and belong
+    to one of the ``projects`` ids.  Any of the filters may be omitted.
+    The remaining keywords are passed to :func:`export`.
+    """
+    return export(
+        Job, finished_filter(Job, start=start, end=end, projects=projects),
+        output, **kwargs)
+
+
+def export_tasks(output, start=None, end=None, projects=None, **kwargs):
+    """
+    Exports tasks which finished between ``start`` and ``end``.  When
+    ``projects`` is given a task belongs to its own project or, if it does
+    not have one, to the project of its job.  The remaining keywords are
+    passed to :func:`export`.
+    """
+    whereclause = finished_filter(Task, start=start, end=end)
+    if projects is not None:
+        project_id = db.select([Job.project_id]).where(
+            Job.id == Task.job_id).as_scalar()
+        whereclause = db.and_(whereclause, db.func.coalesce(
+            Task.project_id, project_id).in_(list(projects)))
+
+    return export(Task, whereclause, output, **kwargs)
@@ -29,24 +29,36 @@ except ImportError:  # pragma: no cover
     pwd = None
 
 import json
+from datetime import datetime, timedelta
 from textwrap import dedent
 
 from sqlalchemy import event
-from sqlalchemy.orm import validates
+from sqlalchemy.orm import (
+    validates, object_session, deferred, undefer_group, subqueryload,
+    joinedload, aliased, Session)
 from sqlalchemy.schema import UniqueConstraint
+from sqlalchemy.sql.expression import case
 
-from pyfarm.core.config import read_env, read_env_int
+from pyfarm.core.config import read_env, read_env_int, read_env_number
 from pyfarm.core.enums import WorkState, DBWorkState
 from pyfarm.master.application import db
-from pyfarm.models.core.functions import work_columns
+from pyfarm.models.core.functions import (
+    work_columns, epoch_hours, insert_associations, chunked, DEFAULT_PRIORITY,
+    BULK_CHUNK_SIZE)
 from pyfarm.models.core.types import id_column, JSONDict, JSONList, IDTypeWork
+from pyfarm.models.core.statemap import FrameStateMap, state_maps
 from pyfarm.models.core.cfg import (
     TABLE_JOB, TABLE_JOB_SOFTWARE_DEP, TABLE_JOB_TYPE, TABLE_TAG,
     TABLE_JOB_TAG_ASSOC, MAX_COMMAND_LENGTH, MAX_TAG_LENGTH, MAX_USERNAME_LENGTH,
     TABLE_SOFTWARE, TABLE_JOB_DEPENDENCIES, TABLE_PROJECT)
 from pyfarm.models.core.mixins import (
-    ValidatePriorityMixin, WorkStateChangedMixin, ReprMixin)
+    ValidatePriorityMixin, WorkStateChangedMixin, ReprMixin,
+    KeysetPaginationMixin, StreamingMixin)
 from pyfarm.models.jobtype import JobType  # required for a relationship
+from pyfarm.models.task import Task, TaskBatch, TaskDependencies
+from pyfarm.models.project import project_usage
+from pyfarm.models.software import Software
+from pyfarm.models.tag import Tag
 
 
 JobSoftwareDependency = db.Table(
@@ -65,6 +77,12 @@ JobTagAssociation = db.Table(
               db.ForeignKey("%s.id" % TABLE_TAG), primary_key=True))
 
 
+#: Callables which are given a list of the ids of jobs whose parents have
+#: all finished once the transaction finishing the last parent commits,
+#: see :attr:`Job.waiting_parents`.  Ready jobs are not looked up unless
+#: at least one callback is registered.
+ready_job_callbacks = []
+
 JobDependencies = db.Table(
     TABLE_JOB_DEPENDENCIES, db.metadata,
     db.Column("parentid", IDTypeWork,
@@ -72,14 +90,26 @@ JobDependencies = db.Table(
     db.Column("childid", IDTypeWork,
               db.ForeignKey("%s.id" % TABLE_JOB), primary_key=True))
 
+# Based on the joins of Job.parents ``parentid`` holds the job which waits
+# and ``childid`` holds the job it waits on.
+WAITING_JOB = JobDependencies.c.parentid
+WAITED_ON_JOB = JobDependencies.c.childid
+
 
-class Job(db.Model, ValidatePriorityMixin, WorkStateChangedMixin, ReprMixin):
+class Job(db.Model, ValidatePriorityMixin, WorkStateChangedMixin, ReprMixin,
+          KeysetPaginationMixin, StreamingMixin):
     """
     Defines the attributes and environment for a job.  Individual commands
     are kept track of by |Task|
     """
     __tablename__ = TABLE_JOB
+    __table_args__ = (
+        db.Index("%s_queue_aging_idx" % TABLE_JOB, "state", "aging_key"),
+        db.Index("%s_keyset_idx" % TABLE_JOB,
+                 "priority", "time_submitted", "id"),
+        db.Index("%s_archive_idx" % TABLE_JOB, "state", "time_finished"))
     REPR_COLUMNS = ("id", "state", "project")
+    KEYSET_COLUMNS = ("priority", "time_submitted", "id")
     REPR_CONVERT_COLUMN = {
         "state": repr}
     MIN_CPUS = read_env_int("PYFARM_QUEUE_MIN_CPUS", 1)
@@ -88,6 +118,8 @@ class Job(db.Model, ValidatePriorityMixin, WorkStateChangedMixin, ReprMixin):
     MAX_RAM = read_env_int("PYFARM_QUEUE_MAX_RAM", 262144)
     SPECIAL_RAM = read_env("PYFARM_AGENT_SPECIAL_RAM", [0], eval_literal=True)
     SPECIAL_CPUS = read_env("PYFARM_AGENT_SPECIAL_CPUS", [0], eval_literal=True)
+    AGING_RATE = read_env_number("PYFARM_QUEUE_PRIORITY_AGING_RATE", 1.0)
+    AGING_CAP = read_env_number("PYFARM_QUEUE_PRIORITY_AGING_CAP", 100)
 
     # quick check of the configured data
     assert MIN_CPUS >= 1, "$PYFARM_QUEUE_MIN_CPUS must be > 0"
@@ -96,7 +128,13 @@ class Job(db.Model, ValidatePriorityMixin, WorkStateChangedMixin, ReprMixin):
     assert MIN_RAM >= 1, "$PYFARM_QUEUE_MIN_RAM must be > 0"
     assert MAX_RAM >= 1, "$PYFARM_QUEUE_MAX_RAM must be > 0"
     assert MAX_RAM >= MIN_RAM, "MIN_RAM must be <= MAX_RAM"
+    assert AGING_RATE >= 0, "$PYFARM_QUEUE_PRIORITY_AGING_RATE must be >= 0"
+    assert AGING_CAP >= 0, "$PYFARM_QUEUE_PRIORITY_AGING_CAP must be >= 0"
 
+    #: Query options which load the deferred ``details`` columns
+    #: (:attr:`notes`, :attr:`environ`, :attr:`args` and :attr:`data`) along
+    #: with the job instead of on first access
+    WITH_DETAILS = (undefer_group("details"), )
 
     # shared work columns
     id, state, priority, time_submitted, time_started, time_finished = \
@@ -120,12 +158,14 @@ class Job(db.Model, ValidatePriorityMixin, WorkStateChangedMixin, ReprMixin):
                      .. warning::
                         this may not behave as expected on all platforms
                         (windows in particular)"""))
-    notes = db.Column(db.Text, default="",
-                      doc=dedent("""
-                      Notes that are provided on submission or added after
-                      the fact. This column is only provided for human
-                      consumption is not scanned, index, or used when
-                      searching"""))
+    notes = deferred(
+        db.Column(db.Text, default="",
+                  doc=dedent("""
+                  Notes that are provided on submission or added after
+                  the fact. This column is only provided for human
+                  consumption is not scanned, index, or used when
+                  searching""")),
+        group="details")
 
     # task data
     cmd = db.Column(db.String(MAX_COMMAND_LENGTH),
@@ -242,28 +282,53 @@ class Job(db.Model, ValidatePriorityMixin, WorkStateChangedMixin, ReprMixin):
                        ui.  This is typically set to True if you either want
                        to save a job for later viewing or if the jobs data
                        is being populated in a deferred manner."""))
-    environ = db.Column(JSONDict,
-                        doc=dedent("""
-                        Dictionary containing information about the environment
-                        in which the job will execute.
+    environ = deferred(
+        db.Column(JSONDict,
+                  doc=dedent("""
+                  Dictionary containing information about the environment
+                  in which the job will execute.
 
-                        .. note::
-                            Changes made directly to this object are **not**
-                            applied to the session."""))
-    args = db.Column(JSONList,
-                     doc=dedent("""
-                     List containing the command line arguments.
+                  .. note::
+                      Changes made directly to this object are **not**
+                      applied to the session.""")),
+        group="details")
+    args = deferred(
+        db.Column(JSONList,
+                  doc=dedent("""
+                  List containing the command line arguments.
 
-                     .. note::
-                        Changes made directly to this object are **not**
-                        applied to the session."""))
-    data = db.Column(JSONDict,
-                     doc=dedent("""
-                     Json blob containing additional data for a job
+                  .. note::
+                     Changes made directly to this object are **not**
+                     applied to the session.""")),
+        group="details")
+    data = deferred(
+        db.Column(JSONDict,
+                  doc=dedent("""
+                  Json blob containing additional data for a job
 
-                     .. note::
-                        Changes made directly to this object are **not**
-                        applied to the session."""))
+                  .. note::
+                     Changes made directly to this object are **not**
+                     applied to the session.""")),
+        group="details")
+    waiting_parents = db.Column(db.Integer, default=0, nullable=False,
+                                doc=dedent("""
+                                The number of :attr:`parents` which have not
+                                finished yet.  This is maintained as parents
+                                are added, removed and finished.  When it
+                                reaches zero the job's id is passed to
+                                :data:`ready_job_callbacks` once the
+                                finishing parent has been committed."""))
+    aging_key = db.Column(db.Float,
+                          doc=dedent("""
+                          Time independent portion of the job's effective
+                          priority, ``priority - AGING_RATE * hours`` where
+                          ``hours`` is :attr:`time_submitted` expressed in
+                          hours since the epoch.  Adding ``AGING_RATE * now``
+                          to this value produces the aged priority so
+                          ordering by this column alone is the same as
+                          ordering by the uncapped effective priority.  This
+                          value is maintained on insert and update and should
+                          not be set directly."""))
 
     project = db.relationship("Project",
                               backref=db.backref("jobs", lazy="dynamic"),
@@ -311,6 +376,26 @@ class Job(db.Model, ValidatePriorityMixin, WorkStateChangedMixin, ReprMixin):
                                lazy="dynamic",
                                doc="software needed by this job")
 
+    # Read only, non-dynamic versions of the relationships above so they
+    # can be eager loaded.  These are not refreshed when the dynamic
+    # relationships are changed until the job is expired or reloaded.
+    tags_list = db.relationship("Tag", secondary=JobTagAssociation,
+                                viewonly=True,
+                                doc="Eager loadable version of :attr:`tags`")
+    software_list = db.relationship("Software",
+                                    secondary=JobSoftwareDependency,
+                                    viewonly=True,
+                                    doc=dedent("""
+                                    Eager loadable version of
+                                    :attr:`software`"""))
+
+    #: Query options for listing jobs along with their project, tags and
+    #: software.  Each collection is loaded for every job in the result
+    #: with one additional query.
+    PROFILE_LIST = (
+        joinedload("project"), subqueryload("tags_list"),
+        subqueryload("software_list"))
+
     @validates("ram", "cpus")
     def validate_resource(self, key, value):
         """
@@ -340,5 +425,611 @@ class Job(db.Model, ValidatePriorityMixin, WorkStateChangedMixin, ReprMixin):
 
         return value
 
+    def add_tags(self, names):
+        """
+        Associates the tags ``names`` with this job.  Tags are resolved
+        and created in bulk by :meth:`.Tag.resolve` and the association
+        rows are written with a single statement.  Returns the number of
+        tags which were newly associated.
+        """
+        if self.id is None:
+            db.session.add(self)
+            db.session.flush()
+
+        return insert_associations(
+            JobTagAssociation, "job_id", self.id, "tag_id",
+            Tag.resolve(names).values())
+
+    def add_software(self, items):
+        """
+        Associates the software ``items`` with this job, see
+        :meth:`.Software.resolve` for the accepted values.  Returns the
+        number of software items which were newly associated.
+        """
+        if self.id is None:
+            db.session.add(self)
+            db.session.flush()
+
+        return insert_associations(
+            JobSoftwareDependency, "job_id", self.id, "software_id",
+            Software.resolve(items).values())
+
+    def create_tasks(self, range_size=1):
+        """
+        Creates the tasks for this job from :attr:`start`, :attr:`end`
+        and :attr:`by` and adds them to the session.  When ``range_size``
+        is larger than one each task is range encoded and covers up to
+        ``range_size`` frames which greatly reduces the number of rows
+        required for jobs with many frames.
+
+        :param int range_size:
+            the maximum number of frames a single task should cover
+        """
+        assert range_size >= 1, "`range_size` must be >= 1"
+        start = self.start
+        end = start if self.end is None else self.end
+        by = self.by or 1
+        count = Task.count_frames(start, end, by)
+
+        tasks = []
+        for first in range(0, count, range_size):
+            last = min(first + range_size, count) - 1
+            task = Task(
+                job=self, frame=start + first * by,
+                priority=self.priority, project_id=self.project_id)
+
+            if last > first:
+                task.frame_end = start + last * by
+                task.frame_by = by
+
+            tasks.append(task)
+
+        db.session.add_all(tasks)
+        return tasks
+
+    def iter_tasks(self, chunk_size=None):
+        """
+        Yields the tasks of this job ordered by frame using
+        :meth:`.Task.stream` so that memory use does not depend on the
+        number of tasks.  Use this instead of :attr:`tasks` when
+        scanning every task of a large job.
+        """
+        return Task.stream(
+            Task.query.filter_by(job_id=self.id).order_by(Task.frame, Task.id),
+            chunk_size=chunk_size)
+
+    def frame_states(self):
+        """
+        Iterates over every frame of this job in order and yields a tuple
+        of ``(frame, state)``.  Only the frame and state columns of each
+        task are loaded and range encoded tasks are expanded as they are
+        iterated over.
+        """
+        query = db.session.query(
+            Task.frame, Task.frame_end, Task.frame_by, Task.state).filter(
+            Task.job_id == self.id).order_by(Task.frame)
+
+        for frame, frame_end, frame_by, state in query:
+            frame_by = frame_by or 1
+            for index in range(Task.count_frames(frame, frame_end, frame_by)):
+                yield frame + index * frame_by, state
+
+    def frame_state(self, frame):
+        """
+        Returns the state of a single ``frame`` in this job or None if
+        the job does not contain ``frame``.
+        """
+        query = db.session.query(
+            Task.frame, Task.frame_by, Task.state).filter(
+            Task.job_id == self.id, Task.frame <= frame,
+            db.func.coalesce(Task.frame_end, Task.frame) >= frame)
+
+        for start, frame_by, state in query:
+            offset = (frame - start) / float(frame_by or 1)
+            if abs(offset - round(offset)) < 1e-6:
+                return state
+
+    def frame_counts(self):
+        """
+        Returns a dictionary of ``{state: frames}`` for this job.  The
+        number of frames in range encoded tasks is summed by the database
+        so no tasks are loaded.
+        """
+        frames = db.func.round(
+            (db.func.coalesce(Task.frame_end, Task.frame) - Task.frame) /
+            db.func.coalesce(Task.frame_by, 1)) + 1
+        query = db.session.query(Task.state, db.func.sum(frames)).filter(
+            Task.job_id == self.id).group_by(Task.state)
+        return dict((state, int(count)) for state, count in query)
+
+    def state_map(self, cache=True):
+        """
+        Returns a :class:`.FrameStateMap` containing the state of every
+        frame in this job.  The map is built from a single column only
+        query and, when ``cache`` is True, stored in memory so later
+        calls can skip the query.  Cached maps are kept up to date as
+        :attr:`.Task.state` changes on objects in the session.
+
+        If the job has no :attr:`start` the map covers the frames of its
+        tasks instead, and is empty if there are no tasks.
+
+        .. note::
+            Changes which are rolled back or which are made outside of
+            the ORM are not applied to cached maps, use ``cache=False``
+            when an exact answer is required.
+        """
+        statemap = state_maps.get(self.id) if cache else None
+
+        if statemap is None:
+            query = db.session.query(
+                Task.frame, Task.frame_end, Task.frame_by, Task.state).filter(
+                Task.job_id == self.id)
+            start, end = self.start, self.end
+            if start is None:
+                start, end = db.session.query(
+                    db.func.min(Task.frame),
+                    db.func.max(db.func.coalesce(
+                        Task.frame_end, Task.frame))).filter(
+                    Task.job_id == self.id).one()
+                if start is None:
+                    start, end = 0, -float(self.by or 1)
+            elif end is None:
+                end = start
+            statemap = FrameStateMap.from_rows(start, end, self.by, query)
+
+            if cache:
+                state_maps.put(self.id, statemap)
+
+        return statemap
+
+    def task_batches(self, batch=None):
+        """
+        Iterates over the queued tasks for this job in :attr:`Task.frame`
+        order and yields :class:`.TaskBatch` objects containing contiguous
+        runs of at most ``batch`` frames.  Two frames are contiguous when
+        they are :attr:`by` apart.  Only the id and frame columns are
+        loaded so this is cheap even for large jobs.  Tasks which are still
+        backing off from a previous failure, see :attr:`.Task.next_eligible`,
+        are skipped.  A range encoded task
+        may be spread over several batches, :meth:`.Task.claim_batch` will
+        split the task when the batch is claimed.
+
+        :param int batch:
+            the maximum number of frames per batch, defaults to
+            :attr:`batch`
+        """
+        batch = batch or self.batch or 1
+        step = self.by or 1
+        query = db.session.query(
+            Task.id, Task.frame, Task.frame_end, Task.frame_by).filter(
+            Task.job_id == self.id, Task.eligible()).order_by(Task.frame)
+
+        task_ids = []
+        size = 0
+        start = end = None
+        for task_id, frame, frame_end, frame_by in query:
+            frame_by = frame_by or step
+            remaining = Task.count_frames(frame, frame_end, frame_by)
+
+            while remaining:
+                if task_ids and (
+                        size >= batch or abs(frame - end - step) > 1e-6):
+                    yield TaskBatch(self.id, start, end, tuple(task_ids))
+                    task_ids = []
+                    size = 0
+
+                if not task_ids:
+                    start = frame
+
+                count = min(remaining, batch - size)
+                task_ids.append(task_id)
+                size += count
+                remaining -= count
+                end = frame + (count - 1) * frame_by
+                frame = end + frame_by
+
+        if task_ids:
+            yield TaskBatch(self.id, start, end, tuple(task_ids))
+
+    @classmethod
+    def requeue_failed_tasks(cls, job_ids=None):
+        """
+        Moves failed tasks back into the queue for each job which has not
+        used up its :attr:`requeue` budget.  A task is requeued when its
+        :attr:`.Task.attempts` is less than or equal to :attr:`requeue`, a
+        value of 0 never requeues a task and -1 always will.  All tasks of a
+        job are requeued with a single ``UPDATE``, which also sets
+        :attr:`.Task.next_eligible` so retries back off, and jobs which
+        failed are put back into the queue as well.
+
+        .. note::
+            This does not go through the session so tasks and jobs which
+            are already loaded should be expired or reloaded.
+
+        :param list job_ids:
+            the ids of the jobs to requeue tasks for, by default every job
+            with failed tasks will be considered
+
+        :return:
+            returns a tuple of ``(requeued, failed)`` containing the number
+            of tasks which were requeued and the number of tasks which
+            remain failed because they exceeded their job's budget
+        """
+        failed_tasks = db.session.query(
+            Task.job_id, cls.requeue, db.func.count(Task.id)).join(
+            cls, cls.id == Task.job_id).filter(
+            Task.state == WorkState.FAILED).group_by(Task.job_id, cls.requeue)
+
+        if job_ids is not None:
+            failed_tasks = failed_tasks.filter(Task.job_id.in_(job_ids))
+
+        requeued = failed = 0
+        requeued_jobs = []
+        for job_id, requeue, count in failed_tasks.all():
+            requeued_tasks = 0
+
+            if requeue:
+                query = Task.query.filter(
+                    Task.job_id == job_id, Task.state == WorkState.FAILED)
+
+                if requeue > 0:
+                    query = query.filter(
+                        db.func.coalesce(Task.attempts, 0) <= requeue)
+
+                requeued_tasks = query.update({
+                    Task.state: WorkState.QUEUED, Task.agent_id: None,
+                    Task.lease_expires: None, Task.time_started: None,
+                    Task.time_finished: None,
+                    Task.next_eligible: Task.next_eligible_expression()},
+                    synchronize_session=False)
+
+            if requeued_tasks:
+                requeued_jobs.append(job_id)
+                state_maps.pop(job_id)
+
+            requeued += requeued_tasks
+            failed += count - requeued_tasks
+
+        if requeued_jobs:
+            cls.query.filter(
+                cls.id.in_(requeued_jobs),
+                cls.state == WorkState.FAILED).update({
+                    cls.state: WorkState.QUEUED, cls.time_finished: None},
+                    synchronize_session=False)
+
+        return requeued, failed
+
+    @classmethod
+    def dependent_rows(cls, job_ids):
+        """
+        Returns ``(table, whereclause)`` for every row belonging to
+        ``job_ids``, including the jobs themselves, in the order they must
+        be deleted to satisfy the foreign keys.
+        """
+        task_ids = db.select([Task.id]).where(Task.job_id.in_(job_ids))
+        return (
+            (TaskDependencies,
+             TaskDependencies.c.parent_id.in_(task_ids) |
+             TaskDependencies.c.child_id.in_(task_ids)),
+            (Task.__table__, Task.job_id.in_(job_ids)),
+            (JobDependencies,
+             WAITING_JOB.in_(job_ids) | WAITED_ON_JOB.in_(job_ids)),
+            (JobTagAssociation, JobTagAssociation.c.job_id.in_(job_ids)),
+            (JobSoftwareDependency,
+             JobSoftwareDependency.c.job_id.in_(job_ids)),
+            (cls.__table__, cls.id.in_(job_ids)))
+
+    @classmethod
+    def release_children(cls, job_ids, exclude=()):
+        """
+        Stops the children of ``job_ids`` from waiting on those jobs
+        before they are removed, ignoring children in ``exclude``.  This
+        is the set based version of :meth:`parentRemovedEvent`.  Children
+        which no longer wait on any parent are passed to
+        :data:`ready_job_callbacks` once the session commits.
+        """
+        table = cls.__table__
+        parent = aliased(cls)
+        waiting_on = db.select([db.func.count()]).where(
+            (WAITING_JOB == table.c.id) &
+            WAITED_ON_JOB.in_(job_ids) &
+            (parent.id == WAITED_ON_JOB) &
+            (parent.state != WorkState.DONE)).as_scalar()
+        children = db.select([WAITING_JOB]).where(
+            WAITED_ON_JOB.in_(job_ids))
+        if exclude:
+            children = children.where(~WAITING_JOB.in_(list(exclude)))
+
+        db.session.execute(
+            table.update().where(table.c.id.in_(children)).values(
+                waiting_parents=table.c.waiting_parents - waiting_on))
+        expire_waiting_parents(db.session)
+
+        if ready_job_callbacks:
+            ready = db.session.execute(db.select([table.c.id]).where(
+                table.c.id.in_(children) & (table.c.waiting_parents <= 0)))
+            db.session.info.setdefault("ready_jobs", []).extend(
+                row[0] for row in ready)
+
+    @classmethod
+    def purge(cls, job_ids, batch_size=None, chunk_size=None):
+        """
+        Deletes ``job_ids`` along with their tasks, dependencies and
+        tag/software associations using set based statements in
+        dependency order.  No ORM objects are loaded.  Jobs are handled
+        ``chunk_size`` at a time and their tasks are deleted
+        ``batch_size`` at a time, both :const:`.BULK_CHUNK_SIZE` by
+        default.  Each batch of tasks and each chunk of jobs is committed
+        so other writers are never blocked for long.  Returns a
+        dictionary with the number of rows deleted from each table.
+
+        .. warning::
+            Because every batch is committed any work already pending in
+            the session is committed along with the first batch.
+
+        .. note::
+            This does not go through the session so loaded jobs and
+            tasks should be expired or reloaded.
+        """
+        batch_size = batch_size or BULK_CHUNK_SIZE
+        job_ids = list(job_ids)
+        counts = {}
+
+        def delete(table, whereclause):
+            result = db.session.execute(table.delete().where(whereclause))
+            counts[table.name] = counts.get(table.name, 0) + result.rowcount
+
+        for chunk in chunked(job_ids, chunk_size):
+            while True:
+                task_ids = [row[0] for row in db.session.execute(
+                    db.select([Task.id]).where(
+                        Task.job_id.in_(chunk)).limit(batch_size))]
+                if not task_ids:
+                    break
+
+                # the running tasks in this batch no longer count towards
+                # their project's quota, this is read first because the
+                # deletes can't return it
+                project_id = db.func.coalesce(Task.project_id, cls.project_id)
+                usage = db.session.query(
+                    project_id, db.func.count(Task.id),
+                    db.func.sum(
+                        case([(cls.cpus > 0, cls.cpus)], else_=0))).join(
+                    cls, cls.id == Task.job_id).filter(
+                    Task.id.in_(task_ids),
+                    Task.state.in_(Task.ACTIVE_STATES)).group_by(
+                    project_id).all()
+
+                delete(TaskDependencies,
+                       TaskDependencies.c.parent_id.in_(task_ids) |
+                       TaskDependencies.c.child_id.in_(task_ids))
+                delete(Task.__table__, Task.id.in_(task_ids))
+                db.session.commit()
+
+                for project, tasks, cpus in usage:
+                    project_usage.adjust(project, -tasks, -(cpus or 0))
+
+            cls.release_children(chunk, exclude=job_ids)
+            for table, whereclause in cls.dependent_rows(chunk):
+                delete(table, whereclause)
+            db.session.commit()
+
+            for job_id in chunk:
+                state_maps.pop(job_id)
+
+        return counts
+
+    @classmethod
+    def compute_aging_key(cls, priority, time_submitted):
+        """
+        Returns the value which should be stored in :attr:`aging_key` for
+        the given ``priority`` and ``time_submitted``
+        """
+        return priority - cls.AGING_RATE * epoch_hours(time_submitted)
+
+    @classmethod
+    def aging_horizon(cls, now=None):
+        """
+        Returns the submission time before which jobs have reached
+        :attr:`AGING_CAP` or None if aging is not capped.
+        """
+        if not cls.AGING_RATE or not cls.AGING_CAP:
+            return None
+
+        now = now or datetime.now()
+        return now - timedelta(hours=cls.AGING_CAP / float(cls.AGING_RATE))
+
+    @classmethod
+    def effective_priority(cls, now=None):
+        """
+        Returns a SQL expression for the aged priority of a job at ``now``
+        which can be used in ``ORDER BY`` or returned as a column.  Because
+        the cap makes the value depend on each row this expression can't
+        be served by an index, :meth:`dispatch_order` should be preferred
+        when selecting the top of the queue.
+        """
+        now = now or datetime.now()
+        aged = cls.aging_key + cls.AGING_RATE * epoch_hours(now)
+
+        if not cls.AGING_RATE or not cls.AGING_CAP:
+            return aged
+
+        capped = cls.priority + cls.AGING_CAP
+        return case([(aged > capped, capped)], else_=aged)
+
+    def effective_priority_at(self, now=None):
+        """Python version of :meth:`effective_priority` for this job"""
+        now = now or datetime.now()
+        aged = self.aging_key + self.AGING_RATE * epoch_hours(now)
+
+        if not self.AGING_RATE or not self.AGING_CAP:
+            return aged
+
+        return min(aged, self.priority + self.AGING_CAP)
+
+    @classmethod
+    def dispatch_order(cls, limit, now=None, query=None, skip_blocked=True):
+        """
+        Returns up to ``limit`` queued jobs with the highest effective
+        priority.  Jobs which have not reached the aging cap are read in
+        :attr:`aging_key` order and jobs which have are read in
+        :attr:`priority` order, both through an index, and the two short
+        lists are merged here instead of sorting the whole queue.
+
+        :param int limit:
+            the maximum number of jobs to return
+
+        :param datetime now:
+            the time to compute the effective priority at, defaults to
+            :meth:`datetime.datetime.now`
+
+        :param query:
+            optional query to start from, this may be used to apply
+            additional filters
+
+        :param bool skip_blocked:
+            if True, skip jobs from projects which have reached their quota
+            according to :data:`.project_usage`
+        """
+        now = now or datetime.now()
+        if query is None:
+            query = cls.query
+
+        query = query.filter(
+            cls.state == WorkState.QUEUED, cls.hidden == False)
+        blocked = project_usage.blocked_ids() if skip_blocked else None
+        if blocked:
+            query = query.filter(
+                (cls.project_id == None) | ~cls.project_id.in_(list(blocked)))
+        horizon = cls.aging_horizon(now)
+
+        if horizon is None:
+            return query.order_by(
+                cls.aging_key.desc(), cls.time_submitted).limit(limit).all()
+
+        aging = query.filter(cls.time_submitted > horizon).order_by(
+            cls.aging_key.desc()).limit(limit).all()
+        capped = query.filter(cls.time_submitted <= horizon).order_by(
+            cls.priority.desc(), cls.time_submitted).limit(limit).all()
+
+        return sorted(
+            aging + capped,
+            key=lambda job: (-job.effective_priority_at(now),
+                             job.time_submitted))[:limit]
+
+    @staticmethod
+    def parentAddedEvent(target, value, initiator):
+        """counts ``value`` as a parent of ``target`` which must finish"""
+        if value.state != WorkState.DONE:
+            target.waiting_parents = (target.waiting_parents or 0) + 1
+
+    @staticmethod
+    def parentRemovedEvent(target, value, initiator):
+        """stops counting ``value`` as a parent ``target`` waits on"""
+        if value.state != WorkState.DONE:
+            target.waiting_parents = max((target.waiting_parents or 0) - 1, 0)
+
+    @staticmethod
+    def dependencyStateEvent(target, new_value, old_value, initiator):
+        """
+        Records how :attr:`waiting_parents` of the children should change
+        when this job is finished or taken back out of the finished state.
+        The change itself is applied by :func:`job_after_update`.
+        """
+        done = new_value == WorkState.DONE
+        if done != (old_value == WorkState.DONE):
+            target.children_delta = \
+                getattr(target, "children_delta", 0) + (-1 if done else 1)
+
+
+# declared outside of __table_args__ so the index can match the descending
+# priority ordering used by Job.dispatch_order
+db.Index("%s_queue_priority_idx" % TABLE_JOB,
+         Job.state, Job.priority.desc(), Job.time_submitted)
+
+
+def job_after_update(mapper, connection, job):
+    """
+    Applies the change recorded by :meth:`Job.dependencyStateEvent` to the
+    :attr:`Job.waiting_parents` column of the children of ``job`` and
+    records the children which no longer wait on any parent.  Only the
+    rows for this job in the dependency table are read.
+    """
+    delta = job.__dict__.pop("children_delta", 0)
+    if not delta:
+        return
+
+    table = mapper.local_table
+    child_ids = [
+        row[0] for row in connection.execute(
+            db.select([WAITING_JOB]).where(WAITED_ON_JOB == job.id))]
+    if not child_ids:
+        return
+
+    connection.execute(
+        table.update().where(table.c.id.in_(child_ids)).values(
+            waiting_parents=table.c.waiting_parents + delta))
+    session = object_session(job)
+    expire_waiting_parents(session, child_ids)
+
+    if delta < 0 and ready_job_callbacks:
+        ready = connection.execute(
+            db.select([table.c.id]).where(
+                table.c.id.in_(child_ids) & (table.c.waiting_parents <= 0)))
+        pending = session.info.setdefault("ready_jobs", [])
+        pending.extend(row[0] for row in ready)
+
+
+def expire_waiting_parents(session, job_ids=None):
+    """
+    Expires :attr:`Job.waiting_parents` on the jobs loaded in ``session``,
+    or only those in ``job_ids``, after the column was updated outside of
+    the ORM so a stale value is neither read nor written back.
+    """
+    if job_ids is None:
+        jobs = [
+            instance for instance in session.identity_map.values()
+            if isinstance(instance, Job)]
+    else:
+        identity_key = Job.__mapper__.identity_key_from_primary_key
+        jobs = [
+            session.identity_map.get(identity_key((job_id, )))
+            for job_id in job_ids]
+
+    for job in jobs:
+        if job is not None:
+            session.expire(job, ["waiting_parents"])
+
+
+def session_after_commit(session):
+    """passes jobs which are now ready to :data:`ready_job_callbacks`"""
+    job_ids = session.info.pop("ready_jobs", None)
+    if job_ids:
+        for callback in ready_job_callbacks:
+            callback(job_ids)
+
+
+def session_after_rollback(session):
+    """discards ready jobs from a transaction which was rolled back"""
+    session.info.pop("ready_jobs", None)
+
+
+def job_before_insert_update(mapper, connection, job):
+    """updates :attr:`Job.aging_key` before the job is written"""
+    if job.time_submitted is None:
+        job.time_submitted = datetime.now()
+
+    priority = DEFAULT_PRIORITY if job.priority is None else job.priority
+    job.aging_key = job.compute_aging_key(priority, job.time_submitted)
+
 
 event.listen(Job.state, "set", Job.stateChangedEvent)
+event.listen(Job, "before_insert", job_before_insert_update)
+event.listen(Job, "before_update", job_before_insert_update)
+event.listen(Job, "after_update", job_after_update)
+event.listen(Job.parents, "append", Job.parentAddedEvent)
+event.listen(Job.parents, "remove", Job.parentRemovedEvent)
+event.listen(
+    Job.state, "set", Job.dependencyStateEvent, active_history=True)
+event.listen(Session, "after_commit", session_after_commit)
+event.listen(Session, "after_rollback", session_after_rollback)
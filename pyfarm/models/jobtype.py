@@ -24,15 +24,143 @@ general implementation.
 """
 
 import ast
+from collections import namedtuple
+from hashlib import sha256
+from multiprocessing import Pool
 from textwrap import dedent
 from sqlalchemy import event
-from sqlalchemy.orm import validates
+from sqlalchemy.orm import validates, deferred, undefer_group
+from pyfarm.core.config import read_env_int
 from pyfarm.core.enums import JobTypeLoadMode
 from pyfarm.master.application import db
+from pyfarm.models.core.cache import LRUCache
+from pyfarm.models.core.functions import chunked
 from pyfarm.models.core.types import id_column, JobTypeLoadModeEnum
 from pyfarm.models.core.cfg import TABLE_JOB_TYPE, MAX_JOBTYPE_LENGTH
 
 JOBTYPE_BASECLASS = "JobType"
+VALIDATION_PROCESSES = read_env_int("PYFARM_JOBTYPE_VALIDATION_PROCESSES", 0)
+
+#: Returned by :meth:`JobType.create_many`, ``errors`` is a list of
+#: ``(index, name, message)`` for each job type which was rejected
+JobTypeReport = namedtuple("JobTypeReport", ("created", "errors"))
+
+#: Results of :func:`check_jobtype_code` keyed by ``(code_sha256, classname)``
+#: so repeat submissions of the same code are not parsed again
+validated_code = LRUCache(
+    read_env_int("PYFARM_JOBTYPE_VALIDATION_CACHE_SIZE", 256))
+
+#: Code objects compiled from :attr:`JobType.code` keyed by
+#: :attr:`JobType.code_sha256`
+compiled_code = LRUCache(
+    read_env_int("PYFARM_JOBTYPE_COMPILED_CACHE_SIZE", 256))
+
+
+def code_hash(code):
+    """returns the hex encoded sha256 digest of jobtype ``code``"""
+    if not isinstance(code, bytes):
+        code = code.encode("utf-8")
+    return sha256(code).hexdigest()
+
+
+def check_jobtype_code(code, classname):
+    """
+    Parses ``code`` and ensures it defines ``classname`` as a subclass of
+    :const:`JOBTYPE_BASECLASS`.  A :class:`SyntaxError` is raised if the
+    code can't be parsed, the class does not exist or the class has the
+    wrong parent.  This does not depend on any database state so the
+    result only depends on the arguments.
+    """
+    # TODO: this parsing is extremely basic and needs some expansion
+    # If jobtype's says to download a file then we must
+    # be sure it's valid.  If we don't, you could probably tip over
+    # the master(s) under the load of rapidly failing tasks due to
+    # any of the following:
+    #   * job class name does not exist in the code (...)
+    #   * invalid Python code (SyntaxError)
+    #   * invalid parent class (jobtype must subclass JobType)
+    parsed = ast.parse(code)
+
+    for node in ast.walk(parsed):
+        if not isinstance(node, ast.ClassDef):
+            continue
+
+        # found the class, make sure it has the proper parent class
+        elif node.name == classname:
+            if JOBTYPE_BASECLASS not in set(base.id for base in node.bases):
+                error_args = (classname, JOBTYPE_BASECLASS)
+                raise SyntaxError("%s is not a subclass of %s" % error_args)
+            else:  # pragma: no cover
+                break
+    else:  # pragma: no cover
+        raise SyntaxError(
+            "jobtype class `%s` does not exist" % classname)
+
+
+def jobtype_code_error(code, classname):
+    """
+    Returns the type and arguments of the exception
+    :func:`check_jobtype_code` raises for ``code`` or None if the code is
+    valid.  The exception itself is not returned so cached results do not
+    keep its traceback alive.
+    """
+    try:
+        check_jobtype_code(code, classname)
+    except Exception as e:
+        return type(e), e.args
+
+
+def jobtype_code_error_worker(args):
+    """calls :func:`jobtype_code_error` with ``(code, classname)``"""
+    return jobtype_code_error(*args)
+
+
+def check_jobtype_codes(items, processes=None):
+    """
+    Runs :func:`jobtype_code_error` on many ``(code, classname)`` pairs
+    and returns the results in the same order.  Results already in
+    :data:`validated_code` are reused and the rest are checked
+    concurrently in a process pool.
+
+    :param int processes:
+        the number of processes to use, by default
+        :const:`VALIDATION_PROCESSES` or the number of cpus when that
+        is 0.  With one process, or a single item to check, the checks
+        run in this process.
+    """
+    if processes is None:
+        processes = VALIDATION_PROCESSES or None
+
+    keys = [(code_hash(code), classname) for code, classname in items]
+    pending = {}
+    for key, item in zip(keys, items):
+        if key not in validated_code and key not in pending:
+            pending[key] = item
+
+    checked = {}
+    if len(pending) == 1 or processes == 1:
+        checked = dict(
+            (key, jobtype_code_error_worker(item))
+            for key, item in pending.items())
+
+    elif pending:
+        pool = Pool(processes)
+        try:
+            results = pool.map(
+                jobtype_code_error_worker, list(pending.values()))
+        finally:
+            pool.close()
+            pool.join()
+
+        checked = dict(zip(pending, results))
+
+    for key, result in checked.items():
+        validated_code.put(key, result)
+
+    return [
+        checked[key] if key in checked else validated_code.lookup(
+            key, lambda: jobtype_code_error_worker(item))
+        for key, item in zip(keys, items)]
 
 
 class JobType(db.Model):
@@ -41,6 +169,10 @@ class JobType(db.Model):
     """
     __tablename__ = TABLE_JOB_TYPE
 
+    #: Query options which load the deferred :attr:`code` along with the
+    #: job type instead of on first access
+    WITH_CODE = (undefer_group("code"), )
+
     id = id_column(db.Integer)
     name = db.Column(db.String(MAX_JOBTYPE_LENGTH), nullable=False,
                      doc=dedent("""
@@ -57,11 +189,21 @@ class JobType(db.Model):
                           The name of the job class contained within the file
                           being loaded.  This field may be null but when it's
                           not provided :attr:`name` will be used instead."""))
-    code = db.Column(db.UnicodeText, nullable=False,
-                     doc=dedent("""
-                     General field containing the 'code' to retrieve the job
-                     type.  See below for information on what this field will
-                     contain depending on how the job will be loaded."""))
+    code = deferred(
+        db.Column(db.UnicodeText, nullable=False,
+                  doc=dedent("""
+                  General field containing the 'code' to retrieve the job
+                  type.  See below for information on what this field will
+                  contain depending on how the job will be loaded.  This
+                  column is only loaded when accessed unless the query
+                  uses :attr:`WITH_CODE`.""")),
+        group="code")
+    code_sha256 = db.Column(db.String(64), index=True,
+                            doc=dedent("""
+                            The sha256 digest of :attr:`code`, used to find
+                            job types with identical code and as the key
+                            for cached validation results and compiled
+                            code."""))
     mode = db.Column(JobTypeLoadModeEnum,
                      default=JobTypeLoadMode.IMPORT,
                      nullable=False,
@@ -88,40 +230,120 @@ class JobType(db.Model):
             raise ValueError("invalid value for mode")
         return value
 
+    @validates("code")
+    def validates_code(self, key, value):
+        """keeps :attr:`code_sha256` in sync with :attr:`code`"""
+        self.code_sha256 = None if value is None else code_hash(value)
+        return value
+
+    @classmethod
+    def create(cls, name, classname, code, mode=JobTypeLoadMode.IMPORT,
+               description=None):
+        """
+        Returns a job type with the given values.  If a job type with the
+        same name, class name, mode and identical code already exists it
+        is reused instead of storing another copy of the code.  New job
+        types are added to the session but not committed.
+        """
+        jobtype = cls.query.filter_by(
+            code_sha256=code_hash(code), name=name, classname=classname,
+            mode=mode).first()
+
+        if jobtype is None:
+            jobtype = cls(
+                name=name, classname=classname, code=code, mode=mode,
+                description=description)
+            db.session.add(jobtype)
+
+        return jobtype
+
+    @classmethod
+    def create_many(cls, jobtypes, processes=None):
+        """
+        Validates and inserts many job types at once.  The code of
+        :attr:`JobTypeLoadMode.DOWNLOAD` job types is checked up front
+        by :func:`check_jobtype_codes`, outside of any flush, and makes
+        the same decisions as :func:`jobtype_before_insert`.  The
+        accepted job types are then inserted with one statement per
+        chunk.  Rejected job types do not prevent the others from being
+        inserted.  Nothing is committed.
+
+        :param list jobtypes:
+            dictionaries with the ``name``, ``classname``, ``code`` and
+            optionally the ``mode`` and ``description`` of each job type
+
+        :param int processes:
+            passed to :func:`check_jobtype_codes`
+
+        :rtype: :class:`JobTypeReport`
+        """
+        downloads = [
+            (jobtype["code"], jobtype.get("classname"))
+            for jobtype in jobtypes
+            if jobtype.get("mode") == JobTypeLoadMode.DOWNLOAD]
+        results = iter(check_jobtype_codes(downloads, processes=processes))
+
+        rows = []
+        errors = []
+        for index, jobtype in enumerate(jobtypes):
+            mode = jobtype.get("mode", JobTypeLoadMode.IMPORT)
+            error = None
+
+            if mode not in JobTypeLoadMode:
+                error = (ValueError, ("invalid value for mode", ))
+            elif mode == JobTypeLoadMode.DOWNLOAD:
+                error = next(results)
+
+            if error is not None:
+                error_type, error_args = error
+                errors.append(
+                    (index, jobtype.get("name"),
+                     "%s: %s" % (error_type.__name__,
+                                 error_type(*error_args))))
+                continue
+
+            rows.append({
+                "name": jobtype.get("name"),
+                "description": jobtype.get("description"),
+                "classname": jobtype.get("classname"),
+                "code": jobtype["code"],
+                "code_sha256": code_hash(jobtype["code"]),
+                "mode": mode})
+
+        for chunk in chunked(rows):
+            db.session.execute(cls.__table__.insert(), chunk)
+
+        return JobTypeReport(len(rows), errors)
+
+    def check_code(self):
+        """
+        Runs :func:`check_jobtype_code` on :attr:`code`, reusing the
+        result of previous checks of the same code and class name.
+        """
+        key = (self.code_sha256 or code_hash(self.code), self.classname)
+        error = validated_code.lookup(
+            key, lambda: jobtype_code_error(self.code, self.classname))
+
+        if error is not None:
+            error_type, error_args = error
+            raise error_type(*error_args)
+
+    def compiled(self):
+        """
+        Returns :attr:`code` compiled into a code object.  Code objects
+        are shared by all job types with identical code so the same code
+        is only compiled once per process.
+        """
+        sha = self.code_sha256 or code_hash(self.code)
+        return compiled_code.lookup(
+            sha, lambda: compile(self.code, "<jobtype %s>" % sha, "exec"))
+
 
 def jobtype_before_insert(mapper, connection, jobtype):
     if jobtype.mode != JobTypeLoadMode.DOWNLOAD:
         return
 
-    # TODO: this parsing is extremely basic and needs some expansion
-    # If jobtype's says to download a file then we must
-    # be sure it's valid.  If we don't, you could probably tip over
-    # the master(s) under the load of rapidly failing tasks due to
-    # any of the following:
-    #   * job class name does not exist in the code (...)
-    #   * invalid Python code (SyntaxError)
-    #   * invalid parent class (jobtype must subclass JobType)
-    try:
-        parsed = ast.parse(jobtype.code)
-
-        # NOTE: some coverage is skipped because the final except clause
-        # prevents coverage from pulling the correct lines in
-        for node in ast.walk(parsed):
-            if not isinstance(node, ast.ClassDef):
-                continue
+    jobtype.check_code()
 
-            # found the class, make sure it has the proper parent class
-            elif node.name == jobtype.classname:
-                if JOBTYPE_BASECLASS not in set(base.id for base in node.bases):
-                    error_args = (jobtype.classname, JOBTYPE_BASECLASS)
-                    raise SyntaxError("%s is not a subclass of %s" % error_args)
-                else:  # pragma: no cover
-                    break
-        else:  # pragma: no cover
-            raise SyntaxError(
-                "jobtype class `%s` does not exist" % jobtype.classname)
-
-    except Exception:
-        raise
 
 event.listen(JobType, "before_insert", jobtype_before_insert)
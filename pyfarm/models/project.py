@@ -22,12 +22,120 @@ Top level table used as a grouping mechanism for many components of PyFarm
  including jobs, tasks, agents, users, and more.
 """
 
+from collections import defaultdict
+from textwrap import dedent
+from threading import RLock
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.expression import case
+
+from pyfarm.core.config import read_env_int
+from pyfarm.core.enums import STRING_TYPES
 from pyfarm.master.application import db
+from pyfarm.models.core.cache import LRUCache, clear_on_rollback
 from pyfarm.models.core.types import id_column
 from pyfarm.models.core.cfg import TABLE_PROJECT, MAX_PROJECT_NAME_LENGTH
 from pyfarm.models.core.mixins import ReprMixin
 
 
+class QuotaUsage(object):
+    """
+    In-process counters of the tasks and cpus each project is using along
+    with the quota limits for each project.  The counters are maintained
+    incrementally as tasks change state so :meth:`blocked` can be answered
+    without a query.  :meth:`Project.reconcile_usage` replaces the
+    counters with values from the database to correct any drift.
+    """
+    def __init__(self):
+        self.lock = RLock()
+        self.tasks = defaultdict(int)
+        self.cpus = defaultdict(int)
+        self.limits = {}
+        self.blocked_projects = set()
+
+    def update_blocked(self, project_id):
+        """updates :attr:`blocked_projects` for a single project"""
+        max_tasks, max_cpus = self.limits.get(project_id, (None, None))
+
+        if (max_tasks is not None and self.tasks[project_id] >= max_tasks) or \
+                (max_cpus is not None and self.cpus[project_id] >= max_cpus):
+            self.blocked_projects.add(project_id)
+        else:
+            self.blocked_projects.discard(project_id)
+
+    def set_limits(self, project_id, max_tasks, max_cpus):
+        """sets the quota for ``project_id``, None meaning unlimited"""
+        with self.lock:
+            if max_tasks is None and max_cpus is None:
+                self.limits.pop(project_id, None)
+            else:
+                self.limits[project_id] = (max_tasks, max_cpus)
+            self.update_blocked(project_id)
+
+    def adjust(self, project_id, tasks, cpus):
+        """adds ``tasks`` and ``cpus`` to the usage of ``project_id``"""
+        if project_id is None:
+            return
+
+        with self.lock:
+            self.tasks[project_id] = max(self.tasks[project_id] + tasks, 0)
+            self.cpus[project_id] = max(self.cpus[project_id] + cpus, 0)
+            self.update_blocked(project_id)
+
+    def adjust_on_commit(self, session, project_id, tasks, cpus):
+        """
+        Like :meth:`adjust` but the change is kept in ``session.info`` and
+        only applied once ``session`` commits.  It is discarded if the
+        session rolls back instead.
+        """
+        if project_id is None:
+            return
+
+        pending = session.info.setdefault("project_usage", {})
+        pending_tasks, pending_cpus = pending.get(project_id, (0, 0))
+        pending[project_id] = (pending_tasks + tasks, pending_cpus + cpus)
+
+    def blocked(self, project_id):
+        """returns True if ``project_id`` has reached its quota"""
+        return project_id in self.blocked_projects
+
+    def blocked_ids(self):
+        """returns a copy of the ids of projects which reached their quota"""
+        with self.lock:
+            return set(self.blocked_projects)
+
+    def reset(self, usage, limits):
+        """
+        Replaces all counters and limits.
+
+        :param dict usage:
+            dictionary of ``{project_id: (tasks, cpus)}``
+
+        :param dict limits:
+            dictionary of ``{project_id: (max_tasks, max_cpus)}``
+        """
+        with self.lock:
+            self.tasks.clear()
+            self.cpus.clear()
+            self.limits = dict(limits)
+            self.blocked_projects = set()
+
+            for project_id, (tasks, cpus) in usage.items():
+                self.tasks[project_id] = tasks
+                self.cpus[project_id] = cpus
+
+            for project_id in self.limits:
+                self.update_blocked(project_id)
+
+
+#: Usage counters and quotas shared by the process
+project_usage = QuotaUsage()
+
+#: Maps the names of existing projects to their ids
+project_ids = LRUCache(read_env_int("PYFARM_PROJECT_CACHE_SIZE", 256))
+
+
 class Project(db.Model, ReprMixin):
     """
     Stores the top level projects which jobs, tasks, users, roles, etc
@@ -39,6 +147,18 @@ class Project(db.Model, ReprMixin):
     id = id_column()
     name = db.Column(
         db.Unicode(MAX_PROJECT_NAME_LENGTH), doc="the name of the project")
+    max_running_tasks = db.Column(db.Integer,
+                                  doc=dedent("""
+                                  The maximum number of tasks from this
+                                  project which may be assigned or running at
+                                  once.  Null means there is no limit."""))
+    max_running_cpus = db.Column(db.Integer,
+                                 doc=dedent("""
+                                 The maximum number of cpus tasks from this
+                                 project may use at once, based on
+                                 :attr:`.Job.cpus`.  Jobs using the special
+                                 cpu values are not counted.  Null means
+                                 there is no limit."""))
 
     @classmethod
     def get(cls, name, create=True):
@@ -52,8 +172,9 @@ class Project(db.Model, ReprMixin):
             if True and a project by ``name`` does not exist, create it
             before returning
         """
-        assert isinstance(name, basestring), "expected string for `name`"
-        project = cls.query.filter_by(name=name).first()
+        assert isinstance(name, STRING_TYPES), "expected string for `name`"
+        project_id = cls.get_id(name)
+        project = None if project_id is None else cls.query.get(project_id)
 
         # create the project if necessary
         if project is None and create:
@@ -68,3 +189,84 @@ class Project(db.Model, ReprMixin):
 
         return project
 
+    @classmethod
+    def get_id(cls, name):
+        """
+        Returns the id of the project named ``name`` or None if it does
+        not exist.  Ids of existing projects are cached in
+        :data:`project_ids` until a project is inserted, updated or
+        deleted.  Missing projects are not cached so the query, and the
+        autoflush of pending projects, runs on every miss.
+        """
+        return project_ids.lookup(
+            name, lambda: db.session.query(cls.id).filter_by(
+                name=name).limit(1).scalar(), store_none=False)
+
+    @classmethod
+    def blocked_ids(cls):
+        """
+        Returns the ids of the projects which have reached their quota.
+        This does not query the database.
+        """
+        return project_usage.blocked_ids()
+
+    @classmethod
+    def reconcile_usage(cls):
+        """
+        Recomputes the quota usage of every project from the database and
+        reloads the quota limits.  This should run periodically to correct
+        any drift in :data:`project_usage` caused by changes made outside
+        of this process or outside of the ORM.
+        """
+        # imported here because both models depend on this module
+        from pyfarm.models.job import Job
+        from pyfarm.models.task import Task
+
+        project_id = db.func.coalesce(Task.project_id, Job.project_id)
+        cpus = db.func.sum(case([(Job.cpus > 0, Job.cpus)], else_=0))
+        query = db.session.query(
+            project_id, db.func.count(Task.id), cpus).join(
+            Job, Job.id == Task.job_id).filter(
+            Task.state.in_(Task.ACTIVE_STATES)).group_by(project_id)
+        usage = dict(
+            (row[0], (row[1], row[2] or 0)) for row in query
+            if row[0] is not None)
+
+        limits = db.session.query(
+            cls.id, cls.max_running_tasks, cls.max_running_cpus).filter(
+            (cls.max_running_tasks != None) | (cls.max_running_cpus != None))
+        project_usage.reset(
+            usage, dict((row[0], (row[1], row[2])) for row in limits))
+
+
+def session_after_commit(session):
+    """applies usage recorded by :meth:`QuotaUsage.adjust_on_commit`"""
+    pending = session.info.pop("project_usage", {})
+    for project_id, (tasks, cpus) in pending.items():
+        project_usage.adjust(project_id, tasks, cpus)
+
+
+def session_after_rollback(session):
+    """discards usage recorded in a transaction which was rolled back"""
+    session.info.pop("project_usage", None)
+
+
+def project_after_insert_update(mapper, connection, project):
+    """updates the limits in :data:`project_usage`"""
+    project_usage.set_limits(
+        project.id, project.max_running_tasks, project.max_running_cpus)
+    project_ids.clear()
+
+
+def project_after_delete(mapper, connection, project):
+    """removes the limits from :data:`project_usage`"""
+    project_usage.set_limits(project.id, None, None)
+    project_ids.clear()
+
+
+event.listen(Project, "after_insert", project_after_insert_update)
+event.listen(Project, "after_update", project_after_insert_update)
+event.listen(Project, "after_delete", project_after_delete)
+event.listen(Session, "after_commit", session_after_commit)
+event.listen(Session, "after_rollback", session_after_rollback)
+clear_on_rollback(project_ids)
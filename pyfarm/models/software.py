@@ -22,15 +22,115 @@ to show that they provide a given software, while jobs can reference it to
 depend on that software.
 """
 
+import re
+from operator import eq, ne, ge, gt, le, lt
 from textwrap import dedent
 
+from sqlalchemy import event
+from sqlalchemy.orm import validates
 from sqlalchemy.schema import UniqueConstraint
+from sqlalchemy.sql.expression import and_, true
 
+from pyfarm.core.config import read_env_int
+from pyfarm.core.enums import STRING_TYPES
 from pyfarm.master.application import db
+from pyfarm.models.core.cache import LRUCache, clear_on_rollback
 from pyfarm.models.core.cfg import TABLE_SOFTWARE, MAX_TAG_LENGTH
+from pyfarm.models.core.functions import get_or_create_ids
 from pyfarm.models.core.types import id_column
 from pyfarm.models.core.mixins import UtilityMixins
 
+#: Maps ``(software, version)`` of existing software to ids
+software_ids = LRUCache(read_env_int("PYFARM_SOFTWARE_CACHE_SIZE", 1024))
+
+VERSION_TOKEN = re.compile(r"\d+|[a-zA-Z]+")
+REQUIREMENT = re.compile(r"^\s*([^\s<>=!,]+)\s*(.*?)\s*$")
+
+#: Operators which may be used in a version constraint, longest first so
+#: parsing ``>=`` does not stop at ``>``
+CONSTRAINT_OPERATORS = (
+    (">=", ge), ("<=", le), ("==", eq), ("!=", ne), (">", gt), ("<", lt),
+    ("=", eq))
+
+
+def version_sort_key(version):
+    """
+    Returns a string for ``version`` which sorts in version order when
+    compared as a string, or None for ``any``.  Each run of digits is
+    prefixed with its length so ``10`` sorts after ``9`` and each run of
+    letters is lowercased.  Trailing zeros are dropped so ``1.0`` and
+    ``1`` produce the same key.
+
+    >>> version_sort_key("2014.1") < version_sort_key("2014.10")
+    True
+    >>> version_sort_key("2014") < version_sort_key("2014.1")
+    True
+    """
+    if version is None or version == "any":
+        return None
+
+    tokens = []
+    for token in VERSION_TOKEN.findall(version):
+        if token.isdigit():
+            token = token.lstrip("0")
+            tokens.append("%02d%s" % (len(token), token))
+        else:
+            tokens.append(token.lower())
+
+    while len(tokens) > 1 and tokens[-1] == "00":
+        tokens.pop()
+
+    return ".".join(tokens) or None
+
+
+def parse_constraint(spec):
+    """
+    Parses a version constraint such as ``2014``, ``>=2014`` or
+    ``>=2014,<2016`` into a list of ``(operator, version)`` tuples.  An
+    empty constraint or ``any`` produces an empty list.
+
+    >>> parse_constraint(">=2014, <2016")
+    [('>=', '2014'), ('<', '2016')]
+    """
+    if spec is None or spec.strip() in ("", "any"):
+        return []
+
+    constraint = []
+    for clause in spec.split(","):
+        clause = clause.strip()
+        for operator, _ in CONSTRAINT_OPERATORS:
+            if clause.startswith(operator):
+                version = clause[len(operator):].strip()
+                break
+        else:
+            operator, version = "==", clause
+
+        if version_sort_key(version) is None:
+            raise ValueError("invalid version constraint %r" % spec)
+
+        constraint.append(("==" if operator == "=" else operator, version))
+
+    return constraint
+
+
+def parse_requirement(requirement):
+    """
+    Splits a requirement such as ``maya >= 2014`` into the name of
+    the software and its version constraint.
+
+    >>> parse_requirement("maya >= 2014")
+    ('maya', '>= 2014')
+    >>> parse_requirement("maya")
+    ('maya', 'any')
+    """
+    match = REQUIREMENT.match(requirement)
+    if match is None:
+        raise ValueError("invalid software requirement %r" % requirement)
+
+    name, spec = match.groups()
+    return name, spec or "any"
+
+
 class Software(db.Model, UtilityMixins):
     """
     Model to represent a versioned piece of software that can be present on an
@@ -48,7 +148,9 @@ class Software(db.Model, UtilityMixins):
     """
     __tablename__ = TABLE_SOFTWARE
     __table_args__ = (
-        UniqueConstraint("software", "version"), )
+        UniqueConstraint("software", "version"),
+        db.Index("%s_version_key_idx" % TABLE_SOFTWARE,
+                 "software", "version_key"))
 
     id = id_column()
     software = db.Column(db.String(MAX_TAG_LENGTH), nullable=False,
@@ -60,3 +162,111 @@ class Software(db.Model, UtilityMixins):
                         The version of the software.  This value does not follow
                         any special formatting rules because the format depends
                         on the 3rd party."""))
+    version_key = db.Column(db.String(MAX_TAG_LENGTH * 2),
+                            default=lambda context: version_sort_key(
+                                context.current_parameters.get("version")),
+                            doc=dedent("""
+                            Sortable form of :attr:`version` produced by
+                            :func:`version_sort_key`.  This is what
+                            version constraints are compared against and
+                            is null when the version is ``any``."""))
+
+    @validates("version")
+    def validate_version(self, key, value):
+        """keeps :attr:`version_key` in sync with :attr:`version`"""
+        self.version_key = version_sort_key(value)
+        return value
+
+    @classmethod
+    def version_constraint(cls, spec):
+        """
+        Returns a SQL expression which matches rows whose version
+        satisfies ``spec``, see :func:`parse_constraint`.  The
+        comparisons are made against :attr:`version_key` so they can use
+        an index.
+        """
+        operators = dict(CONSTRAINT_OPERATORS)
+        clauses = [
+            operators[operator](cls.version_key, version_sort_key(version))
+            for operator, version in parse_constraint(spec)]
+        return and_(*clauses) if clauses else true()
+
+    @classmethod
+    def matching(cls, software, spec="any"):
+        """
+        Returns a SQL expression which matches rows for ``software``
+        with a version satisfying ``spec``
+        """
+        return (cls.software == software) & cls.version_constraint(spec)
+
+    @classmethod
+    def get_id(cls, software, version="any"):
+        """
+        Returns the id of ``software`` at ``version`` or None if it does
+        not exist.  Ids of existing software are cached in
+        :data:`software_ids` until software is inserted, updated or
+        deleted.  Missing software is not cached so the query, and the
+        autoflush of pending software, runs on every miss.
+        """
+        return software_ids.lookup(
+            (software, version), lambda: db.session.query(cls.id).filter_by(
+                software=software, version=version).scalar(),
+            store_none=False)
+
+    @classmethod
+    def get(cls, software, version="any", create=True):
+        """
+        Returns a :class:`.Software` object matching ``software`` and
+        ``version``.
+
+        :param str software:
+            the name of the software to look for
+
+        :param str version:
+            the version of the software to look for
+
+        :param bool create:
+            if True and the software does not exist, add it to the session
+            before returning
+        """
+        software_id = cls.get_id(software, version)
+        item = None if software_id is None else cls.query.get(software_id)
+
+        if item is None and create:
+            item = cls(software=software, version=version)
+            db.session.add(item)
+
+        return item
+
+    @classmethod
+    def resolve(cls, items):
+        """
+        Returns a dictionary mapping ``(software, version)`` to the id of
+        each of ``items``, creating any software which does not exist yet
+        in bulk.
+
+        :param items:
+            ``(software, version)`` tuples or the names of software, in
+            which case the version will be ``any``
+        """
+        keys = [
+            (item, "any") if isinstance(item, STRING_TYPES) else tuple(item)
+            for item in items]
+        return get_or_create_ids(
+            cls, ("software", "version"), keys, cache=software_ids)
+
+
+def software_after_insert_delete(mapper, connection, software):
+    """removes the cached id of ``software``"""
+    software_ids.pop((software.software, software.version))
+
+
+def software_after_update(mapper, connection, software):
+    """discards all cached ids since software may have been renamed"""
+    software_ids.clear()
+
+
+event.listen(Software, "after_insert", software_after_insert_delete)
+event.listen(Software, "after_update", software_after_update)
+event.listen(Software, "after_delete", software_after_insert_delete)
+clear_on_rollback(software_ids)
@@ -22,13 +22,21 @@ Table with tags for both jobs and agents
 
 from textwrap import dedent
 
+from sqlalchemy import event
 from sqlalchemy.schema import UniqueConstraint
 
+from pyfarm.core.config import read_env_int
 from pyfarm.master.application import app, db
+from pyfarm.models.core.cache import LRUCache, clear_on_rollback
 from pyfarm.models.core.cfg import TABLE_TAG, MAX_TAG_LENGTH
+from pyfarm.models.core.functions import get_or_create_ids
 from pyfarm.models.core.types import id_column
 from pyfarm.models.core.mixins import UtilityMixins
 
+#: Maps the names of existing tags to their ids
+tag_ids = LRUCache(read_env_int("PYFARM_TAG_CACHE_SIZE", 1024))
+
+
 class Tag(db.Model, UtilityMixins):
     """
     Model which provides tagging for :class:`.Job` and class:`.Agent` objects
@@ -40,3 +48,60 @@ class Tag(db.Model, UtilityMixins):
 
     tag = db.Column(db.String(MAX_TAG_LENGTH), nullable=False,
                     doc=dedent("""The actual value of the tag"""))
+
+    @classmethod
+    def get_id(cls, name):
+        """
+        Returns the id of the tag ``name`` or None if it does not exist.
+        Ids of existing tags are cached in :data:`tag_ids` until a tag is
+        inserted, updated or deleted.  Missing tags are not cached so the
+        query, and the autoflush of pending tags, runs on every miss.
+        """
+        return tag_ids.lookup(
+            name, lambda: db.session.query(cls.id).filter_by(
+                tag=name).scalar(), store_none=False)
+
+    @classmethod
+    def get(cls, name, create=True):
+        """
+        Returns a :class:`.Tag` object matching ``name``.
+
+        :param str name:
+            the tag to look for
+
+        :param bool create:
+            if True and the tag does not exist, add it to the session
+            before returning
+        """
+        tag_id = cls.get_id(name)
+        tag = None if tag_id is None else cls.query.get(tag_id)
+
+        if tag is None and create:
+            tag = cls(tag=name)
+            db.session.add(tag)
+
+        return tag
+
+    @classmethod
+    def resolve(cls, names):
+        """
+        Returns a dictionary mapping each of ``names`` to the id of its
+        tag, creating any tags which do not exist yet in bulk.
+        """
+        return get_or_create_ids(cls, ("tag", ), names, cache=tag_ids)
+
+
+def tag_after_insert_delete(mapper, connection, tag):
+    """removes the cached id of ``tag``"""
+    tag_ids.pop(tag.tag)
+
+
+def tag_after_update(mapper, connection, tag):
+    """discards all cached ids since a tag may have been renamed"""
+    tag_ids.clear()
+
+
+event.listen(Tag, "after_insert", tag_after_insert_delete)
+event.listen(Tag, "after_update", tag_after_update)
+event.listen(Tag, "after_delete", tag_after_insert_delete)
+clear_on_rollback(tag_ids)
@@ -21,19 +21,37 @@ Task Models
 Models and interface classes related to tasks
 """
 
+from collections import namedtuple
+from datetime import datetime, timedelta
 from functools import partial
+from math import ceil, log
+from random import random
 from textwrap import dedent
 
 from sqlalchemy import event
+from sqlalchemy.orm import joinedload, object_session, Session
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.sql.expression import case
 
+from pyfarm.core.config import read_env_int, read_env_number
 from pyfarm.core.enums import WorkState
 from pyfarm.master.application import db
 from pyfarm.models.core.types import IDTypeAgent, IDTypeWork
+from pyfarm.models.core.statemap import state_maps
+from pyfarm.models.project import project_usage
 from pyfarm.models.core.functions import work_columns, repr_enum
 from pyfarm.models.core.cfg import (
     TABLE_JOB, TABLE_TASK, TABLE_AGENT, TABLE_TASK_DEPENDENCIES, TABLE_PROJECT)
 from pyfarm.models.core.mixins import (
-    ValidatePriorityMixin, WorkStateChangedMixin, UtilityMixins, ReprMixin)
+    ValidatePriorityMixin, WorkStateChangedMixin, UtilityMixins, ReprMixin,
+    KeysetPaginationMixin, StreamingMixin)
+
+TaskBatch = namedtuple("TaskBatch", ("job_id", "start", "end", "task_ids"))
+TaskBatch.__doc__ = """
+A contiguous run of queued tasks from a single job which should be
+assigned to one agent at the same time.  See :meth:`.Job.task_batches`
+and :meth:`Task.claim_batch`.
+"""
 
 TaskDependencies = db.Table(
     TABLE_TASK_DEPENDENCIES, db.metadata,
@@ -44,16 +62,40 @@ TaskDependencies = db.Table(
 
 
 class Task(db.Model, ValidatePriorityMixin, WorkStateChangedMixin, UtilityMixins,
-           ReprMixin):
+           ReprMixin, KeysetPaginationMixin, StreamingMixin):
     """
     Defines a task which a child of a :class:`Job`.  This table represents
     rows which contain the individual work unit(s) for a job.
     """
     __tablename__ = TABLE_TASK
+    __table_args__ = (
+        db.Index("%s_job_state_frame_idx" % TABLE_TASK,
+                 "job_id", "state", "frame"),
+        db.Index("%s_state_eligible_idx" % TABLE_TASK,
+                 "state", "next_eligible"),
+        db.Index("%s_lease_expires_idx" % TABLE_TASK, "lease_expires"),
+        db.Index("%s_keyset_idx" % TABLE_TASK, "job_id", "frame", "id"))
     STATE_ENUM = WorkState
     STATE_DEFAULT = STATE_ENUM.QUEUED
     REPR_COLUMNS = ("id", "state", "frame", "project")
+    KEYSET_COLUMNS = ("job_id", "frame", "id")
     REPR_CONVERT_COLUMN = {"state": partial(repr_enum, enum=STATE_ENUM)}
+    ACTIVE_STATES = (WorkState.ASSIGN, WorkState.RUNNING)
+    RETRY_DELAY = read_env_number("PYFARM_QUEUE_RETRY_DELAY", 30)
+    RETRY_MAX_DELAY = read_env_number("PYFARM_QUEUE_RETRY_MAX_DELAY", 3600)
+    RETRY_JITTER = read_env_number("PYFARM_QUEUE_RETRY_JITTER", .25)
+    RETRY_JITTER_BUCKETS = read_env_int(
+        "PYFARM_QUEUE_RETRY_JITTER_BUCKETS", 8)
+    LEASE_DURATION = read_env_number("PYFARM_TASK_LEASE_DURATION", 300)
+
+    # quick check of the configured data
+    assert RETRY_DELAY > 0, "$PYFARM_QUEUE_RETRY_DELAY must be > 0"
+    assert RETRY_MAX_DELAY >= RETRY_DELAY, \
+        "RETRY_DELAY must be <= RETRY_MAX_DELAY"
+    assert 0 <= RETRY_JITTER <= 1, "$PYFARM_QUEUE_RETRY_JITTER must be 0-1"
+    assert RETRY_JITTER_BUCKETS > 0, \
+        "$PYFARM_QUEUE_RETRY_JITTER_BUCKETS must be > 0"
+    assert LEASE_DURATION > 0, "$PYFARM_TASK_LEASE_DURATION must be > 0"
 
     # shared work columns
     id, state, priority, time_submitted, time_started, time_finished = \
@@ -63,6 +105,7 @@ class Task(db.Model, ValidatePriorityMixin, WorkStateChangedMixin, UtilityMixins
     agent_id = db.Column(IDTypeAgent, db.ForeignKey("%s.id" % TABLE_AGENT),
                          doc="Foreign key which stores :attr:`Job.id`")
     job_id = db.Column(IDTypeWork, db.ForeignKey("%s.id" % TABLE_JOB),
+                       nullable=False,
                        doc="Foreign key which stores :attr:`Job.id`")
     hidden = db.Column(db.Boolean, default=False,
                        doc=dedent("""
@@ -75,7 +118,39 @@ class Task(db.Model, ValidatePriorityMixin, WorkStateChangedMixin, UtilityMixins
                          running state."""))
     frame = db.Column(db.Float, nullable=False,
                       doc=dedent("""
-                      The frame the :class:`Task` will be executing."""))
+                      The frame the :class:`Task` will be executing.  For
+                      range encoded tasks this is the first frame in the
+                      range."""))
+    frame_end = db.Column(db.Float,
+                          doc=dedent("""
+                          The last frame of a range encoded task.  When this
+                          value is null the task covers :attr:`frame`
+                          only, otherwise it covers every frame between
+                          :attr:`frame` and this value counting by
+                          :attr:`frame_by`.  Range encoded tasks are split
+                          using :meth:`split` when only part of the range
+                          needs to change."""))
+    frame_by = db.Column(db.Float,
+                         doc=dedent("""
+                         The number of frames to count by between
+                         :attr:`frame` and :attr:`frame_end`.  Only used by
+                         range encoded tasks, defaults to 1."""))
+    next_eligible = db.Column(db.DateTime, nullable=False,
+                              default=datetime.now,
+                              doc=dedent("""
+                              The earliest time this task may be dispatched.
+                              When a task is requeued this is pushed into the
+                              future using an exponential backoff based on
+                              :attr:`attempts`, see :meth:`retry_delay`."""))
+    lease_expires = db.Column(db.DateTime,
+                              doc=dedent("""
+                              The time the agent's ownership of this task
+                              expires.  This is set when the task is assigned,
+                              extended by :meth:`renew_leases` when the agent
+                              checks in and cleared when the task is
+                              finished.  Tasks with expired leases are put
+                              back into the queue by
+                              :meth:`release_expired_leases`."""))
 
     # relationships
     parents = db.relationship("Task",
@@ -94,12 +169,417 @@ class Task(db.Model, ValidatePriorityMixin, WorkStateChangedMixin, UtilityMixins
                           relationship attribute which retrieves the
                           associated job for this task"""))
 
+    #: Query options for listing tasks along with their job and agent
+    #: in a single query
+    PROFILE_LIST = (joinedload("job"), joinedload("agent"))
+
+    @classmethod
+    def retry_delay(cls, attempts, jitter=None):
+        """
+        Returns the number of seconds a task should wait before being
+        dispatched again after ``attempts`` attempts.  The delay doubles
+        with each attempt, starting at :attr:`RETRY_DELAY` and never going
+        above :attr:`RETRY_MAX_DELAY`, and is then reduced by up to
+        :attr:`RETRY_JITTER` so requeued tasks are spread out over time.
+
+        :param int attempts:
+            the number of attempts made so far
+
+        :param float jitter:
+            value between 0 and 1 which selects how much jitter to apply,
+            a random value is used by default
+        """
+        if not attempts:
+            return 0
+
+        if jitter is None:
+            jitter = random()
+
+        exponent = min(attempts, cls.retry_attempts_limit()) - 1
+        delay = min(cls.RETRY_DELAY * 2 ** exponent, cls.RETRY_MAX_DELAY)
+        return delay * (1 - cls.RETRY_JITTER * jitter)
+
+    @classmethod
+    def retry_attempts_limit(cls):
+        """
+        Returns the number of attempts after which :meth:`retry_delay`
+        will always be based on :attr:`RETRY_MAX_DELAY`
+        """
+        return int(ceil(
+            log(cls.RETRY_MAX_DELAY / float(cls.RETRY_DELAY), 2))) + 1
+
+    @classmethod
+    def next_eligible_expression(cls, now=None):
+        """
+        Returns a SQL expression which computes :attr:`next_eligible` from
+        :attr:`attempts` so many tasks can be requeued with a single
+        ``UPDATE``.  Date arithmetic differs between databases so the
+        time for each number of attempts up to
+        :meth:`retry_attempts_limit` is computed here instead.  Each of
+        those is spread over :attr:`RETRY_JITTER_BUCKETS` jitter values
+        chosen by :attr:`id` so tasks which failed together are not all
+        requeued at the same moment.
+        """
+        now = now or datetime.now()
+        buckets = cls.RETRY_JITTER_BUCKETS
+        bucket = cls.id % buckets
+        offset = random()
+
+        def delayed(attempt):
+            whens = []
+            for index in range(buckets):
+                jitter = ((index + offset) % buckets) / float(buckets)
+                delay = cls.retry_delay(attempt, jitter)
+                whens.append((bucket == index, now + timedelta(seconds=delay)))
+            return case(whens[:-1], else_=whens[-1][1])
+
+        attempts = db.func.coalesce(cls.attempts, 0)
+        limit = cls.retry_attempts_limit()
+        whens = [(attempts <= 0, now)]
+        for attempt in range(1, limit):
+            whens.append((attempts == attempt, delayed(attempt)))
+
+        return case(whens, else_=delayed(limit))
+
+    @classmethod
+    def eligible(cls, now=None):
+        """
+        Returns a filter which matches queued tasks that can be dispatched
+        at ``now``, this is served by an index on :attr:`state` and
+        :attr:`next_eligible`.
+        """
+        return (cls.state == WorkState.QUEUED) & \
+               (cls.next_eligible <= (now or datetime.now()))
+
+    @staticmethod
+    def count_frames(frame, frame_end=None, frame_by=None):
+        """
+        Returns the number of frames covered by a task with the given
+        :attr:`frame`, :attr:`frame_end` and :attr:`frame_by` values.  This
+        is a static method so it can be used with column only queries.
+        """
+        if frame_end is None:
+            return 1
+        return int(round((frame_end - frame) / float(frame_by or 1))) + 1
+
+    @property
+    def frame_count(self):
+        """the number of frames this task covers"""
+        return self.count_frames(self.frame, self.frame_end, self.frame_by)
+
+    @property
+    def is_range(self):
+        """True if this task covers more than a single frame"""
+        return self.frame_count > 1
+
+    def frames(self):
+        """iterates over each frame this task covers"""
+        frame_by = self.frame_by or 1
+        for index in range(self.frame_count):
+            yield self.frame + index * frame_by
+
+    def copy_range(self, frame, frame_end):
+        """
+        Returns a new task, added to the session, which is a copy of this
+        task except for the frames it covers.  Task dependencies are not
+        copied.
+        """
+        task = Task(
+            job_id=self.job_id, project_id=self.project_id,
+            priority=self.priority, hidden=self.hidden, frame=frame,
+            frame_end=frame_end if frame_end != frame else None,
+            frame_by=self.frame_by if frame_end != frame else None,
+            time_submitted=self.time_submitted)
+        task.agent_id = self.agent_id
+        task.state = self.state
+        task.attempts = self.attempts
+        task.time_started = self.time_started
+        task.time_finished = self.time_finished
+        task.next_eligible = self.next_eligible
+        task.lease_expires = self.lease_expires
+        db.session.add(task)
+        return task
+
+    def split(self, start, end=None):
+        """
+        Splits a range encoded task so that this task only covers the
+        frames from ``start`` to ``end``.  Any frames before or after that
+        range are moved into new tasks with the same state and attributes
+        as this task.  Because this task keeps its id, batches and other
+        references to it remain valid for the frames which were asked for.
+
+        :param float start:
+            the first frame this task should cover
+
+        :param float end:
+            the last frame this task should cover, defaults to ``start``
+
+        :raises ValueError:
+            raised if ``start`` or ``end`` is outside of the range this
+            task covers
+
+        :return:
+            returns a list of the new tasks which were created
+        """
+        end = start if end is None else end
+        frame_by = float(self.frame_by or 1)
+        count = self.frame_count
+        first = int(round((start - self.frame) / frame_by))
+        last = int(round((end - self.frame) / frame_by))
+
+        if first < 0 or last >= count or first > last:
+            raise ValueError(
+                "%s-%s is not within the frames of %r" % (start, end, self))
+
+        created = []
+        if first > 0:
+            created.append(self.copy_range(
+                self.frame, self.frame + (first - 1) * frame_by))
+
+        if last < count - 1:
+            created.append(self.copy_range(
+                self.frame + (last + 1) * frame_by,
+                self.frame + (count - 1) * frame_by))
+
+        frame = self.frame
+        self.frame = frame + first * frame_by
+        if first == last:
+            self.frame_end = None
+            self.frame_by = None
+        else:
+            self.frame_end = frame + last * frame_by
+
+        return created
+
+    @classmethod
+    def claim_batch(cls, batch, agent_id):
+        """
+        Assigns every task in ``batch`` to ``agent_id`` using a single
+        ``UPDATE``.  The update only applies to tasks which are still
+        queued and unassigned, if any task in the batch was claimed by
+        something else in the mean time the whole batch is released again
+        and False is returned.
+
+        .. note::
+            This does not go through the session so :attr:`state` and
+            :attr:`agent_id` on any loaded :class:`Task` objects will
+            not reflect the change until they are expired or reloaded.
+
+        :param TaskBatch batch:
+            the batch of tasks to assign, typically produced by
+            :meth:`.Job.task_batches`
+
+        :param int agent_id:
+            the id of the agent the batch is being assigned to
+        """
+        savepoint = db.session.begin_nested()
+
+        # range encoded tasks which extend outside of the batch must
+        # be split first so only the frames in the batch are claimed
+        try:
+            for task in cls.query.filter(
+                    cls.id.in_(batch.task_ids), cls.frame_end != None,
+                    cls.state == WorkState.QUEUED):
+                start = max(task.frame, batch.start)
+                end = min(task.frame_end, batch.end)
+
+                # the task's range changed since the batch was produced
+                if start > end:
+                    savepoint.rollback()
+                    return False
+
+                if start != task.frame or end != task.frame_end:
+                    task.split(start, end)
+            db.session.flush()
+        except Exception:
+            savepoint.rollback()
+            raise
+
+        claimed = cls.query.filter(
+            cls.id.in_(batch.task_ids),
+            cls.state == WorkState.QUEUED,
+            cls.agent_id == None).update({
+                cls.agent_id: agent_id, cls.state: WorkState.ASSIGN,
+                cls.lease_expires: cls.new_lease()},
+                synchronize_session=False)
+
+        if claimed != len(batch.task_ids):
+            savepoint.rollback()
+            return False
+
+        savepoint.commit()
+        state_maps.pop(batch.job_id)
+
+        # imported here because the job model depends on this module
+        from pyfarm.models.job import Job
+
+        project_id, cpus = db.session.query(
+            Job.project_id, Job.cpus).filter(Job.id == batch.job_id).one()
+        project_usage.adjust_on_commit(
+            db.session, project_id, claimed, claimed * max(cpus or 0, 0))
+        return True
+
+    @classmethod
+    def new_lease(cls, duration=None):
+        """
+        Returns the expiration time of a lease starting now and lasting
+        ``duration`` seconds, :attr:`LEASE_DURATION` by default
+        """
+        return datetime.now() + timedelta(
+            seconds=duration or cls.LEASE_DURATION)
+
+    @classmethod
+    def renew_leases(cls, agent_id, duration=None):
+        """
+        Extends the lease of every assigned or running task on ``agent_id``
+        with a single ``UPDATE``, this should be called each time the agent
+        checks in.  Returns the number of leases renewed.
+
+        :param int agent_id:
+            the id of the agent to renew the leases for
+
+        :param int duration:
+            the length of the lease in seconds, defaults to
+            :attr:`LEASE_DURATION`
+        """
+        return cls.query.filter(
+            cls.agent_id == agent_id,
+            cls.state.in_(cls.ACTIVE_STATES)).update(
+                {cls.lease_expires: cls.new_lease(duration)},
+                synchronize_session=False)
+
+    @classmethod
+    def release_expired_leases(cls, now=None):
+        """
+        Puts every task whose lease has expired back into the queue with
+        a single ``UPDATE`` on the :attr:`lease_expires` index.  This is
+        meant to be run periodically so tasks on agents which stopped
+        checking in are released within one :attr:`LEASE_DURATION`.
+        Returns the number of tasks released.
+
+        .. note::
+            This does not go through the session so loaded tasks should
+            be expired or reloaded.
+        """
+        now = now or datetime.now()
+        expired = cls.query.filter(
+            cls.lease_expires < now, cls.state.in_(cls.ACTIVE_STATES))
+
+        # imported here because the job model depends on this module
+        from pyfarm.models.job import Job
+
+        # the tasks no longer count towards their project's quota, this is
+        # read first because the update can't return it
+        project_id = db.func.coalesce(cls.project_id, Job.project_id)
+        usage = expired.join(Job, Job.id == cls.job_id).with_entities(
+            project_id, db.func.count(cls.id),
+            db.func.sum(case([(Job.cpus > 0, Job.cpus)], else_=0))).group_by(
+            project_id).all()
+
+        released = expired.update({
+                cls.state: WorkState.QUEUED, cls.agent_id: None,
+                cls.lease_expires: None, cls.next_eligible: now,
+                cls.time_started: None},
+                synchronize_session=False)
+
+        if released:
+            state_maps.clear()
+            for project, tasks, cpus in usage:
+                project_usage.adjust_on_commit(
+                    db.session, project, -tasks, -(cpus or 0))
+
+        return released
+
     @staticmethod
     def agentChangedEvent(target, new_value, old_value, initiator):
         """set the state to ASSIGN whenever the agent is changed"""
         if new_value is not None:
             target.state = target.STATE_ENUM.ASSIGN
+            target.lease_expires = target.new_lease()
+        else:
+            target.lease_expires = None
+
+    @staticmethod
+    def leaseEvent(target, new_value, old_value, initiator):
+        """clears :attr:`lease_expires` once the task is no longer active"""
+        if new_value not in target.ACTIVE_STATES:
+            target.lease_expires = None
+
+    @staticmethod
+    def retryEvent(target, new_value, old_value, initiator):
+        """pushes back :attr:`next_eligible` when a failed task is requeued"""
+        if new_value == WorkState.QUEUED and old_value == WorkState.FAILED:
+            target.next_eligible = datetime.now() + timedelta(
+                seconds=target.retry_delay(target.attempts))
+
+    @staticmethod
+    def stateMapEvent(target, new_value, old_value, initiator):
+        """updates the cached :class:`.FrameStateMap` for the job, if any"""
+        statemap = state_maps.get(target.job_id)
+        if statemap is not None and target.frame is not None:
+            statemap.set(
+                target.frame, new_value,
+                frame_end=target.frame_end, frame_by=target.frame_by)
+
+
+def task_after_insert_delete(mapper, connection, task):
+    """discards the cached :class:`.FrameStateMap` for the task's job"""
+    state_maps.pop(task.job_id)
+
+
+def task_after_insert_update(mapper, connection, task):
+    """
+    Records the task if this flush moved it into or out of one of the
+    :attr:`Task.ACTIVE_STATES`.  The change to :data:`.project_usage` is
+    resolved by :func:`session_after_flush`.
+    """
+    history = get_history(task, "state")
+    if not history.added:
+        return
+
+    active = history.added[0] in Task.ACTIVE_STATES
+    old_value = history.deleted[0] if history.deleted else None
+    if active != (old_value in Task.ACTIVE_STATES):
+        object_session(task).info.setdefault("task_quota", []).append(
+            (task.job_id, task.project_id, 1 if active else -1))
+
+
+def session_after_flush(session, flush_context):
+    """
+    Records the quota changes of the tasks just flushed with
+    :meth:`.QuotaUsage.adjust_on_commit` so they only apply once the
+    transaction commits.  The project and cpus of the tasks' jobs are
+    read with one query.
+    """
+    changes = session.info.pop("task_quota", None)
+    if not changes:
+        return
+
+    # imported here because the job model depends on this module
+    from pyfarm.models.job import Job
+
+    job_ids = set(job_id for job_id, _, _ in changes if job_id is not None)
+    jobs = {}
+    if job_ids:
+        jobs = dict(
+            (row[0], (row[1], row[2])) for row in session.query(
+                Job.id, Job.project_id, Job.cpus).filter(Job.id.in_(job_ids)))
+
+    for job_id, project_id, delta in changes:
+        job_project_id, cpus = jobs.get(job_id, (None, 0))
+        if project_id is None:
+            project_id = job_project_id
+        project_usage.adjust_on_commit(
+            session, project_id, delta, delta * max(cpus or 0, 0))
 
 
 event.listen(Task.agent_id, "set", Task.agentChangedEvent)
+event.listen(Task.state, "set", Task.stateMapEvent)
+event.listen(Task.state, "set", Task.leaseEvent)
+event.listen(Task.state, "set", Task.retryEvent, active_history=True)
+event.listen(Task, "after_insert", task_after_insert_delete)
+event.listen(Task, "after_insert", task_after_insert_update)
+event.listen(Task, "after_update", task_after_insert_update)
+event.listen(Session, "after_flush", session_after_flush)
+event.listen(Task, "after_delete", task_after_insert_delete)
 event.listen(Task.state, "set", Task.stateChangedEvent)
@@ -21,24 +21,108 @@ Permissions
 Stores users and their roles in the database.
 """
 
+from collections import namedtuple
 from hashlib import sha256
 from datetime import datetime
 from textwrap import dedent
 
 from flask.ext.login import UserMixin
+from itsdangerous import BadData
+from sqlalchemy import event
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy.orm.attributes import get_history
 
+from pyfarm.core.config import read_env_int
 from pyfarm.core.logger import getLogger
 from pyfarm.core.enums import STRING_TYPES, PY3
 from pyfarm.master.application import app, db, login_serializer
+from pyfarm.models.core.cache import LRUCache, TTLCache
 from pyfarm.models.core.mixins import ReprMixin
-from pyfarm.models.core.functions import split_and_extend
+from pyfarm.models.core.functions import (
+    split_and_extend, expand_roles, chunked)
 from pyfarm.models.core.cfg import (
     TABLE_USERS_USER, TABLE_USERS_ROLE, TABLE_USERS_USER_ROLES,
     MAX_USERNAME_LENGTH, SHA256_ASCII_LENGTH, MAX_EMAILADDR_LENGTH,
-    MAX_ROLE_LENGTH, TABLE_USERS_PROJECTS, TABLE_PROJECT)
+    MAX_ROLE_LENGTH, TABLE_USERS_PROJECTS, TABLE_PROJECT,
+    TABLE_USERS_ROLE_CLOSURE)
 
 logger = getLogger("models.users")
 
+PermissionSnapshot = namedtuple(
+    "PermissionSnapshot", ("active", "roles", "expires"))
+PermissionSnapshot.__doc__ = """
+The effective permissions of a user at a point in time.  ``active`` is
+the result of :meth:`User.is_active`, ``roles`` is a frozenset of the
+names of the user's roles and ``expires`` is the earliest upcoming user
+or role expiration, after which the snapshot must be rebuilt.
+"""
+
+#: Cache of :class:`PermissionSnapshot` objects keyed by user id
+permission_snapshots = LRUCache(
+    read_env_int("PYFARM_PERMISSION_CACHE_SIZE", 1024))
+
+#: Cache of :class:`UserSnapshot` objects keyed by auth token
+auth_tokens = TTLCache(
+    read_env_int("PYFARM_AUTH_TOKEN_CACHE_SIZE", 4096),
+    ttl=read_env_int("PYFARM_AUTH_TOKEN_CACHE_TTL", 60))
+
+
+def roles_match(roles, allowed=None, required=None):
+    """
+    Returns True if the set of role names in ``roles`` grants any of the
+    ``allowed`` roles and every one of the ``required`` roles.  A role is
+    granted by holding it or one of its ancestors, for example holding
+    `root` grants `root.admin`, see :func:`.expand_roles`.
+    """
+    if allowed and roles.isdisjoint(expand_roles(allowed)):
+        return False
+
+    if required:
+        if isinstance(required, STRING_TYPES):
+            required = [required]
+
+        for role in required:
+            if roles.isdisjoint(expand_roles([role])):
+                return False
+
+    return True
+
+
+class UserSnapshot(UserMixin):
+    """
+    Lightweight, read only, copy of an authenticated :class:`User` which
+    is produced by :meth:`User.from_auth_token`.  It supports the same
+    authentication and permission checks as :class:`User` without needing
+    a database session.
+    """
+    def __init__(self, user):
+        self.id = user.id
+        self.username = user.username
+        self.email = user.email
+        self.permission_snapshot = user.permissions()
+
+    def __repr__(self):
+        return "UserSnapshot(id=%r, username=%r)" % (self.id, self.username)
+
+    def get_id(self):
+        return self.id
+
+    def permissions(self):
+        """
+        Returns the :class:`PermissionSnapshot` taken when this snapshot
+        was created, see :meth:`User.permissions`
+        """
+        return self.permission_snapshot
+
+    def is_active(self):
+        """returns true if the user and the roles it belongs to are active"""
+        return self.permissions().active
+
+    def has_roles(self, allowed=None, required=None):
+        """checks the provided arguments against the roles assigned"""
+        return roles_match(self.permissions().roles, allowed, required)
+
+
 # roles the user is a member of
 UserRoles = db.Table(
     TABLE_USERS_USER_ROLES,
@@ -47,6 +131,16 @@ UserRoles = db.Table(
     db.Column("role_id", db.Integer,
               db.ForeignKey("%s.id" % TABLE_USERS_ROLE)))
 
+# ancestor/descendant pairs of roles, for example `root` is an ancestor
+# of `root.admin`, including a pair of each role with itself
+RoleClosure = db.Table(
+    TABLE_USERS_ROLE_CLOSURE,
+    db.Column("ancestor_id", db.Integer,
+              db.ForeignKey("%s.id" % TABLE_USERS_ROLE), primary_key=True),
+    db.Column("descendant_id", db.Integer,
+              db.ForeignKey("%s.id" % TABLE_USERS_ROLE), primary_key=True,
+              index=True))
+
 # projects the user is a member of
 UserProjects = db.Table(
     TABLE_USERS_PROJECTS,
@@ -123,13 +217,74 @@ class User(db.Model, UserMixin, ReprMixin):
             username=username,
             password=cls.hash_password(password),
             email=email)
-        user.roles.extend(map(Role.create, roles))
+
+        # resolve all of the role names at once
+        names = [role for role in roles if not isinstance(role, Role)]
+        if names:
+            role_ids = list(Role.create_many(names).values())
+            user.roles.extend(Role.query.filter(Role.id.in_(role_ids)))
+        user.roles.extend(role for role in roles if isinstance(role, Role))
 
         # commit and return
         db.session.add(user)
         db.session.commit()
         return user
 
+    @classmethod
+    def create_many(cls, users):
+        """
+        Creates many users, and any roles they need, in a single
+        transaction using bulk statements instead of one round trip per
+        user and role.  This is intended for bulk provisioning such as
+        synchronizing users from a directory service.
+
+        :param list users:
+            list of dictionaries containing ``username`` and ``password``
+            and optionally ``email`` and ``roles``, which may be a string
+            or a list of role names
+
+        :return:
+            returns a dictionary of ``{username: id}`` for the new users
+        """
+        users = list(users)
+        roles = {}
+        for user in users:
+            names = user.get("roles") or []
+            if isinstance(names, STRING_TYPES):
+                names = [names]
+            roles[user["username"]] = names
+
+        try:
+            role_ids = Role.create_many(
+                set(name for names in roles.values() for name in names))
+
+            table = cls.__table__
+            for chunk in chunked(users):
+                db.session.execute(table.insert(), [
+                    {"username": user["username"],
+                     "password": cls.hash_password(user["password"]),
+                     "email": user.get("email")} for user in chunk])
+
+            user_ids = {}
+            for chunk in chunked(roles):
+                user_ids.update(db.session.execute(
+                    db.select([table.c.username, table.c.id]).where(
+                        table.c.username.in_(chunk))).fetchall())
+
+            user_roles = [
+                {"user_id": user_ids[username], "role_id": role_ids[name]}
+                for username, names in roles.items() for name in set(names)]
+            for chunk in chunked(user_roles):
+                db.session.execute(UserRoles.insert(), chunk)
+
+            db.session.commit()
+
+        except Exception:
+            db.session.rollback()
+            raise
+
+        return user_ids
+
     @classmethod
     def get(cls, id_or_username):
         """Get a user model either by id or by the user's username"""
@@ -157,6 +312,51 @@ class User(db.Model, UserMixin, ReprMixin):
     def get_auth_token(self):
         return login_serializer.dumps([str(self.id), self.password])
 
+    @classmethod
+    def from_auth_token(cls, token, max_age=None):
+        """
+        Returns a :class:`UserSnapshot` for the user the ``token`` produced
+        by :meth:`get_auth_token` belongs to, or None if the token is not
+        valid.  Results are cached in :data:`auth_tokens` so repeated
+        requests with the same token don't query the database.  Cached
+        entries are discarded when the user's password, active state,
+        expiration or roles change and never outlive the expiration of
+        the user or its roles.
+
+        :param int max_age:
+            if provided, the maximum age of the token in seconds.  Tokens
+            checked against a maximum age bypass the cache entirely since
+            a cached result would skip the age check.
+        """
+        if max_age is None:
+            snapshot = auth_tokens.get(token)
+            if snapshot is not None:
+                return snapshot
+
+        try:
+            if max_age is None:
+                user_id, password = login_serializer.loads(token)
+            else:
+                user_id, password = login_serializer.loads(
+                    token, max_age=max_age)
+        except (BadData, TypeError, ValueError):
+            return None
+
+        user = cls.get(user_id)
+        if user is None or user.password != password:
+            return None
+
+        snapshot = UserSnapshot(user)
+        ttl = auth_tokens.ttl
+        expires = snapshot.permissions().expires
+        if expires is not None:
+            remaining = expires - datetime.now()
+            ttl = min(ttl, remaining.total_seconds())
+
+        if max_age is None:
+            auth_tokens.put(token, snapshot, ttl=ttl)
+        return snapshot
+
     def get_id(self):
         return self.id
 
@@ -165,52 +365,81 @@ class User(db.Model, UserMixin, ReprMixin):
         assert isinstance(password, STRING_TYPES)
         return self.hash_password(password) == self.password
 
+    def permissions(self):
+        """
+        Returns a :class:`PermissionSnapshot` for this user.  Snapshots are
+        cached until the user or one of its roles changes or until the
+        earliest expiration of the user or its roles is reached.
+        """
+        now = datetime.now()
+        snapshot = permission_snapshots.get(self.id)
+
+        if snapshot is None or (
+                snapshot.expires is not None and now >= snapshot.expires):
+            roles = list(self.roles)
+            expirations = [
+                expiration for expiration in
+                [self.expiration] + [role.expiration for role in roles]
+                if expiration is not None and expiration >= now]
+
+            active = bool(
+                self.active and
+                (self.expiration is None or now <= self.expiration) and
+                all(role.is_active() for role in roles))
+            snapshot = PermissionSnapshot(
+                active, frozenset(role.name for role in roles),
+                min(expirations) if expirations else None)
+
+            # users which have not been written yet don't have an id
+            if self.id is not None:
+                permission_snapshots.put(self.id, snapshot)
+
+        return snapshot
+
     def is_active(self):
         """returns true if the user and the roles it belongs to are active"""
         logger.debug("%(self)s.is_active()" % locals())
-        now = datetime.now()
-
-        # user is not active
-        if not self.active:
-            return False
-
-        # user has expired
-        if self.expiration is not None and now > self.expiration:
-            return False
-
-        # TODO: there's probably some way to cache this information
-        return all(role.is_active() for role in self.roles)
+        return self.permissions().active
 
     def has_roles(self, allowed=None, required=None):
         """checks the provided arguments against the roles assigned"""
         if not allowed and not required:
             return True
 
-        allowed = split_and_extend(allowed)
-        required = split_and_extend(required)
-
         logger.debug(
             "%(self)s.has_roles(allowed=%(allowed)s, required=%(required)s)"
             % locals())
 
-        if allowed:
-            # Ask the database if the user has any of the allowed roles.  For
-            # smaller numbers of roles this is very slightly slower with
-            # SQLite in :memory: but is a good amount faster over the network
-            # or with large role sets.
-            return bool(
-                User.query.filter(
-                    User.roles.any(
-                        Role.name.in_(allowed))
-                ).filter(User.id == self.id).count())
-
-        if required:
-            # Ask the database for all roles matching ``required``.  In order
-            # for this to return True is the number of entries found must
-            # be equal to len(required).
-            count = Role.query.filter(
-                Role.name.in_(required)).filter(User.id == self.id).count()
-            return count == len(required)
+        return roles_match(self.permissions().roles, allowed, required)
+
+    @classmethod
+    def with_roles(cls, names):
+        """
+        Returns a query for the users holding any of the roles in ``names``
+        either directly or through an ancestor role, for example a user
+        with the `root` role is returned for `root.admin`.  This is an
+        indexed join through :data:`RoleClosure` so only roles which exist
+        in the database are considered.
+        """
+        role = aliased(Role)
+        granted = db.select([RoleClosure.c.ancestor_id]).where(
+            RoleClosure.c.descendant_id == role.id).where(
+            role.name.in_(list(names)))
+        return cls.query.filter(cls.roles.any(Role.id.in_(granted)))
+
+    @staticmethod
+    def permissionsChangedEvent(target, value, *args):
+        """
+        discards the cached :class:`PermissionSnapshot` and any cached
+        :class:`UserSnapshot` objects for the user
+        """
+        # users without an id, such as those being constructed, can't
+        # have anything cached
+        if target.id is None:
+            return
+
+        permission_snapshots.pop(target.id)
+        auth_tokens.discard(lambda token, snapshot: snapshot.id == target.id)
 
 
 class Role(db.Model):
@@ -239,6 +468,22 @@ class Role(db.Model):
 
     description = db.Column(db.Text, doc="Human description of the role.")
 
+    ancestors = db.relationship(
+        "Role", secondary=RoleClosure, lazy="dynamic", viewonly=True,
+        primaryjoin=id == RoleClosure.c.descendant_id,
+        secondaryjoin=id == RoleClosure.c.ancestor_id,
+        doc=dedent("""
+        Roles which grant this role, for example `root` for
+        `root.admin`.  This includes the role itself."""))
+
+    descendants = db.relationship(
+        "Role", secondary=RoleClosure, lazy="dynamic", viewonly=True,
+        primaryjoin=id == RoleClosure.c.ancestor_id,
+        secondaryjoin=id == RoleClosure.c.descendant_id,
+        doc=dedent("""
+        Roles which this role grants, for example `root.admin` for
+        `root`.  This includes the role itself."""))
+
     @classmethod
     def create(cls, name, description=None):
         """
@@ -257,7 +502,144 @@ class Role(db.Model):
 
         return role
 
+    @classmethod
+    def create_many(cls, names):
+        """
+        Returns a dictionary of ``{name: id}`` for each role in ``names``.
+        Existing roles are found with a single ``IN`` query, roles which
+        do not exist are inserted with one bulk statement and
+        :data:`RoleClosure` is updated for them.  The session is flushed
+        but not committed.
+        """
+        names = set(names)
+        table = cls.__table__
+        db.session.flush()
+
+        role_ids = {}
+        for chunk in chunked(names):
+            role_ids.update(db.session.execute(
+                db.select([table.c.name, table.c.id]).where(
+                    table.c.name.in_(chunk))).fetchall())
+
+        missing = [name for name in names if name not in role_ids]
+        if missing:
+            db.session.execute(
+                table.insert(), [{"name": name} for name in missing])
+
+            created = []
+            for chunk in chunked(missing):
+                created.extend(db.session.execute(
+                    db.select([table.c.id, table.c.name]).where(
+                        table.c.name.in_(chunk))).fetchall())
+
+            update_role_closure(db.session.connection(), created)
+            role_ids.update((name, role_id) for role_id, name in created)
+
+        return role_ids
+
     def is_active(self):
         if self.expiration is None:
             return self.active
         return self.active and datetime.now() < self.expiration
+
+    @staticmethod
+    def permissionsChangedEvent(target, value, *args):
+        """
+        Discards every cached :class:`PermissionSnapshot` and
+        :class:`UserSnapshot`.  Roles change rarely and may be shared by
+        many users so it's simpler to start over than to find the users
+        affected.
+        """
+        permission_snapshots.clear()
+        auth_tokens.clear()
+
+
+def update_role_closure(connection, roles):
+    """
+    Rebuilds the rows in :data:`RoleClosure` which involve ``roles``.  This
+    is called when roles are created or renamed so the hierarchy of dotted
+    role names does not need to be worked out when permissions are checked.
+
+    :param list roles:
+        list of ``(id, name)`` tuples for the roles which changed
+    """
+    if not roles:
+        return
+
+    role_ids = [role_id for role_id, name in roles]
+    table = Role.__table__
+    connection.execute(RoleClosure.delete().where(
+        RoleClosure.c.ancestor_id.in_(role_ids) |
+        RoleClosure.c.descendant_id.in_(role_ids)))
+
+    pairs = set()
+    for role_id, name in roles:
+        ancestors = connection.execute(
+            db.select([table.c.id]).where(
+                table.c.name.in_(list(split_and_extend([name])))))
+        pairs.update((row[0], role_id) for row in ancestors)
+
+        # LIKE treats `_` as a wildcard so the names are checked again
+        descendants = connection.execute(
+            db.select([table.c.id, table.c.name]).where(
+                table.c.name.like(name + ".%")))
+        pairs.update(
+            (role_id, row[0]) for row in descendants
+            if row[1].startswith(name + "."))
+
+    connection.execute(RoleClosure.insert(), [
+        {"ancestor_id": ancestor, "descendant_id": descendant}
+        for ancestor, descendant in pairs])
+
+
+def role_after_insert(mapper, connection, role):
+    """adds the new role to :data:`RoleClosure`"""
+    update_role_closure(connection, [(role.id, role.name)])
+
+
+def role_after_update(mapper, connection, role):
+    """updates :data:`RoleClosure` when a role is renamed"""
+    if get_history(role, "name").has_changes():
+        update_role_closure(connection, [(role.id, role.name)])
+
+
+def role_before_delete(mapper, connection, role):
+    """removes the role from :data:`RoleClosure`"""
+    connection.execute(RoleClosure.delete().where(
+        (RoleClosure.c.ancestor_id == role.id) |
+        (RoleClosure.c.descendant_id == role.id)))
+
+
+def user_after_delete(mapper, connection, user):
+    """discards the cached permissions for the user"""
+    User.permissionsChangedEvent(user, None)
+
+
+def role_after_delete(mapper, connection, role):
+    """discards all cached permissions"""
+    Role.permissionsChangedEvent(role, None)
+
+
+def session_after_rollback(session):
+    """
+    discards all cached permissions since they may have been built from
+    changes which were just rolled back
+    """
+    permission_snapshots.clear()
+    auth_tokens.clear()
+
+
+for attribute in (User.active, User.expiration, User.password):
+    event.listen(attribute, "set", User.permissionsChangedEvent)
+
+for attribute in (Role.active, Role.expiration, Role.name):
+    event.listen(attribute, "set", Role.permissionsChangedEvent)
+
+event.listen(User.roles, "append", User.permissionsChangedEvent)
+event.listen(User.roles, "remove", User.permissionsChangedEvent)
+event.listen(User, "after_delete", user_after_delete)
+event.listen(Role, "after_delete", role_after_delete)
+event.listen(Role, "after_insert", role_after_insert)
+event.listen(Role, "after_update", role_after_update)
+event.listen(Role, "before_delete", role_before_delete)
+event.listen(Session, "after_rollback", session_after_rollback)
@@ -0,0 +1,100 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2013 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from .utcore import unittest
+from pyfarm.models.core.cache import LRUCache, TTLCache
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_get_put(self):
+        cache = LRUCache(maxsize=2)
+        self.assertEqual(cache.put("a", 1), 1)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("b", 2), 2)
+        self.assertIn("a", cache)
+        self.assertEqual(len(cache), 1)
+
+    def test_eviction(self):
+        cache = LRUCache(maxsize=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertIn("c", cache)
+
+    def test_counters(self):
+        cache = LRUCache()
+        cache.put("a", 1)
+        cache.get("a")
+        cache.get("b")
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_discard(self):
+        cache = LRUCache()
+        for value in range(4):
+            cache.put(value, value)
+        cache.discard(lambda key, value: value % 2)
+        self.assertEqual(list(cache.data), [0, 2])
+
+    def test_lookup(self):
+        cache = LRUCache()
+        calls = []
+
+        def function():
+            calls.append(1)
+
+        self.assertIsNone(cache.lookup("a", function))
+        self.assertIsNone(cache.lookup("a", function))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.lookup("b", lambda: 2), 2)
+
+    def test_lookup_store_none(self):
+        cache = LRUCache()
+        self.assertIsNone(cache.lookup("a", lambda: None, store_none=False))
+        self.assertNotIn("a", cache)
+        self.assertEqual(cache.lookup("b", lambda: 2, store_none=False), 2)
+        self.assertIn("b", cache)
+
+    def test_pop_clear(self):
+        cache = LRUCache()
+        cache.put("a", 1)
+        self.assertEqual(cache.pop("a"), 1)
+        self.assertIsNone(cache.pop("a"))
+        cache.put("b", 2)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+
+class TestTTLCache(unittest.TestCase):
+    def test_ttl(self):
+        cache = TTLCache(ttl=60)
+        cache.put("a", 1)
+        cache.put("b", 2, ttl=-1)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertNotIn("b", cache)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_pop_discard(self):
+        cache = TTLCache()
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.pop("a"), 1)
+        cache.discard(lambda key, value: value == 2)
+        self.assertEqual(len(cache), 0)
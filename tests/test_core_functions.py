@@ -21,7 +21,7 @@ from sqlalchemy import Column, Integer, DateTime
 from .utcore import ModelTestCase
 from pyfarm.models.core.types import IDTypeWork, WorkStateEnum
 from pyfarm.models.core.functions import (
-    modelfor, getuuid, work_columns, split_and_extend)
+    modelfor, getuuid, work_columns, split_and_extend, expand_roles)
 
 
 class Foo(object):
@@ -77,3 +77,9 @@ class TestFunctionsModule(ModelTestCase):
             set(["a", "a.b", "a.b.c", "a.b.c.d"]))
         self.assertIsNone(split_and_extend(None))
 
+    def test_expand_roles(self):
+        expanded = expand_roles(["a.b", "c"])
+        self.assertEqual(expanded, frozenset(["a", "a.b", "c"]))
+        self.assertIs(expand_roles(["c", "a.b"]), expanded)
+        self.assertEqual(expand_roles("a.b"), frozenset(["a", "a.b"]))
+        self.assertIsNone(expand_roles(None))
@@ -15,7 +15,7 @@
 # limitations under the License.
 
 from random import choice
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from sqlalchemy import event
 from sqlalchemy.types import Integer, DateTime
@@ -27,7 +27,7 @@ from pyfarm.models.core.cfg import TABLE_PREFIX
 from pyfarm.models.core.types import IPv4Address, WorkStateEnum
 from pyfarm.models.core.mixins import (
     WorkStateChangedMixin, ValidatePriorityMixin, UtilityMixins,
-    ValidateWorkStateMixin)
+    ValidateWorkStateMixin, KeysetPaginationMixin)
 
 
 rand_state = lambda: choice(list(WorkState))
@@ -64,6 +64,21 @@ class MixinModel(db.Model, UtilityMixins):
         return column
 
 
+class KeysetModel(db.Model, KeysetPaginationMixin):
+    __tablename__ = "%s_keyset_mixin_test" % TABLE_PREFIX
+    KEYSET_COLUMNS = ("a", "b", "id")
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    a = db.Column(db.Integer, nullable=False)
+    b = db.Column(DateTime, nullable=False)
+
+
+class KeysetNullModel(db.Model, KeysetPaginationMixin):
+    __tablename__ = "%s_keyset_null_mixin_test" % TABLE_PREFIX
+    KEYSET_COLUMNS = ("a", "id")
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    a = db.Column(db.Integer)
+
+
 class TestMixins(ModelTestCase):
     def test_state_validation(self):
         model = ValidationModel()
@@ -142,4 +157,44 @@ class TestMixins(ModelTestCase):
         self.assertDictEqual(
             {"a": "INTEGER", "b": "VARCHAR(512)",
              "id": "INTEGER", "c": "IPv4Address"},
-            model.to_schema())
\ No newline at end of file
+            model.to_schema())
+
+    def test_keyset_token(self):
+        values = [1, datetime(2014, 1, 2, 3, 4, 5, 6), 3]
+        token = KeysetModel.encode_keyset_token(values, reverse=True)
+        self.assertEqual(
+            KeysetModel.decode_keyset_token(token), (values, True))
+
+        values[1] = values[1].replace(microsecond=0)
+        token = KeysetModel.encode_keyset_token(values)
+        self.assertEqual(
+            KeysetModel.decode_keyset_token(token), (values, False))
+
+        for token in ("foo", KeysetModel.encode_keyset_token([1])):
+            with self.assertRaises(ValueError):
+                KeysetModel.decode_keyset_token(token)
+
+    def test_keyset_page(self):
+        now = datetime.now()
+        for i in range(25):
+            db.session.add(KeysetModel(
+                a=i % 3, b=now + timedelta(seconds=i % 2)))
+        db.session.commit()
+
+        expected = KeysetModel.query.order_by(
+            KeysetModel.a, KeysetModel.b, KeysetModel.id).all()
+
+        for reverse in (False, True):
+            pages = []
+            rows, token = KeysetModel.keyset_page(limit=7, reverse=reverse)
+            pages.extend(rows)
+            while token is not None:
+                rows, token = KeysetModel.keyset_page(token=token, limit=7)
+                pages.extend(rows)
+
+            self.assertEqual(
+                pages, list(reversed(expected)) if reverse else expected)
+
+    def test_keyset_nullable(self):
+        with self.assertRaises(ValueError):
+            KeysetNullModel.keyset_page()
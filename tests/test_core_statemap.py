@@ -0,0 +1,64 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2013 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from .utcore import unittest
+from pyfarm.core.enums import WorkState
+from pyfarm.models.core import statemap
+from pyfarm.models.core.statemap import FrameStateMap
+
+
+class TestFrameStateMap(unittest.TestCase):
+    def setUp(self):
+        self.statemap = FrameStateMap.from_rows(1, 10, 1, [
+            (1, 4, 1, WorkState.DONE),
+            (5, None, None, WorkState.FAILED),
+            (6, 10, 2, WorkState.QUEUED),
+            (7, 9, 2, WorkState.FAILED)])
+
+    def test_size(self):
+        self.assertEqual(len(self.statemap), 10)
+        self.assertEqual(self.statemap.nbytes, 10)
+        self.assertEqual(FrameStateMap(0, 99999, 1).nbytes, 100000)
+
+    def test_get(self):
+        self.assertEqual(self.statemap.get(1), WorkState.DONE)
+        self.assertEqual(self.statemap.get(5), WorkState.FAILED)
+        self.assertEqual(self.statemap.get(6), WorkState.QUEUED)
+        self.assertIsNone(self.statemap.get(11))
+
+    def test_set_clipped(self):
+        self.statemap.set(-3, WorkState.RUNNING, frame_end=20, frame_by=2)
+        self.assertEqual(self.statemap.get(1), WorkState.RUNNING)
+        self.assertEqual(self.statemap.get(2), WorkState.DONE)
+        self.assertEqual(self.statemap.get(9), WorkState.RUNNING)
+
+    def test_counts(self):
+        self.assertEqual(self.statemap.counts(), {
+            WorkState.DONE: 4, WorkState.FAILED: 3, WorkState.QUEUED: 3})
+
+    def test_ranges(self):
+        self.assertEqual(
+            self.statemap.ranges(WorkState.FAILED),
+            [(5, 5), (7, 7), (9, 9)])
+        self.assertEqual(self.statemap.ranges(WorkState.DONE), [(1, 4)])
+
+    def test_without_numpy(self):
+        numpy, statemap.numpy = statemap.numpy, None
+        try:
+            self.test_counts()
+            self.test_ranges()
+        finally:
+            statemap.numpy = numpy
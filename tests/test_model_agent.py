@@ -19,7 +19,7 @@ import uuid
 
 from sqlalchemy.exc import DatabaseError, IntegrityError
 
-from .utcore import ModelTestCase, unittest
+from .utcore import ModelTestCase, QueryCounter, unittest
 from pyfarm.core.enums import AgentState
 from pyfarm.master.application import db
 from pyfarm.models.software import Software
@@ -118,6 +118,25 @@ class TestAgentSoftware(AgentTestCase, ModelTestCase):
             agent_software.sort()
             self.assertListEqual(agent_software, software_objects)
 
+    def test_with_software(self):
+        agents = list(self.models(limit=3))
+        for agent, version in zip(agents, ("2013", "2014.5", "2016")):
+            agent.add_software([("maya", version), "nuke"])
+        db.session.commit()
+
+        def hosts(*requirements):
+            return set(agent.hostname for agent in
+                       Agent.with_software(requirements))
+
+        self.assertEqual(
+            hosts("maya >= 2014"),
+            set(agent.hostname for agent in agents[1:]))
+        self.assertEqual(
+            hosts("maya >=2014,<2016", "nuke"), set([agents[1].hostname]))
+        self.assertEqual(hosts(("maya", "2013.0")), set([agents[0].hostname]))
+        self.assertEqual(len(hosts("maya")), 3)
+        self.assertEqual(hosts("houdini"), set())
+
     def test_software_unique(self):
         for agent_foobar in self.models(limit=1):
             softwareA = Software()
@@ -136,6 +155,33 @@ class TestAgentSoftware(AgentTestCase, ModelTestCase):
 
 
 class TestAgentTags(AgentTestCase, ModelTestCase):
+    def test_profile_list(self):
+        for agent in self.models(limit=20):
+            agent.add_tags(["a", "b", agent.hostname])
+            agent.add_software(["foo"])
+        db.session.commit()
+        db.session.remove()
+
+        with QueryCounter() as queries:
+            agents = Agent.query.options(*Agent.PROFILE_LIST).all()
+            for agent in agents:
+                self.assertEqual(len(agent.tags_list), 3)
+                self.assertEqual(len(agent.software_list), 1)
+                self.assertEqual(agent.projects_list, [])
+
+        self.assertEqual(len(agents), 20)
+        self.assertEqual(queries.count, 4)
+
+    def test_add_tags_and_software(self):
+        for agent_foobar in self.models(limit=1):
+            self.assertEqual(agent_foobar.add_tags(["foo", "bar"]), 2)
+            self.assertEqual(agent_foobar.add_tags(["foo"]), 0)
+            self.assertEqual(agent_foobar.add_software([("foo", "1.0")]), 1)
+            db.session.commit()
+            self.assertEqual(
+                sorted(tag.tag for tag in agent_foobar.tags), ["bar", "foo"])
+            self.assertEqual(agent_foobar.software.first().version, "1.0")
+
     def test_tags_validation(self):
         for agent_foobar in self.models(limit=1):
             tag = Tag()
@@ -197,6 +243,19 @@ class TestAgentModel(AgentTestCase, ModelTestCase):
             self.assertEqual(result.cpu_allocation, agent.cpu_allocation)
             self.assertEqual(result.ram_allocation, agent.ram_allocation)
 
+    def test_keyset_page(self):
+        agents = list(self.models(limit=10))
+        for index, agent in enumerate(agents):
+            agent.hostname = "host%02d" % (index % 4)
+            agent.port = Agent.MIN_PORT + index
+            if index % 2:
+                agent.remote_ip = None
+        db.session.add_all(agents)
+        db.session.commit()
+
+        self.assertKeysetPages(
+            Agent, Agent.query.order_by(Agent.hostname, Agent.id).all(), 3)
+
     def test_basic_insert_nonunique(self):
         for (hostname, ip, port, cpus, ram, state,
              ram_allocation, cpu_allocation) in self.modelArguments(limit=1):
@@ -0,0 +1,101 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2013 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime, timedelta
+from textwrap import dedent
+
+from .utcore import ModelTestCase
+from pyfarm.core.enums import WorkState, JobTypeLoadMode
+from pyfarm.master.application import db
+from pyfarm.models.job import Job, JobDependencies
+from pyfarm.models.jobtype import JobType
+from pyfarm.models.task import Task
+from pyfarm.models.archive import (
+    JobArchive, TaskArchive, JobTagAssociationArchive, archive_jobs)
+
+
+class TestArchive(ModelTestCase):
+    def create_job(self, jobtype, state, finished=None):
+        job = Job(job_type=jobtype, data={"a": 1})
+        for frame in (1, 2):
+            Task(job=job, frame=frame, state=state)
+        job.state = state
+        db.session.add(job)
+        db.session.flush()
+        job.add_tags(["foo"])
+        if finished is not None:
+            job.time_finished = finished
+        return job
+
+    def test_archive_jobs(self):
+        jobtype = JobType(
+            name="foo", classname="Foobar", mode=JobTypeLoadMode.OPEN,
+            code=dedent("""
+            class Foobar(JobType):
+                pass"""))
+        old = datetime.now() - timedelta(days=10)
+        archived = [
+            self.create_job(jobtype, WorkState.DONE, finished=old),
+            self.create_job(jobtype, WorkState.FAILED, finished=old)]
+        recent = self.create_job(jobtype, WorkState.DONE)
+        running = self.create_job(jobtype, WorkState.RUNNING)
+        running.parents.append(archived[0])
+        db.session.commit()
+        archived_ids = set(job.id for job in archived)
+
+        totals = archive_jobs(age=5, chunk_size=1)
+        self.assertEqual(totals[Job.__table__.name], 2)
+        self.assertEqual(totals[Task.__table__.name], 4)
+        self.assertEqual(totals[JobDependencies.name], 1)
+
+        self.assertEqual(
+            set(job.id for job in Job.query), set([recent.id, running.id]))
+        self.assertEqual(Task.query.count(), 4)
+        self.assertEqual(
+            set(row.id for row in db.session.execute(JobArchive.select())),
+            archived_ids)
+
+        rows = list(db.session.execute(TaskArchive.select()))
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(set(row.job_id for row in rows), archived_ids)
+        self.assertEqual(
+            len(list(db.session.execute(JobTagAssociationArchive.select()))),
+            2)
+
+        row = db.session.execute(JobArchive.select()).first()
+        self.assertEqual(row.data, {"a": 1})
+        self.assertEqual(archive_jobs(age=5), {})
+
+    def test_archive_failed_parent(self):
+        jobtype = JobType(
+            name="foo", classname="Foobar", mode=JobTypeLoadMode.OPEN,
+            code=dedent("""
+            class Foobar(JobType):
+                pass"""))
+        old = datetime.now() - timedelta(days=10)
+        failed = self.create_job(jobtype, WorkState.FAILED, finished=old)
+        child = self.create_job(jobtype, WorkState.QUEUED)
+        child.parents.append(failed)
+        db.session.commit()
+        child_id = child.id
+        self.assertEqual(child.waiting_parents, 1)
+
+        totals = archive_jobs(age=5)
+        self.assertEqual(totals[JobDependencies.name], 1)
+        db.session.expire_all()
+        child = Job.query.get(child_id)
+        self.assertEqual(child.waiting_parents, 0)
+        self.assertEqual(child.parents, [])
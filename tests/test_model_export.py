@@ -0,0 +1,102 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2013 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import csv
+import gzip
+import json
+from datetime import datetime, timedelta
+from io import BytesIO, StringIO
+from textwrap import dedent
+
+from .utcore import ModelTestCase
+from pyfarm.core.enums import WorkState, JobTypeLoadMode
+from pyfarm.master.application import db
+from pyfarm.models.job import Job
+from pyfarm.models.jobtype import JobType
+from pyfarm.models.project import Project
+from pyfarm.models.task import Task
+from pyfarm.models.export import export_jobs, export_tasks, CSV
+
+
+class TestExport(ModelTestCase):
+    def setUp(self):
+        super(TestExport, self).setUp()
+        jobtype = JobType(
+            name="foo", classname="Foobar", mode=JobTypeLoadMode.OPEN,
+            code=dedent("""
+            class Foobar(JobType):
+                pass"""))
+        self.project = Project(name=u"foo")
+
+        self.jobs = []
+        for project in (self.project, None):
+            job = Job(job_type=jobtype, project=project, data={"a": 1})
+            for frame in (1, 2, 3):
+                task = Task(job=job, frame=frame)
+                task.state = WorkState.DONE if frame < 3 else WorkState.QUEUED
+            job.state = WorkState.DONE
+            db.session.add(job)
+            self.jobs.append(job)
+        db.session.commit()
+
+    def test_export_jobs_ndjson(self):
+        output = BytesIO()
+        self.assertEqual(export_jobs(output), 2)
+        rows = sorted(
+            (json.loads(line) for line in
+             output.getvalue().decode("utf-8").splitlines()),
+            key=lambda row: row["id"])
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0]["state"], WorkState.DONE.str)
+        self.assertEqual(rows[0]["data"], {"a": 1})
+
+        output = BytesIO()
+        self.assertEqual(export_jobs(output, projects=[self.project.id]), 1)
+        self.assertEqual(
+            json.loads(output.getvalue().decode("utf-8"))["id"],
+            self.jobs[0].id)
+
+    def test_export_tasks_time_range(self):
+        now = datetime.now()
+        self.assertEqual(export_tasks(BytesIO()), 4)
+        self.assertEqual(
+            export_tasks(BytesIO(), start=now - timedelta(hours=1)), 4)
+        self.assertEqual(
+            export_tasks(BytesIO(), start=now + timedelta(hours=1)), 0)
+        self.assertEqual(
+            export_tasks(BytesIO(), projects=[self.project.id]), 2)
+
+    def test_export_tasks_csv_gzip(self):
+        output = BytesIO()
+        self.assertEqual(export_tasks(output, format=CSV, compress=True), 4)
+        data = gzip.GzipFile(fileobj=BytesIO(output.getvalue())).read()
+        rows = list(csv.DictReader(StringIO(data.decode("utf-8"))))
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(
+            set(row["state"] for row in rows), set([WorkState.DONE.str]))
+
+    def test_export_jobs_csv_unicode(self):
+        self.jobs[0].user = u"jos\xe9"
+        db.session.commit()
+        output = BytesIO()
+        self.assertEqual(export_jobs(output, format=CSV), 2)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertIn(u"jos\xe9".encode("utf-8"), output.getvalue())
+
+    def test_invalid_format(self):
+        with self.assertRaises(ValueError):
+            export_jobs(BytesIO(), format="xml")
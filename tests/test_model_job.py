@@ -21,16 +21,25 @@ relationships.
 
 from textwrap import dedent
 
-from datetime import datetime
+try:
+    import tracemalloc
+except ImportError:  # pragma: no cover
+    tracemalloc = None
+
+from datetime import datetime, timedelta
 from sqlalchemy.exc import DatabaseError
 
-from .utcore import ModelTestCase, unittest
+from .utcore import ModelTestCase, QueryCounter, unittest
 from pyfarm.core.enums import WorkState
 from pyfarm.master.application import db
-from pyfarm.models.tag import Tag
-from pyfarm.models.software import Software
+from pyfarm.models.tag import Tag, tag_ids
+from pyfarm.models.software import (
+    Software, software_ids, version_sort_key, parse_constraint)
 from pyfarm.models.agent import Agent
-from pyfarm.models.job import Job
+from pyfarm.models.job import (
+    Job, JobDependencies, JobTagAssociation, ready_job_callbacks)
+from pyfarm.models.project import Project, project_usage, project_ids
+from pyfarm.models.task import Task, TaskDependencies
 from pyfarm.core.enums import JobTypeLoadMode
 from pyfarm.models.jobtype import JobType
 
@@ -89,6 +98,30 @@ class TestTags(ModelTestCase):
         with self.assertRaises(DatabaseError):
             db.session.commit()
 
+    def test_get_cached(self):
+        self.assertIsNone(Tag.get("cached", create=False))
+        self.assertNotIn("cached", tag_ids)
+
+        tag = Tag.get("cached")
+        db.session.commit()
+        self.assertNotIn("cached", tag_ids)
+        misses = tag_ids.misses
+
+        for _ in range(10):
+            self.assertEqual(Tag.get_id("cached"), tag.id)
+        self.assertEqual(tag_ids.misses, misses + 1)
+
+        db.session.delete(tag)
+        db.session.commit()
+        self.assertIsNone(Tag.get_id("cached"))
+
+    def test_get_pending(self):
+        self.assertIsNone(Tag.get("pending", create=False))
+        tag = Tag.get("pending")
+        self.assertIs(Tag.get("pending"), tag)
+        db.session.commit()
+        self.assertEqual(Tag.query.filter_by(tag="pending").count(), 1)
+
 
 class TestSoftware(ModelTestCase):
     def test_insert(self):
@@ -145,6 +178,39 @@ class TestSoftware(ModelTestCase):
         with self.assertRaises(DatabaseError):
             db.session.commit()
 
+    def test_version_key(self):
+        versions = ["1.0a", "2", "2.0.1", "10", "2014", "2014.1", "2014.10"]
+        self.assertEqual(
+            sorted(versions, key=version_sort_key),
+            ["1.0a", "2", "2.0.1", "10", "2014", "2014.1", "2014.10"])
+        self.assertEqual(version_sort_key("1.0"), version_sort_key("1"))
+        self.assertIsNone(version_sort_key("any"))
+
+        software = Software(software="foo", version="2014.1")
+        self.assertEqual(software.version_key, version_sort_key("2014.1"))
+
+    def test_parse_constraint(self):
+        self.assertEqual(parse_constraint("any"), [])
+        self.assertEqual(parse_constraint("2014"), [("==", "2014")])
+        self.assertEqual(
+            parse_constraint(">= 2014,<2016"), [(">=", "2014"), ("<", "2016")])
+
+        with self.assertRaises(ValueError):
+            parse_constraint(">=")
+
+    def test_get_cached(self):
+        self.assertIsNone(Software.get_id("foo", "1.0"))
+        software = Software.get("foo", "1.0")
+        db.session.commit()
+        self.assertEqual(Software.get("foo", "1.0"), software)
+        self.assertIsNone(Software.get_id("foo"))
+        self.assertEqual(software_ids.get(("foo", "1.0")), software.id)
+
+        software.version = "2.0"
+        db.session.commit()
+        self.assertEqual(len(software_ids), 0)
+        self.assertEqual(Software.get_id("foo", "2.0"), software.id)
+
 
 class TestJobEventsAndValidation(unittest.TestCase):
     def test_ram(self):
@@ -183,3 +249,648 @@ class TestJobEventsAndValidation(unittest.TestCase):
         model.state = WorkState.RUNNING
         self.assertIsInstance(model.time_started, datetime)
         self.assertEqual(model.attempts, 1)
+
+
+def create_job(**kwargs):
+    """creates and adds a job, and the jobtype it requires, to the session"""
+    jobtype = JobType()
+    jobtype.name = "foo"
+    jobtype.classname = "Foobar"
+    jobtype.code = dedent("""
+    class Foobar(JobType):
+        pass""").encode("utf-8")
+    jobtype.mode = JobTypeLoadMode.OPEN
+
+    job = Job()
+    job.job_type = jobtype
+    for key, value in kwargs.items():
+        setattr(job, key, value)
+
+    db.session.add_all([jobtype, job])
+    return job
+
+
+class TestJobPriorityAging(ModelTestCase):
+    def create_job(self, priority, time_submitted):
+        return create_job(priority=priority, time_submitted=time_submitted)
+
+    def test_aging_key(self):
+        now = datetime.now()
+        job = self.create_job(10, now)
+        db.session.commit()
+        self.assertEqual(
+            job.aging_key, Job.compute_aging_key(10, job.time_submitted))
+        self.assertAlmostEqual(job.effective_priority_at(now), 10)
+
+        job.priority = 20
+        db.session.commit()
+        self.assertAlmostEqual(job.effective_priority_at(now), 20)
+
+    def test_dispatch_order(self):
+        now = datetime.now()
+        hours = 5 / float(Job.AGING_RATE)
+        old = self.create_job(0, now - timedelta(hours=hours))
+        new = self.create_job(3, now)
+        capped = self.create_job(
+            -Job.AGING_CAP + 1,
+            now - timedelta(hours=Job.AGING_CAP * 10 / float(Job.AGING_RATE)))
+        db.session.commit()
+        self.assertEqual(Job.dispatch_order(3, now=now), [old, new, capped])
+        self.assertEqual(Job.dispatch_order(1, now=now), [old])
+        self.assertAlmostEqual(capped.effective_priority_at(now), 1)
+        ordered = Job.query.order_by(Job.effective_priority(now).desc()).all()
+        self.assertEqual(ordered, [old, new, capped])
+
+
+class TestJobTaskBatches(ModelTestCase):
+    def create_agent(self):
+        agent = Agent()
+        agent.hostname = "foobar"
+        agent.ip = "10.0.0.1"
+        agent.port = Agent.MIN_PORT
+        agent.cpus = Agent.MIN_CPUS
+        agent.ram = Agent.MIN_RAM
+        agent.free_ram = Agent.MIN_RAM
+        db.session.add(agent)
+        return agent
+
+    def test_task_batches(self):
+        job = create_job(batch=2, by=1)
+        for frame in (5, 1, 2, 3, 6):
+            db.session.add(Task(job=job, frame=frame))
+        db.session.commit()
+
+        batches = list(job.task_batches())
+        self.assertEqual(
+            [(batch.start, batch.end, len(batch.task_ids))
+             for batch in batches],
+            [(1, 2, 2), (3, 3, 1), (5, 6, 2)])
+        self.assertEqual(len(list(job.task_batches(batch=10))), 2)
+
+    def test_claim_batch(self):
+        job = create_job(batch=3)
+        agent = self.create_agent()
+        for frame in (1, 2, 3):
+            db.session.add(Task(job=job, frame=frame))
+        db.session.commit()
+
+        batch = next(job.task_batches())
+        self.assertTrue(Task.claim_batch(batch, agent.id))
+        db.session.commit()
+        self.assertFalse(Task.claim_batch(batch, agent.id))
+        self.assertEqual(list(job.task_batches()), [])
+        db.session.expire_all()
+        self.assertEqual(agent.tasks.count(), 3)
+
+    def test_leases(self):
+        job = create_job(batch=2)
+        agent = self.create_agent()
+        for frame in (1, 2):
+            db.session.add(Task(job=job, frame=frame))
+        db.session.commit()
+
+        now = datetime.now()
+        self.assertTrue(Task.claim_batch(next(job.task_batches()), agent.id))
+        db.session.commit()
+        self.assertEqual(Task.release_expired_leases(now), 0)
+        self.assertEqual(Task.renew_leases(agent.id, 60), 2)
+        db.session.commit()
+
+        expired = now + timedelta(seconds=120)
+        self.assertEqual(Task.release_expired_leases(expired), 2)
+        db.session.commit()
+        db.session.expire_all()
+        self.assertEqual(agent.tasks.count(), 0)
+        self.assertEqual(job.tasks_queued.count(), 2)
+        self.assertEqual(Task.renew_leases(agent.id), 0)
+
+    def test_lease_events(self):
+        task = Task(frame=1)
+        task.agent_id = 1
+        self.assertIsNotNone(task.lease_expires)
+        task.state = WorkState.DONE
+        self.assertIsNone(task.lease_expires)
+
+
+class TestJobRangeTasks(ModelTestCase):
+    def test_create_tasks(self):
+        job = create_job(start=1, end=10, by=1)
+        tasks = job.create_tasks(range_size=4)
+        db.session.commit()
+        self.assertEqual([task.frame_count for task in tasks], [4, 4, 2])
+        self.assertEqual(job.tasks.count(), 3)
+        self.assertEqual(job.frame_counts(), {WorkState.QUEUED: 10})
+        self.assertEqual(
+            [frame for frame, state in job.frame_states()],
+            [float(frame) for frame in range(1, 11)])
+
+    def test_split(self):
+        job = create_job(start=1, end=10, by=1)
+        task, = job.create_tasks(range_size=10)
+        next_eligible = datetime.now() + timedelta(minutes=5)
+        lease_expires = datetime.now() + timedelta(minutes=10)
+        task.next_eligible = next_eligible
+        task.lease_expires = lease_expires
+        created = task.split(4, 5)
+        task.state = WorkState.FAILED
+        db.session.commit()
+        self.assertEqual((task.frame, task.frame_end), (4, 5))
+        for copy in created:
+            self.assertEqual(copy.next_eligible, next_eligible)
+            self.assertEqual(copy.lease_expires, lease_expires)
+        self.assertEqual(
+            sorted((task.frame, task.frame_end) for task in created),
+            [(1, 3), (6, 10)])
+        self.assertEqual(job.frame_state(4), WorkState.FAILED)
+        self.assertEqual(job.frame_state(7), WorkState.QUEUED)
+        self.assertIsNone(job.frame_state(7.5))
+        self.assertEqual(
+            job.frame_counts(), {WorkState.QUEUED: 8, WorkState.FAILED: 2})
+
+        with self.assertRaises(ValueError):
+            task.split(1)
+
+    def test_range_batches(self):
+        job = create_job(start=1, end=10, by=1, batch=3)
+        job.create_tasks(range_size=5)
+        db.session.commit()
+        self.assertEqual(
+            [(batch.start, batch.end) for batch in job.task_batches()],
+            [(1, 3), (4, 6), (7, 9), (10, 10)])
+
+        batch = next(job.task_batches())
+        self.assertTrue(Task.claim_batch(batch, None))
+        db.session.commit()
+        self.assertEqual(
+            [(batch.start, batch.end) for batch in job.task_batches()],
+            [(4, 6), (7, 9), (10, 10)])
+
+    def test_claim_stale_batch(self):
+        job = create_job(start=1, end=10, by=1, batch=3)
+        task, = job.create_tasks(range_size=10)
+        db.session.commit()
+        batch = next(job.task_batches())
+
+        task.frame = 5
+        db.session.commit()
+        self.assertFalse(Task.claim_batch(batch, None))
+        db.session.commit()
+        self.assertEqual(task.state, WorkState.QUEUED)
+        self.assertEqual((task.frame, task.frame_end), (5, 10))
+        self.assertEqual(job.tasks.count(), 1)
+
+
+class TestJobStateMap(ModelTestCase):
+    def test_state_map(self):
+        job = create_job(start=1, end=10, by=1)
+        tasks = job.create_tasks(range_size=5)
+        db.session.commit()
+
+        statemap = job.state_map()
+        self.assertIs(job.state_map(), statemap)
+        self.assertEqual(statemap.counts(), {WorkState.QUEUED: 10})
+
+        tasks[1].state = WorkState.FAILED
+        self.assertEqual(statemap.ranges(WorkState.FAILED), [(6, 10)])
+        db.session.commit()
+        self.assertEqual(
+            job.state_map(cache=False).counts(),
+            {WorkState.QUEUED: 5, WorkState.FAILED: 5})
+
+    def test_state_map_without_start(self):
+        job = create_job()
+        db.session.commit()
+        statemap = job.state_map(cache=False)
+        self.assertEqual(len(statemap), 0)
+        self.assertEqual(statemap.counts(), {})
+
+        for frame in (3, 4, 5):
+            db.session.add(Task(job=job, frame=frame))
+        db.session.commit()
+        statemap = job.state_map(cache=False)
+        self.assertEqual(len(statemap), 3)
+        self.assertEqual(statemap.ranges(WorkState.QUEUED), [(3, 5)])
+
+
+class TestJobRequeue(ModelTestCase):
+    def create_failed(self, requeue, attempts):
+        job = create_job(requeue=requeue, state=WorkState.FAILED)
+        for frame, attempt in enumerate(attempts):
+            task = Task(job=job, frame=frame, state=WorkState.FAILED)
+            task.attempts = attempt
+            db.session.add(task)
+        return job
+
+    def test_requeue_failed_tasks(self):
+        limited = self.create_failed(2, [1, 2, 3])
+        never = self.create_failed(0, [1])
+        always = self.create_failed(-1, [1, 10])
+        db.session.commit()
+        self.assertEqual(Job.requeue_failed_tasks(), (4, 2))
+        db.session.expire_all()
+        self.assertEqual(limited.tasks_queued.count(), 2)
+        self.assertEqual(limited.tasks_failed.count(), 1)
+        self.assertEqual(limited.state, WorkState.QUEUED)
+        self.assertEqual(never.tasks_failed.count(), 1)
+        self.assertEqual(never.state, WorkState.FAILED)
+        self.assertEqual(always.tasks_queued.count(), 2)
+        self.assertEqual(Job.requeue_failed_tasks([never.id]), (0, 1))
+
+    def test_requeue_backoff(self):
+        job = self.create_failed(-1, [1, 2])
+        db.session.commit()
+        now = datetime.now()
+        Job.requeue_failed_tasks()
+        db.session.expire_all()
+
+        for task in job.tasks:
+            self.assertGreater(task.next_eligible, now)
+            delay = Task.retry_delay(task.attempts, 0)
+            self.assertLessEqual(
+                task.next_eligible, now + timedelta(seconds=delay + 5))
+
+        self.assertEqual(list(job.task_batches()), [])
+        self.assertEqual(Task.query.filter(
+            Task.eligible(now + timedelta(seconds=Task.RETRY_MAX_DELAY))
+        ).count(), 2)
+
+    def test_requeue_jitter(self):
+        job = self.create_failed(-1, [3, 3])
+        db.session.commit()
+        Job.requeue_failed_tasks()
+        db.session.expire_all()
+        first, second = job.tasks.order_by(Task.id).all()
+        self.assertEqual(first.attempts, second.attempts)
+        self.assertNotEqual(first.next_eligible, second.next_eligible)
+
+    def test_retry_delay(self):
+        self.assertEqual(Task.retry_delay(0), 0)
+        self.assertEqual(Task.retry_delay(1, 0), Task.RETRY_DELAY)
+        self.assertEqual(Task.retry_delay(2, 0), Task.RETRY_DELAY * 2)
+        self.assertEqual(Task.retry_delay(1000, 0), Task.RETRY_MAX_DELAY)
+        self.assertLessEqual(
+            Task.retry_delay(1, 1), Task.RETRY_DELAY * (1 - Task.RETRY_JITTER))
+
+    def test_retry_event(self):
+        task = Task(frame=1, state=WorkState.FAILED)
+        task.attempts = 1
+        now = datetime.now()
+        task.state = WorkState.QUEUED
+        self.assertGreater(task.next_eligible, now)
+
+
+class TestJobDependencies(ModelTestCase):
+    def setUp(self):
+        super(TestJobDependencies, self).setUp()
+        self.ready = []
+        ready_job_callbacks.append(self.ready.extend)
+
+    def tearDown(self):
+        ready_job_callbacks.remove(self.ready.extend)
+        super(TestJobDependencies, self).tearDown()
+
+    def test_release_children(self):
+        parent_a = create_job()
+        parent_b = create_job()
+        child = create_job()
+        child.parents.extend([parent_a, parent_b])
+        db.session.commit()
+        self.assertEqual(child.waiting_parents, 2)
+        self.assertEqual(parent_a.children, [child])
+        self.assertEqual(
+            db.session.query(JobDependencies).filter_by(
+                parentid=child.id).count(), 2)
+
+        parent_a.state = WorkState.DONE
+        db.session.commit()
+        self.assertEqual(child.waiting_parents, 1)
+        self.assertEqual(self.ready, [])
+
+        parent_b.state = WorkState.DONE
+        db.session.commit()
+        self.assertEqual(child.waiting_parents, 0)
+        self.assertEqual(self.ready, [child.id])
+
+        parent_b.state = WorkState.QUEUED
+        db.session.commit()
+        self.assertEqual(child.waiting_parents, 1)
+
+    def test_child_in_same_flush(self):
+        parent = create_job()
+        other = create_job()
+        child = create_job()
+        child.parents.append(parent)
+        db.session.commit()
+
+        parent.state = WorkState.DONE
+        child.user = u"changed"
+        db.session.flush()
+        child.parents.append(other)
+        db.session.commit()
+        self.assertEqual(child.waiting_parents, 1)
+
+    def test_no_callbacks(self):
+        ready_job_callbacks.remove(self.ready.extend)
+        try:
+            parent = create_job()
+            child = create_job()
+            child.parents.append(parent)
+            db.session.commit()
+            parent.state = WorkState.DONE
+            db.session.commit()
+            self.assertEqual(child.waiting_parents, 0)
+        finally:
+            ready_job_callbacks.append(self.ready.extend)
+        self.assertEqual(self.ready, [])
+
+    def test_finished_parent(self):
+        parent = create_job(state=WorkState.DONE)
+        child = create_job()
+        child.parents.append(parent)
+        self.assertEqual(child.waiting_parents, 0)
+        child.parents.remove(parent)
+        self.assertEqual(child.waiting_parents, 0)
+
+
+class TestProjectQuota(ModelTestCase):
+    def setUp(self):
+        super(TestProjectQuota, self).setUp()
+        project_usage.reset({}, {})
+
+    def test_quota(self):
+        project = Project(name=u"foo", max_running_tasks=2)
+        job = create_job(
+            project=project, batch=2, cpus=4,
+            time_submitted=datetime.now() - timedelta(minutes=1))
+        other = create_job()
+        for frame in (1, 2, 3):
+            db.session.add(Task(job=job, frame=frame))
+        db.session.commit()
+        self.assertFalse(project_usage.blocked(project.id))
+        self.assertEqual(Job.dispatch_order(2), [job, other])
+
+        self.assertTrue(Task.claim_batch(next(job.task_batches()), None))
+        db.session.commit()
+        self.assertTrue(project_usage.blocked(project.id))
+        self.assertEqual(project_usage.cpus[project.id], 8)
+        self.assertEqual(Project.blocked_ids(), set([project.id]))
+        self.assertEqual(Job.dispatch_order(2), [other])
+        self.assertEqual(
+            Job.dispatch_order(2, skip_blocked=False), [job, other])
+
+        task = job.tasks_queued.first()
+        task.state = WorkState.RUNNING
+        db.session.flush()
+        self.assertEqual(project_usage.tasks[project.id], 2)
+        db.session.rollback()
+        self.assertEqual(project_usage.tasks[project.id], 2)
+        self.assertEqual(project_usage.cpus[project.id], 8)
+
+        task = job.tasks_queued.first()
+        task.state = WorkState.RUNNING
+        db.session.commit()
+        self.assertEqual(project_usage.tasks[project.id], 3)
+        task.state = WorkState.DONE
+        db.session.commit()
+        self.assertEqual(project_usage.tasks[project.id], 2)
+
+        project_usage.reset({}, {})
+        Project.reconcile_usage()
+        self.assertEqual(project_usage.tasks[project.id], 2)
+        self.assertTrue(project_usage.blocked(project.id))
+
+        project.max_running_tasks = None
+        db.session.commit()
+        self.assertFalse(project_usage.blocked(project.id))
+
+    def test_get_cached(self):
+        self.assertIsNone(Project.get(u"bar", create=False))
+        self.assertNotIn(u"bar", project_ids)
+
+        project = Project(name=u"bar")
+        db.session.add(project)
+        db.session.commit()
+        self.assertNotIn(u"bar", project_ids)
+        self.assertEqual(Project.get(u"bar"), project)
+        self.assertEqual(project_ids.get(u"bar"), project.id)
+
+    def test_get_pending(self):
+        self.assertIsNone(Project.get(u"pending", create=False))
+        project = Project(name=u"pending")
+        db.session.add(project)
+        self.assertIs(Project.get(u"pending"), project)
+        db.session.commit()
+        self.assertEqual(
+            Project.query.filter_by(name=u"pending").count(), 1)
+
+
+class TestJobResolve(ModelTestCase):
+    def test_tags(self):
+        existing = Tag.get("a")
+        db.session.commit()
+        tag_ids.clear()
+
+        ids = Tag.resolve(["a", "b", "b", "c"])
+        self.assertEqual(set(ids), set(["a", "b", "c"]))
+        self.assertEqual(ids["a"], existing.id)
+        self.assertEqual(Tag.get_id("c"), ids["c"])
+        self.assertEqual(Tag.resolve(["a", "b", "c"]), ids)
+
+        job = create_job()
+        self.assertEqual(job.add_tags(["a", "b"]), 2)
+        self.assertEqual(job.add_tags(["b", "d"]), 1)
+        db.session.commit()
+        self.assertEqual(
+            sorted(tag.tag for tag in job.tags), ["a", "b", "d"])
+
+    def test_software(self):
+        ids = Software.resolve(["foo", ("foo", "1.0"), ("bar", "2.0")])
+        self.assertEqual(
+            set(ids), set([("foo", "any"), ("foo", "1.0"), ("bar", "2.0")]))
+        self.assertEqual(len(set(ids.values())), 3)
+
+        job = create_job()
+        self.assertEqual(job.add_software(["foo", ("bar", "2.0")]), 2)
+        db.session.commit()
+        self.assertEqual(
+            sorted((item.software, item.version) for item in job.software),
+            [("bar", "2.0"), ("foo", "any")])
+
+
+class TestJobDeferredColumns(ModelTestCase):
+    def test_details_deferred(self):
+        job = create_job(notes="notes", environ={"a": "b"})
+        db.session.commit()
+        job_id = job.id
+        db.session.remove()
+
+        job = Job.query.get(job_id)
+        self.assertNotIn("notes", job.__dict__)
+        self.assertNotIn("environ", job.__dict__)
+        self.assertEqual(job.notes, "notes")
+        db.session.remove()
+
+        job = Job.query.options(*Job.WITH_DETAILS).filter_by(id=job_id).one()
+        for name in ("notes", "environ", "args", "data"):
+            self.assertIn(name, job.__dict__)
+        self.assertEqual(job.environ, {"a": "b"})
+        self.assertNotIn("code", job.job_type.__dict__)
+        self.assertIn("class Foobar", job.job_type.code)
+
+
+class TestLoadingProfiles(ModelTestCase):
+    def test_job_profile_list(self):
+        for _ in range(10):
+            job = create_job(project=Project(name=u"foo"))
+            job.add_tags(["a", "b"])
+            job.add_software(["foo"])
+            db.session.add(Task(job=job, frame=1))
+        db.session.commit()
+        db.session.remove()
+
+        with QueryCounter() as queries:
+            jobs = Job.query.options(*Job.PROFILE_LIST).all()
+            for job in jobs:
+                self.assertEqual(job.project.name, u"foo")
+                self.assertEqual(len(job.tags_list), 2)
+                self.assertEqual(len(job.software_list), 1)
+
+        self.assertEqual(len(jobs), 10)
+        self.assertEqual(queries.count, 3)
+        db.session.remove()
+
+        with QueryCounter() as queries:
+            tasks = Task.query.options(*Task.PROFILE_LIST).all()
+            for task in tasks:
+                self.assertIsNotNone(task.job.id)
+                self.assertIsNone(task.agent)
+
+        self.assertEqual(len(tasks), 10)
+        self.assertEqual(queries.count, 1)
+
+
+class TestKeysetPagination(ModelTestCase):
+    def test_jobs(self):
+        submitted = datetime.now() - timedelta(hours=1)
+        for index in range(10):
+            if index % 3:
+                create_job(priority=index % 2, time_submitted=submitted)
+            else:
+                create_job()
+        db.session.commit()
+
+        expected = Job.query.order_by(
+            Job.priority, Job.time_submitted, Job.id).all()
+        self.assertKeysetPages(Job, expected, 3)
+
+    def test_tasks(self):
+        project = Project(name=u"foo")
+        for index in range(3):
+            job = create_job()
+            for frame in (3, 1, 2, 2):
+                db.session.add(Task(
+                    job=job, frame=frame,
+                    project=project if frame == 1 else None))
+        db.session.commit()
+
+        expected = Task.query.order_by(Task.job_id, Task.frame, Task.id).all()
+        self.assertKeysetPages(Task, expected, 5)
+
+    def test_nullable_columns(self):
+        for model in (Job, Task):
+            for name in model.KEYSET_COLUMNS:
+                column = model.__table__.c[name]
+                self.assertFalse(column.nullable, column)
+
+
+class TestJobStreaming(ModelTestCase):
+    def create_tasks(self, count):
+        job = create_job(start=1, end=count)
+        db.session.flush()
+        db.session.execute(Task.__table__.insert(), [
+            {"job_id": job.id, "frame": frame, "state": WorkState.QUEUED,
+             "priority": 0, "next_eligible": datetime.now()}
+            for frame in range(1, count + 1)])
+        db.session.commit()
+        return job
+
+    def test_iter_tasks(self):
+        job = self.create_tasks(250)
+        frames = []
+        for task in job.iter_tasks(chunk_size=50):
+            frames.append(task.frame)
+            self.assertLessEqual(len(db.session.identity_map), 52)
+
+        self.assertEqual(frames, list(range(1, 251)))
+
+    def test_stream_rows(self):
+        job = self.create_tasks(120)
+        rows = list(Task.stream_rows(
+            [Task.frame, Task.state], Task.job_id == job.id, chunk_size=50))
+        self.assertEqual(len(rows), 120)
+        self.assertEqual(rows[0].state, WorkState.QUEUED)
+
+    @unittest.skipIf(tracemalloc is None, "tracemalloc is not available")
+    def test_memory_flat(self):
+        job = self.create_tasks(3000)
+        job_id = job.id
+        db.session.remove()
+        job = Job.query.get(job_id)
+
+        tracemalloc.start()
+        try:
+            for index, task in enumerate(job.iter_tasks(chunk_size=100)):
+                if index == 1000:
+                    baseline = tracemalloc.get_traced_memory()[0]
+            final = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+
+        self.assertLess(final - baseline, 256 * 1024)
+
+
+class TestJobPurge(ModelTestCase):
+    def setUp(self):
+        super(TestJobPurge, self).setUp()
+        project_usage.reset({}, {})
+        self.ready = []
+        ready_job_callbacks.append(self.ready.extend)
+
+    def tearDown(self):
+        ready_job_callbacks.remove(self.ready.extend)
+        super(TestJobPurge, self).tearDown()
+
+    def test_purge(self):
+        parent = create_job(project=Project(name=u"foo"), cpus=2)
+        other = create_job()
+        child = create_job()
+        child.parents.extend([parent, other])
+        tasks = [Task(job=parent, frame=frame) for frame in range(1, 6)]
+        tasks[1].parents.append(tasks[0])
+        db.session.add_all(tasks)
+        db.session.flush()
+        parent.add_tags(["a", "b"])
+        parent.add_software(["foo"])
+        tasks[0].state = WorkState.RUNNING
+        db.session.commit()
+        parent_id, child_id = parent.id, child.id
+        project_id = parent.project_id
+        self.assertEqual(project_usage.cpus[project_id], 2)
+
+        counts = Job.purge([parent_id], batch_size=2, chunk_size=1)
+        self.assertEqual(counts[Task.__table__.name], 5)
+        self.assertEqual(counts[Job.__table__.name], 1)
+        self.assertEqual(counts[JobDependencies.name], 1)
+        self.assertEqual(counts[JobTagAssociation.name], 2)
+        self.assertEqual(counts[TaskDependencies.name], 1)
+        self.assertEqual(project_usage.cpus[project_id], 0)
+
+        db.session.expire_all()
+        self.assertIsNone(Job.query.get(parent_id))
+        self.assertEqual(Task.query.count(), 0)
+        self.assertEqual(Job.query.get(child_id).waiting_parents, 1)
+        self.assertEqual(self.ready, [])
+
+        Job.purge([other.id])
+        self.assertEqual(Job.query.get(child_id).waiting_parents, 0)
+        self.assertEqual(self.ready, [child_id])
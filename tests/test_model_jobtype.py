@@ -21,7 +21,7 @@ from .utcore import ModelTestCase
 from pyfarm.core.enums import JobTypeLoadMode
 from pyfarm.master.application import db
 from pyfarm.models.job import Job
-from pyfarm.models.jobtype import JobType
+from pyfarm.models.jobtype import JobType, code_hash, validated_code
 
 
 class JobTypeTest(ModelTestCase):
@@ -100,3 +100,68 @@ class JobTypeTest(ModelTestCase):
 
         with self.assertRaises(SyntaxError):
             db.session.commit()
+
+    def test_create_reuses_code(self):
+        code = dedent("""
+        class Foobar(JobType):
+            pass""")
+        jobtype = JobType.create("foo", "Foobar", code)
+        db.session.commit()
+        self.assertEqual(jobtype.code_sha256, code_hash(code))
+        self.assertIs(JobType.create("foo", "Foobar", code), jobtype)
+        self.assertIsNot(JobType.create("bar", "Foobar", code), jobtype)
+
+    def test_validation_cached(self):
+        code = dedent("""
+        class Foobar(object):
+            pass""")
+        jobtype = JobType(classname="Foobar", code=code)
+        misses = validated_code.misses
+
+        for _ in range(3):
+            with self.assertRaises(SyntaxError):
+                jobtype.check_code()
+
+        self.assertEqual(validated_code.misses, misses + 1)
+        self.assertIn((code_hash(code), "Foobar"), validated_code)
+
+    def test_compiled(self):
+        code = dedent("""
+        class Foobar(JobType):
+            pass""")
+        jobtype = JobType(classname="Foobar", code=code)
+        other = JobType(classname="Foobar", code=code)
+        self.assertIs(jobtype.compiled(), other.compiled())
+
+        namespace = {"JobType": object}
+        exec(jobtype.compiled(), namespace)
+        self.assertIn("Foobar", namespace)
+
+    def test_create_many(self):
+        valid = dedent("""
+        class Foobar(JobType):
+            pass""")
+        invalid = dedent("""
+        class Foobar(object):
+            pass""")
+        jobtypes = [
+            {"name": "a", "classname": "Foobar", "code": valid,
+             "mode": JobTypeLoadMode.DOWNLOAD},
+            {"name": "b", "classname": "Foobar", "code": invalid,
+             "mode": JobTypeLoadMode.DOWNLOAD},
+            {"name": "c", "classname": "Foobar", "code": "class (",
+             "mode": JobTypeLoadMode.DOWNLOAD},
+            {"name": "d", "classname": "Foobar", "code": invalid,
+             "mode": JobTypeLoadMode.OPEN}]
+
+        report = JobType.create_many(jobtypes, processes=2)
+        db.session.commit()
+        self.assertEqual(report.created, 2)
+        self.assertEqual([error[:2] for error in report.errors],
+                         [(1, "b"), (2, "c")])
+        self.assertTrue(report.errors[0][2].startswith("SyntaxError"))
+        self.assertEqual(
+            sorted(jobtype.name for jobtype in JobType.query), ["a", "d"])
+        self.assertEqual(
+            JobType.query.filter_by(name="a").one().code_sha256,
+            code_hash(valid))
@@ -20,7 +20,8 @@ from datetime import datetime, timedelta
 
 from .utcore import ModelTestCase
 from pyfarm.master.application import db, login_serializer
-from pyfarm.models.user import User, Role
+from pyfarm.models.user import (
+    User, Role, UserSnapshot, permission_snapshots, auth_tokens)
 
 
 class UserTest(ModelTestCase):
@@ -41,6 +42,38 @@ class UserTest(ModelTestCase):
             user.get_auth_token(),
             login_serializer.dumps([str(user.id), user.password]))
 
+    def test_from_auth_token(self):
+        user = User.create(uuid.uuid4().hex, uuid.uuid4().hex, roles=["a"])
+        token = user.get_auth_token()
+        hits = auth_tokens.hits
+
+        snapshot = User.from_auth_token(token)
+        self.assertIsInstance(snapshot, UserSnapshot)
+        self.assertEqual(snapshot.get_id(), user.id)
+        self.assertTrue(snapshot.is_active())
+        self.assertTrue(snapshot.has_roles(allowed=["a"]))
+        self.assertEqual(snapshot.permissions(), user.permissions())
+        self.assertIs(User.from_auth_token(token), snapshot)
+        self.assertEqual(auth_tokens.hits, hits + 1)
+
+        user.password = User.hash_password(uuid.uuid4().hex)
+        db.session.commit()
+        self.assertIsNone(User.from_auth_token(token))
+        self.assertIsNotNone(User.from_auth_token(user.get_auth_token()))
+        self.assertIsNone(User.from_auth_token("foo"))
+        self.assertIsNone(User.from_auth_token(login_serializer.dumps(5)))
+
+    def test_from_auth_token_max_age(self):
+        user = User.create(uuid.uuid4().hex, uuid.uuid4().hex)
+        token = user.get_auth_token()
+        snapshot = User.from_auth_token(token)
+        hits = auth_tokens.hits
+
+        checked = User.from_auth_token(token, max_age=60)
+        self.assertIsNotNone(checked)
+        self.assertIsNot(checked, snapshot)
+        self.assertEqual(auth_tokens.hits, hits)
+
     def test_get_id(self):
         username = uuid.uuid4().hex
         password = uuid.uuid4().hex
@@ -120,6 +153,62 @@ class UserTest(ModelTestCase):
         self.assertFalse(
             user.has_roles(required=[roles[0].name, roles[1].name, "foo"]))
 
+    def test_permissions_cached(self):
+        user = User.create(uuid.uuid4().hex, uuid.uuid4().hex, roles=["a.b"])
+        snapshot = user.permissions()
+        self.assertIs(user.permissions(), snapshot)
+        self.assertEqual(snapshot.roles, frozenset(["a.b"]))
+        self.assertTrue(snapshot.active)
+        self.assertIsNone(snapshot.expires)
+        self.assertTrue(user.has_roles(allowed=["a.b.c"]))
+        self.assertTrue(user.has_roles(required=["a.b"]))
+        self.assertTrue(user.has_roles(required=["a.b.c"]))
+        self.assertFalse(user.has_roles(required=["a"]))
+        self.assertFalse(user.has_roles(allowed=["a.b"], required=["d"]))
+
+        role = Role.create("c")
+        user.roles.append(role)
+        self.assertNotIn(user.id, permission_snapshots)
+        self.assertTrue(user.has_roles(required=["c"]))
+
+        expiration = datetime.now() + timedelta(days=1)
+        role.expiration = expiration
+        self.assertEqual(user.permissions().expires, expiration)
+        role.active = False
+        self.assertFalse(user.is_active())
+        self.assertFalse(user.permissions().active)
+
+    def test_create_many(self):
+        existing = Role.create("a")
+        user_ids = User.create_many([
+            {"username": "foo", "password": "foo", "roles": ["a", "a.b"]},
+            {"username": "bar", "password": "bar", "roles": "c",
+             "email": "bar@example.com"},
+            {"username": "baz", "password": "baz"}])
+        db.session.remove()
+
+        self.assertEqual(set(user_ids), set(["foo", "bar", "baz"]))
+        foo = User.get("foo")
+        self.assertEqual(foo.id, user_ids["foo"])
+        self.assertTrue(foo.check_password("foo"))
+        self.assertEqual(
+            set(role.name for role in foo.roles), set(["a", "a.b"]))
+        self.assertEqual(User.get("bar").email, "bar@example.com")
+        self.assertEqual(User.get("baz").roles, [])
+        self.assertEqual(Role.query.filter_by(name="a").one().id, existing.id)
+        self.assertEqual(
+            set(role.name for role in Role.create("a").descendants),
+            set(["a", "a.b"]))
+
+    def test_with_roles(self):
+        root = User.create(uuid.uuid4().hex, uuid.uuid4().hex, roles=["root"])
+        admin = User.create(
+            uuid.uuid4().hex, uuid.uuid4().hex, roles=["root.admin"])
+        User.create(uuid.uuid4().hex, uuid.uuid4().hex, roles=["other"])
+        self.assertEqual(
+            set(User.with_roles(["root.admin"])), set([root, admin]))
+        self.assertEqual(list(User.with_roles(["root"])), [root])
+
 
 class RoleTest(ModelTestCase):
     def test_create(self):
@@ -147,3 +236,23 @@ class RoleTest(ModelTestCase):
         self.assertTrue(role.is_active())
         time.sleep(1)
         self.assertFalse(role.is_active())
+
+    def test_closure(self):
+        child = Role.create("a.b")
+        grandchild = Role.create("a.b.c")
+        parent = Role.create("a")
+        Role.create("a_b")
+        self.assertEqual(
+            set(role.name for role in parent.descendants),
+            set(["a", "a.b", "a.b.c"]))
+        self.assertEqual(
+            set(role.name for role in grandchild.ancestors),
+            set(["a", "a.b", "a.b.c"]))
+
+        child.name = "x.b"
+        db.session.commit()
+        self.assertEqual(
+            set(role.name for role in parent.descendants), set(["a"]))
+        self.assertEqual(
+            set(role.name for role in grandchild.ancestors),
+            set(["a", "a.b.c"]))
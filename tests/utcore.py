@@ -31,6 +31,7 @@ if PY26:
 else:
     import unittest
 
+from sqlalchemy import event
 from sqlalchemy.exc import SAWarning
 
 from pyfarm.core.logger import disable_logging
@@ -103,6 +104,27 @@ from pyfarm.models.job import Job
 from pyfarm.models.project import Project
 
 
+class QueryCounter(object):
+    """
+    Context manager which counts the statements executed against the
+    database while it's active.
+    """
+    def __init__(self):
+        self.count = 0
+
+    def before_cursor_execute(self, *args, **kwargs):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(db.engine, "before_cursor_execute",
+                     self.before_cursor_execute)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(db.engine, "before_cursor_execute",
+                     self.before_cursor_execute)
+
+
 class ModelTestCase(unittest.TestCase):
     ORIGINAL_ENVIRONMENT = dict(os.environ)
 
@@ -116,3 +138,19 @@ class ModelTestCase(unittest.TestCase):
     def tearDown(self):
         db.session.remove()
         db.drop_all()
+
+    def assertKeysetPages(self, model, expected, limit):
+        """
+        walks every page of ``model`` forwards and backwards and compares
+        the rows to ``expected``
+        """
+        for reverse in (False, True):
+            rows, token = model.keyset_page(limit=limit, reverse=reverse)
+            pages = list(rows)
+            while token is not None:
+                rows, token = model.keyset_page(token=token, limit=limit)
+                self.assertLessEqual(len(rows), limit)
+                pages.extend(rows)
+
+            self.assertEqual(
+                pages, list(reversed(expected)) if reverse else expected)